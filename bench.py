@@ -0,0 +1,1155 @@
+"""
+أدوات قياس الأداء لسيرفر التتبع.
+
+    python bench.py ingest --seconds 10 --clients 16
+    python bench.py writer --events 5000
+    python bench.py funnel --events 5000000
+    python bench.py contention --stats-clients 8
+    python bench.py storage --events 200000
+
+ingest: يشغّل uvicorn محلي على قاعدة بيانات مؤقتة لكل وضع استقبال (sync / queue)
+ويضغط على /track ثم يطبع عدد الأحداث المكتوبة في الثانية.
+writer: نفس المقارنة بس على طبقة الكتابة مباشرة بدون HTTP.
+funnel: يعبي قاعدة اصطناعية (5M حدث افتراضياً) ويقارن stats_funnel القديم بمحرك SQL.
+contention: زمن /track (p50/p99) لوحده ومع عملاء يضربوا /stats/funnel بنفس الوقت.
+storage: حجم القاعدة لما user_agent / url / referrer / utm_* تنحفظ نص بكل صف vs ids.
+engines / distinct / json: محرك Parquet، تقديرات HyperLogLog، وسرعة JSON_BACKEND.
+
+    python bench.py seed --db events.db --events 10000000
+    python bench.py http --db events.db --out before.json
+    python bench.py compare before.json after.json
+
+seed: يعبي القاعدة بأحداث واقعية (جلسات، أجهزة راجعة، فانل، واتساب، UA، دول ومدن).
+http: p50/p99 و throughput لـ /track و /track/batch وكل GET /stats/* على uvicorn محلي، كـ JSON.
+compare: نسبة التغير بين تقريرين من http.
+"""
+import argparse
+import http.client
+import inspect
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# -------- تشغيل سيرفر محلي --------
+class LocalServer:
+    def __init__(self, env=None, port=None, db_path=None):
+        self.port = port or random.randint(20000, 40000)
+        self.tmpdir = None
+        if db_path is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            db_path = os.path.join(self.tmpdir.name, "events.db")
+        self.db_path = db_path
+        self.env = dict(os.environ, DB_PATH=db_path, **(env or {}))
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--port", str(self.port), "--log-level", "warning",
+            ],
+            cwd=HERE,
+            env=self.env,
+        )
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                self.get("/status")
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(timeout=30)
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+
+    def connection(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+
+    def get(self, path):
+        conn = self.connection()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read() or b"null")
+        finally:
+            conn.close()
+
+
+def sample_event():
+    return {
+        "event": random.choice(["page_view", "product_view", "add_to_cart"]),
+        "session_id": "s-%d" % random.randint(1, 2000),
+        "device_id": "d-%d" % random.randint(1, 1000),
+        "url": "https://shop.example/products/%d" % random.randint(1, 50),
+        "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Safari",
+        "traffic_source": random.choice(["direct", "whatsapp", "referral"]),
+        "meta": {"product_id": random.randint(1, 50), "nonce": uuid.uuid4().hex},
+    }
+
+
+def hammer(server, seconds, clients, path="/track", body_fn=sample_event):
+    """يرسل طلبات POST من عدة خيوط لمدة محددة ويرجع (ناجح, مرفوض)."""
+    stop_at = time.time() + seconds
+    ok = [0] * clients
+    rejected = [0] * clients
+
+    def worker(i):
+        conn = server.connection()
+        while time.time() < stop_at:
+            conn.request(
+                "POST", path, body=json.dumps(body_fn()),
+                headers={"Content-Type": "application/json"},
+            )
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 200:
+                ok[i] += 1
+            elif resp.status == 429:
+                rejected[i] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(ok), sum(rejected)
+
+
+# -------- Benchmark: سرعة الاستقبال --------
+def bench_ingest(args):
+    results = {}
+    for mode in args.modes:
+        with LocalServer(env={"INGEST_MODE": mode}) as server:
+            started = time.time()
+            ok, rejected = hammer(server, args.seconds, args.clients)
+            # ننتظر الكاتب يفضّي الطابور عشان نحسب المكتوب فعلاً
+            while True:
+                _, status = server.get("/status")
+                if status["ingest"]["queue_depth"] == 0:
+                    break
+                time.sleep(0.05)
+            elapsed = time.time() - started
+            results[mode] = {
+                "accepted": ok,
+                "rejected": rejected,
+                "seconds": round(elapsed, 2),
+                "events_per_sec": round(ok / elapsed, 1),
+            }
+    if "sync" in results and "queue" in results and results["sync"]["events_per_sec"]:
+        results["speedup"] = round(
+            results["queue"]["events_per_sec"] / results["sync"]["events_per_sec"], 2
+        )
+    print(json.dumps(results, indent=2))
+
+
+# -------- Benchmark: الكاتب بدون HTTP --------
+def bench_writer(args):
+    """يقارن commit لكل حدث مع apply_batch على نفس الأحداث، داخل نفس البروسيس."""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "events.db")
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        payloads = [tracker.EventIn(**sample_event()) for _ in range(args.events)]
+        now_ts = int(time.time())
+
+        with tracker.db.writer() as conn:
+            cur = conn.cursor()
+            started = time.perf_counter()
+            for payload in payloads:
+                tracker.write_event(cur, payload, now_ts)
+                tracker.db.commit(conn)
+            per_event = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for i in range(0, len(payloads), args.batch_size):
+                chunk = payloads[i:i + args.batch_size]
+                tracker.apply_batch(conn, [(p, now_ts) for p in chunk])
+            batched = time.perf_counter() - started
+        tracker.db.close()
+
+    results = {
+        "events": args.events,
+        "per_event_commit_eps": round(args.events / per_event, 1),
+        "batched_eps": round(args.events / batched, 1),
+        "speedup": round(per_event / batched, 2),
+    }
+    print(json.dumps(results, indent=2))
+
+
+# -------- بيانات اصطناعية --------
+FUNNEL_EVENTS = ["product_view", "add_to_cart", "cart_view", "begin_checkout", "purchase"]
+
+
+def synthetic_event_rows(n, seed=1, start_ts=None):
+    """صفوف جاهزة لجدول events: جلسات تمشي بالفانل وتوقف بنسب واقعية."""
+    rnd = random.Random(seed)
+    start_ts = start_ts or int(time.time()) - 30 * 86400
+    sources = ["direct", "whatsapp", "referral", "instagram", None]
+    produced = 0
+    session_no = 0
+    while produced < n:
+        session_no += 1
+        session_id = "s-%d" % session_no
+        device_id = "d-%d" % rnd.randint(1, max(1, session_no // 2))
+        source = rnd.choice(sources)
+        ts = start_ts + rnd.randint(0, 30 * 86400)
+        product = rnd.randint(1, 2000)
+        meta = json.dumps({"product_id": product, "product_title": "Product %d" % product})
+        # page views قبل الفانل
+        steps = ["page_view"] * rnd.randint(1, 4)
+        for step in FUNNEL_EVENTS:
+            steps.append(step)
+            if rnd.random() < 0.45:
+                break
+        for step in steps:
+            if produced >= n:
+                break
+            produced += 1
+            ts += rnd.randint(1, 90)
+            yield (
+                step, session_id, device_id,
+                "https://shop.example/products/%d" % product, None, None,
+                source, None, None, None, None,
+                ts, meta if step != "page_view" else "{}",
+                rnd.choice(["JO", "SA", "AE", "EG"]), None, None, None, None,
+            ) + (
+                (str(product), "Product %d" % product, None, None, None)
+                if step != "page_view" else (None,) * 5
+            ) + (None,)
+
+
+# -------- مولّد أحداث واقعي (seed و http) --------
+# (الدولة، الوزن، المدن)
+GEO = [
+    ("JO", 35, ["Amman", "Irbid", "Zarqa", "Aqaba"]),
+    ("SA", 25, ["Riyadh", "Jeddah", "Dammam"]),
+    ("AE", 15, ["Dubai", "Abu Dhabi", "Sharjah"]),
+    ("EG", 15, ["Cairo", "Alexandria", "Giza"]),
+    ("KW", 5, ["Kuwait City"]),
+    ("US", 5, ["New York", "Chicago", None]),
+]
+# (traffic_source، الوزن، utm_source/medium/campaign/content، referrer أول صفحة)
+SOURCES = [
+    ("whatsapp", 22, ("whatsapp", "broadcast", "eid_offers", None), "https://api.whatsapp.com/"),
+    ("instagram", 20, ("instagram", "social", "summer_sale_2024", "story_1"), "https://l.instagram.com/"),
+    ("facebook", 12, ("facebook", "paid", "retargeting_cart", "carousel_a"), "https://lm.facebook.com/"),
+    ("google", 12, ("google", "cpc", "brand_search", None), "https://www.google.com/"),
+    ("referral", 8, (None, None, None, None), "https://blog.example.com/"),
+    ("direct", 26, (None, None, None, None), None),
+]
+# متصفح واتساب الداخلي (لما الرابط ينفتح من محادثة)
+WHATSAPP_USER_AGENTS = [
+    "Mozilla/5.0 (Linux; Android 13; SM-A146P Build/TP1A.220624.014; wv) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Version/4.0 Chrome/124.0.6367.82 Mobile Safari/537.36 WhatsApp/2.24.10.79",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4_1 like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Mobile/15E148 WhatsApp/24.9.78",
+]
+# احتمال إن الجلسة تكمل للخطوة اللي بعدها
+FUNNEL_CONTINUE = {
+    "product_view": 0.35,
+    "add_to_cart": 0.7,
+    "cart_view": 0.6,
+    "begin_checkout": 0.55,
+}
+SHOP_URL = "https://4pytkr-hy.myshopify.com"
+
+
+def _weighted(items, weight_index=1):
+    total = sum(item[weight_index] for item in items)
+    cumulative, acc = [], 0
+    for item in items:
+        acc += item[weight_index]
+        cumulative.append(acc / total)
+    return cumulative
+
+
+class EventGenerator:
+    """
+    أحداث قابلة للتكرار (نفس seed = نفس الأحداث) بشكل جلسات حقيقية:
+    - أجهزة ترجع بجلسات جديدة (الأجهزة القديمة أكثر)، ولكل جهاز UA ودولة ثابتين
+    - كل جلسة إلها مصدر (مع utm و referrer)، page views، وبعدين فانل بنسب توقف
+    - جلسات واتساب نسبة منها بمتصفح واتساب الداخلي
+    - event_id فريد لكل حدث
+    """
+
+    def __init__(self, seed=1, devices=50_000, products=800, start_ts=None, days=30):
+        self.rnd = random.Random(seed)
+        self.seed = seed
+        self.devices = devices
+        self.products = products
+        self.days = days
+        self.start_ts = start_ts if start_ts is not None else int(time.time()) - days * 86400
+        self.session_no = 0
+        self._geo_cum = _weighted(GEO)
+        self._source_cum = _weighted(SOURCES)
+
+    def _pick(self, items, cumulative, r):
+        for item, bound in zip(items, cumulative):
+            if r <= bound:
+                return item
+        return items[-1]
+
+    def _device(self):
+        # مربع الرقم العشوائي: الأجهزة بأول القائمة (الزبائن الراجعين) تظهر أكثر
+        number = int(self.devices * self.rnd.random() ** 2) + 1
+        # صفات الجهاز من رقمه بس، فنفس الجهاز دايماً بنفس الـ UA والمدينة
+        attrs = random.Random(number * 7919 + self.seed)
+        country, _, cities = self._pick(GEO, self._geo_cum, attrs.random())
+        return (
+            "d-%d-%d" % (self.seed, number),
+            attrs.choice(USER_AGENTS),
+            country,
+            attrs.choice(cities),
+        )
+
+    def session(self):
+        """أحداث جلسة وحدة: [(payload dict, created_at)]."""
+        rnd = self.rnd
+        self.session_no += 1
+        device_id, user_agent, country, city = self._device()
+        source, _, utm, referrer = self._pick(SOURCES, self._source_cum, rnd.random())
+        if source == "whatsapp" and rnd.random() < 0.4:
+            user_agent = rnd.choice(WHATSAPP_USER_AGENTS)
+        product = int(self.products * rnd.random() ** 1.5) + 1
+        product_url = "%s/products/product-%d" % (SHOP_URL, product)
+        price = round(5 + (product * 37 % 200) + 0.99, 2)
+
+        steps = [("page_view", "index", SHOP_URL + "/")]
+        for _ in range(rnd.randint(0, 3)):
+            steps.append(("page_view", "collection", SHOP_URL + "/collections/all"))
+        steps.append(("product_view", "product", product_url))
+        for previous, step in zip(FUNNEL_EVENTS, FUNNEL_EVENTS[1:]):
+            if rnd.random() >= FUNNEL_CONTINUE[previous]:
+                break
+            template = "cart" if step in ("add_to_cart", "cart_view") else "checkout"
+            steps.append((step, template, product_url if step == "add_to_cart" else SHOP_URL + "/cart"))
+
+        ts = self.start_ts + rnd.randint(0, self.days * 86400)
+        started_ts = ts
+        session_id = "s-%d-%d" % (self.seed, self.session_no)
+        events = []
+        for page, (event, template, url) in enumerate(steps, 1):
+            meta = {}
+            if event != "page_view" or template == "product":
+                meta = {"product_id": product, "product_title": "Product %d" % product}
+            if event == "add_to_cart":
+                meta["quantity"] = rnd.randint(1, 3)
+            if event == "purchase":
+                meta.update(value=price, currency="JOD")
+            events.append(({
+                "event": event,
+                "event_id": "%016x" % rnd.getrandbits(64),
+                "session_id": session_id,
+                "device_id": device_id,
+                "url": url,
+                "referrer": referrer if page == 1 else SHOP_URL + "/",
+                "user_agent": user_agent,
+                "traffic_source": source,
+                "utm_source": utm[0],
+                "utm_medium": utm[1],
+                "utm_campaign": utm[2],
+                "utm_content": utm[3],
+                "geo_country": country,
+                "geo_city": city,
+                "session_pages": page,
+                "session_duration_ms": (ts - started_ts) * 1000,
+                "template_name": template,
+                "meta": meta,
+            }, ts))
+            ts += rnd.randint(3, 120)
+        return events
+
+    def events(self, n):
+        produced = 0
+        while produced < n:
+            for item in self.session()[: n - produced]:
+                produced += 1
+                yield item
+
+
+# مواقع url / referrer / user_agent / utm_* بصفوف EVENT_INSERT_SQL (تنحفظ كـ ids)
+STRING_POSITIONS = (3, 4, 5, 7, 8, 9, 10)
+
+
+def seed_events(conn, n, batch=50_000):
+    import main as tracker
+
+    cur = conn.cursor()
+    rows = synthetic_event_rows(n)
+    while True:
+        chunk = [r for _, r in zip(range(batch), rows)]
+        if not chunk:
+            break
+        ids = tracker.string_table.intern_many(
+            cur, (row[i] for row in chunk for i in STRING_POSITIONS)
+        )
+        chunk = [
+            tuple(ids.get(v) if i in STRING_POSITIONS else v for i, v in enumerate(row))
+            for row in chunk
+        ]
+        cur.executemany(tracker.EVENT_INSERT_SQL, chunk)
+        tracker.db.commit(conn)
+    cur.execute("ANALYZE")
+    conn.commit()
+
+
+# النسخة القديمة من stats_funnel (قبل محرك SQL)، للمقارنة بس
+def legacy_funnel(conn, steps=FUNNEL_EVENTS):
+    cur = conn.cursor()
+    placeholders = ",".join(["?"] * len(steps))
+    cur.execute(
+        f"SELECT event, session_id, traffic_source, meta FROM events WHERE event IN ({placeholders})",
+        steps,
+    )
+    rows = cur.fetchall()
+    overall_sets = {step: set() for step in steps}
+    source_sets = {}
+    product_sets = {}
+    for event, session_id, traffic_source, meta_json in rows:
+        if not session_id:
+            continue
+        overall_sets[event].add(session_id)
+        src = traffic_source or "unknown"
+        if src not in source_sets:
+            source_sets[src] = {step: set() for step in steps}
+        source_sets[src][event].add(session_id)
+        try:
+            meta = json.loads(meta_json or "{}")
+        except Exception:
+            meta = {}
+        product_id = meta.get("product_id")
+        product_title = meta.get("product_title") or meta.get("title")
+        if product_id is not None:
+            key = (str(product_id), str(product_title) if product_title else None)
+            if key not in product_sets:
+                product_sets[key] = {step: set() for step in steps}
+            product_sets[key][event].add(session_id)
+
+    def convert_nested(obj):
+        if isinstance(obj, set):
+            return len(obj)
+        if isinstance(obj, dict):
+            return {k: convert_nested(v) for k, v in obj.items()}
+        return obj
+
+    return {
+        "overall": convert_nested(overall_sets),
+        "by_source": {src: convert_nested(s) for src, s in source_sets.items()},
+        "by_product": {
+            f"{pid} | {title if title else 'No Title'}": convert_nested(s)
+            for (pid, title), s in product_sets.items()
+        },
+    }
+
+
+def _timed(fn, *args):
+    import tracemalloc
+
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, round(elapsed, 3), round(peak / 1024 / 1024, 1)
+
+
+# -------- Benchmark: الفانل القديم مقابل محرك SQL --------
+def bench_funnel(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "events.db")
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        started = time.perf_counter()
+        with tracker.db.writer() as conn:
+            seed_events(conn, args.events)
+        seed_s = time.perf_counter() - started
+
+        with tracker.db.reader() as conn:
+            old, old_s, old_mb = _timed(legacy_funnel, conn)
+        # stats_funnel نفسه async على reader_pool؛ نقيس الدالة الأصلية
+        new, new_s, new_mb = _timed(inspect.unwrap(tracker.stats_funnel))
+        tracker.db.close()
+
+    print(json.dumps({
+        "events": args.events,
+        "seed_seconds": round(seed_s, 1),
+        "legacy": {"seconds": old_s, "peak_python_mb": old_mb},
+        "sql_engine": {"seconds": new_s, "peak_python_mb": new_mb},
+        "speedup": round(old_s / new_s, 2) if new_s else None,
+        "same_output": old == new,
+    }, indent=2))
+
+
+# -------- Benchmark: محرك SQLite مقابل Parquet --------
+def bench_engines(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "events.db")
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        with tracker.db.writer() as conn:
+            seed_events(conn, args.events)
+        started = time.perf_counter()
+        with tracker.db.reader() as conn:
+            tracker.run_export(conn)
+        export_s = time.perf_counter() - started
+
+        endpoints = {
+            "funnel": lambda: inspect.unwrap(tracker.stats_funnel)(),
+            "geo": lambda: inspect.unwrap(tracker.stats_geo)(),
+            "device_types": lambda: inspect.unwrap(tracker.stats_device_types)(),
+        }
+        report = {}
+        for name, fn in endpoints.items():
+            tracker.STATS_ENGINE = "sqlite"
+            old, old_s, _ = _timed(fn)
+            tracker.STATS_ENGINE = "parquet"
+            new, new_s, _ = _timed(fn)
+            report[name] = {
+                "sqlite_seconds": old_s,
+                "parquet_seconds": new_s,
+                "speedup": round(old_s / new_s, 2) if new_s else None,
+                "same_output": old == new,
+            }
+        tracker.db.close()
+
+    print(json.dumps({
+        "events": args.events,
+        "export_seconds": round(export_s, 1),
+        "endpoints": report,
+    }, indent=2))
+
+
+# -------- Benchmark: سيريالايز JSON (meta بالاستقبال + رد الفانل) --------
+def bench_json(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "events.db")
+        sys.path.insert(0, HERE)
+        import main as tracker
+        from fastapi.encoders import jsonable_encoder
+        from fastapi.responses import JSONResponse
+
+        rnd = random.Random(5)
+        metas = [realistic_payload(rnd)["meta"] for _ in range(args.events)]
+        steps = tracker.FUNNEL_STEPS
+        funnel = {
+            "overall": {step: rnd.randint(0, 10**6) for step in steps},
+            "by_source": {
+                src: {step: rnd.randint(0, 10**5) for step in steps}
+                for src in ("instagram", "facebook", "whatsapp", "google", "direct", "unknown")
+            },
+            "by_product": {
+                "%d | Product %d" % (i, i): {step: rnd.randint(0, 10**4) for step in steps}
+                for i in range(args.products)
+            },
+        }
+
+        def best(fn, repeat=5):
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - started)
+            return min(times)
+
+        # المسار القديم: json.dumps للـ meta، و FastAPI يمرر الـ dict على jsonable_encoder ثم JSONResponse
+        ingest_old = best(lambda: [json.dumps(m, ensure_ascii=False) for m in metas])
+        ingest_new = best(lambda: [tracker.json_dumps(m) for m in metas])
+        funnel_old = best(lambda: JSONResponse(jsonable_encoder(funnel)).body)
+        funnel_new = best(lambda: tracker.FastJSONResponse(funnel).body)
+        body_bytes = len(tracker.FastJSONResponse(funnel).body)
+
+    print(json.dumps({
+        "backend": "orjson" if tracker._USE_ORJSON else "stdlib",
+        "ingest_meta": {
+            "events": args.events,
+            "stdlib_us_per_event": round(ingest_old / args.events * 1e6, 2),
+            "backend_us_per_event": round(ingest_new / args.events * 1e6, 2),
+            "speedup": round(ingest_old / ingest_new, 1),
+        },
+        "funnel_response": {
+            "products": args.products,
+            "body_bytes": body_bytes,
+            "default_ms": round(funnel_old * 1000, 2),
+            "backend_ms": round(funnel_new * 1000, 2),
+            "speedup": round(funnel_old / funnel_new, 1),
+        },
+    }, indent=2))
+
+
+# -------- Benchmark: حجم الملف (نصوص مكررة vs ids) --------
+USER_AGENTS = [
+    "Mozilla/5.0 (iPhone; CPU iPhone OS %s like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/%s Mobile/15E148 Safari/604.1" % (ios, ver)
+    for ios in ("16_6", "17_0", "17_4_1", "17_5", "18_0") for ver in ("16.6", "17.0", "17.4", "18.0")
+] + [
+    "Mozilla/5.0 (Linux; Android %s; %s) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/%s Mobile Safari/537.36" % (android, model, chrome)
+    for android in ("11", "13", "14") for model in ("SM-A146P", "SM-G991B", "Redmi Note 12", "CPH2481")
+    for chrome in ("124.0.6367.82", "126.0.6478.71")
+] + [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/17.5 Safari/605.1.15",
+]
+REFERRERS = [
+    None,
+    "https://www.google.com/",
+    "https://l.instagram.com/",
+    "https://lm.facebook.com/",
+    "https://api.whatsapp.com/",
+    "https://4pytkr-hy.myshopify.com/",
+    "https://4pytkr-hy.myshopify.com/collections/all",
+]
+CAMPAIGNS = [
+    (None, None, None, None),
+    ("instagram", "social", "summer_sale_2024", "story_1"),
+    ("facebook", "paid", "retargeting_cart", "carousel_a"),
+    ("whatsapp", "broadcast", "eid_offers", None),
+    ("google", "cpc", "brand_search", None),
+]
+
+
+def realistic_payload(rnd):
+    product = rnd.randint(1, 800)
+    utm_source, utm_medium, utm_campaign, utm_content = rnd.choice(CAMPAIGNS)
+    return {
+        "event": rnd.choice(["page_view"] * 4 + FUNNEL_EVENTS),
+        "session_id": "s-%d" % rnd.randint(1, 50_000),
+        "device_id": "d-%d" % rnd.randint(1, 25_000),
+        "url": "https://4pytkr-hy.myshopify.com/products/product-%d?variant=%d"
+        % (product, 40_000_000_000 + product),
+        "referrer": rnd.choice(REFERRERS),
+        "user_agent": rnd.choice(USER_AGENTS),
+        "traffic_source": utm_source or rnd.choice(["direct", "referral"]),
+        "utm_source": utm_source,
+        "utm_medium": utm_medium,
+        "utm_campaign": utm_campaign,
+        "utm_content": utm_content,
+        "geo_country": rnd.choice(["JO", "SA", "AE", "EG"]),
+        "meta": {"product_id": product, "product_title": "Product %d" % product},
+    }
+
+
+def bench_storage(args):
+    """
+    يكتب نفس الأحداث من مسار الكتابة، ويقارن حجم الملف (بعد VACUUM) مع نسخة
+    منه رجعت فيها النصوص لكل صف (شكل الجدول قبل جدول strings).
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "events.db")
+        os.environ["DB_PATH"] = db_path
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        rnd = random.Random(7)
+        now_ts = int(time.time())
+        with tracker.db.writer() as conn:
+            for _ in range(0, args.events, 1000):
+                batch = [(tracker.EventIn(**realistic_payload(rnd)), now_ts) for _ in range(1000)]
+                tracker.apply_batch(conn, batch)
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            interned = os.path.getsize(db_path)
+            interned_table = table_bytes(conn, "events")
+
+            legacy_path = os.path.join(tmp, "legacy.db")
+            conn.execute("VACUUM INTO ?", (legacy_path,))
+        tracker.db.close()
+
+        legacy = tracker.sqlite3.connect(legacy_path)
+        for table, columns in (
+            ("events", tracker.EVENT_STRING_COLUMNS),
+            ("sessions", tracker.SESSION_STRING_COLUMNS),
+        ):
+            legacy.execute(
+                "UPDATE %s SET %s" % (
+                    table,
+                    ", ".join("%s = %s" % (c, tracker.decoded_column(c)) for c in columns),
+                )
+            )
+            legacy.execute("DROP VIEW %s_decoded" % table)
+            for c in columns:
+                legacy.execute("ALTER TABLE %s DROP COLUMN %s_id" % (table, c))
+        legacy.execute("DROP TABLE strings")
+        legacy.commit()
+        legacy.execute("VACUUM")
+        legacy_table = table_bytes(legacy, "events")
+        legacy.close()
+        legacy_bytes = os.path.getsize(legacy_path)
+
+    print(json.dumps({
+        "events": args.events,
+        "inline_strings_bytes": legacy_bytes,
+        "interned_bytes": interned,
+        "bytes_per_event": {
+            "inline_strings": round(legacy_bytes / args.events, 1),
+            "interned": round(interned / args.events, 1),
+        },
+        "ratio": round(legacy_bytes / interned, 2),
+        # جدول events لحاله بدون الفهارس (الفهارس ما فيها هالنصوص أصلاً)
+        "events_table_ratio": (
+            round(legacy_table / interned_table, 2) if legacy_table and interned_table else None
+        ),
+    }, indent=2))
+
+
+# -------- Benchmark: COUNT(DISTINCT) مقابل sketches الـ HyperLogLog --------
+def bench_distinct(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "events.db")
+        os.environ["APPROX_DISTINCT"] = "on"
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        rnd = random.Random(11)
+        now_ts = int(time.time())
+        with tracker.db.writer() as conn:
+            for _ in range(0, args.events, 1000):
+                batch = [
+                    (tracker.EventIn(**realistic_payload(rnd)), now_ts - rnd.randint(0, 86400 * 30))
+                    for _ in range(1000)
+                ]
+                tracker.apply_batch(conn, batch)
+
+        def errors(exact, approx):
+            return [abs(a - e) / e for e, a in zip(exact, approx) if e]
+
+        report = {}
+        exact, exact_s, _ = _timed(inspect.unwrap(tracker.stats_devices))
+        approx, approx_s, _ = _timed(inspect.unwrap(tracker.stats_devices), True)
+        keys = ("total_devices", "purchased_devices")
+        report["devices"] = (exact_s, approx_s, errors([exact[k] for k in keys], [approx[k] for k in keys]))
+
+        exact, exact_s, _ = _timed(inspect.unwrap(tracker.stats_geo))
+        approx, approx_s, _ = _timed(inspect.unwrap(tracker.stats_geo), True)
+        estimates = {r["country"]: r["sessions"] for r in approx["by_country"]}
+        report["geo"] = (
+            exact_s,
+            approx_s,
+            errors([r["sessions"] for r in exact["by_country"]],
+                   [estimates.get(r["country"], 0) for r in exact["by_country"]]),
+        )
+        tracker.db.close()
+
+    print(json.dumps({
+        "events": args.events,
+        "relative_std_error": round(tracker.HLL_STD_ERROR, 4),
+        "endpoints": {
+            name: {
+                "exact_seconds": exact_s,
+                "approx_seconds": approx_s,
+                "speedup": round(exact_s / approx_s, 1) if approx_s else None,
+                "max_relative_error": round(max(errs, default=0.0), 4),
+            }
+            for name, (exact_s, approx_s, errs) in report.items()
+        },
+    }, indent=2))
+
+
+def table_bytes(conn, name):
+    # dbstat مش موجود بكل نسخ SQLite
+    try:
+        return conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,)).fetchone()[0]
+    except Exception:
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[idx], 2)
+
+
+def track_latencies(server, seconds):
+    """عميل واحد يرسل /track ورا بعض ويرجع زمن كل طلب بالـ ms."""
+    conn = server.connection()
+    latencies = []
+    stop_at = time.time() + seconds
+    while time.time() < stop_at:
+        body = json.dumps(sample_event())
+        started = time.perf_counter()
+        conn.request("POST", "/track", body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+    conn.close()
+    return latencies
+
+
+# -------- Benchmark: زمن /track أثناء استعلامات فانل ثقيلة --------
+def bench_contention(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "events.db")
+        os.environ["DB_PATH"] = db_path
+        sys.path.insert(0, HERE)
+        import main as tracker
+
+        with tracker.db.writer() as conn:
+            seed_events(conn, args.events)
+        tracker.db.close()
+
+        # الكاش مطفي عشان كل طلب funnel يوصل للقاعدة فعلاً
+        with LocalServer(env={"INGEST_MODE": args.mode, "STATS_CACHE": "off"}, db_path=db_path) as server:
+            alone = track_latencies(server, args.seconds)
+
+            stop = threading.Event()
+            funnel_calls = [0] * args.stats_clients
+
+            def dashboard(i):
+                conn = server.connection()
+                while not stop.is_set():
+                    conn.request("GET", "/stats/funnel")
+                    conn.getresponse().read()
+                    funnel_calls[i] += 1
+                conn.close()
+
+            threads = [
+                threading.Thread(target=dashboard, args=(i,))
+                for i in range(args.stats_clients)
+            ]
+            for t in threads:
+                t.start()
+            time.sleep(0.5)
+            loaded = track_latencies(server, args.seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            _, status = server.get("/status")
+
+    def summary(latencies):
+        return {
+            "requests": len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+        }
+
+    print(json.dumps({
+        "events_seeded": args.events,
+        "mode": args.mode,
+        "track_alone": summary(alone),
+        "track_with_funnel_load": summary(loaded),
+        "funnel_calls": sum(funnel_calls),
+        "pools": status["pools"],
+    }, indent=2))
+
+
+# -------- أداة التعبئة: events.db بحجم 1M / 10M --------
+def bench_seed(args):
+    """
+    يعبي القاعدة من EventGenerator عبر apply_batch (نفس مسار الكتابة: أجهزة، جلسات،
+    rollups، sketches، strings)، فكل /stats ترجع أرقام متناسقة. الأحداث موزعة على
+    آخر --days يوم بأوقاتها هي.
+    """
+    os.environ["DB_PATH"] = os.path.abspath(args.db)
+    sys.path.insert(0, HERE)
+    import main as tracker
+
+    generator = EventGenerator(seed=args.seed, devices=args.devices, days=args.days)
+    started = time.perf_counter()
+    written = 0
+    batch = []
+    with tracker.db.writer() as conn:
+        for payload, ts in generator.events(args.events):
+            batch.append((tracker.EventIn(**payload), ts))
+            if len(batch) == args.batch_size:
+                tracker.apply_batch(conn, batch)
+                written += len(batch)
+                batch = []
+                if written % (args.batch_size * 100) == 0:
+                    rate = written / (time.perf_counter() - started)
+                    print(f"{written} events, {rate:.0f}/s", file=sys.stderr)
+        if batch:
+            tracker.apply_batch(conn, batch)
+            written += len(batch)
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        totals = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("events", "sessions", "devices")
+        }
+    tracker.db.close()
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        "db": os.path.abspath(args.db),
+        "seed": args.seed,
+        "events_written": written,
+        "seconds": round(elapsed, 1),
+        "events_per_sec": round(written / elapsed, 1),
+        "rows": totals,
+        "db_bytes": os.path.getsize(args.db),
+    }, indent=2))
+
+
+# -------- Benchmark: HTTP (p50/p99 + throughput لـ /track و كل /stats) --------
+def latency_summary(latencies, errors, seconds):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 2),
+        "throughput_rps": round(len(latencies) / seconds, 1) if seconds else None,
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": round(max(latencies), 2) if latencies else None,
+    }
+
+
+def run_clients(server, clients, make_request, seconds=None, requests=None):
+    """
+    clients خيوط، كل واحد باتصال keep-alive. make_request(i) يرجع (method, path, body).
+    يوقف بعد seconds أو لما يخلص requests طلب. يرجع (latencies ms, أخطاء حسب status).
+    """
+    latencies = [[] for _ in range(clients)]
+    errors = [{} for _ in range(clients)]
+    stop_at = time.time() + seconds if seconds else None
+    remaining = [requests if requests is not None else float("inf")]
+    lock = threading.Lock()
+
+    def take():
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def worker(i):
+        conn = server.connection()
+        while (stop_at is None or time.time() < stop_at) and take():
+            method, path, body = make_request(i)
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            started = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            elapsed = (time.perf_counter() - started) * 1000
+            if resp.status == 200:
+                latencies[i].append(elapsed)
+            else:
+                errors[i][resp.status] = errors[i].get(resp.status, 0) + 1
+        conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    merged_errors = {}
+    for e in errors:
+        for status, count in e.items():
+            merged_errors[str(status)] = merged_errors.get(str(status), 0) + count
+    return [x for per in latencies for x in per], merged_errors, time.perf_counter() - started
+
+
+def _git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=HERE, capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_http(args):
+    """
+    uvicorn محلي على نسخة من --db (أو قاعدة فاضية)، وبعدين:
+    /track و /track/batch بـ --clients عميل لمدة --seconds، وكل GET /stats/*
+    بـ --stats-requests طلب على --stats-clients عميل. النتيجة JSON (و --out لملف).
+    """
+    import shutil
+    import sqlite3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "events.db")
+        if args.db:
+            # نسخة عشان /track ما يغير القاعدة المعبّاة
+            source = sqlite3.connect(args.db)
+            source.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            source.close()
+            shutil.copyfile(args.db, db_path)
+
+        env = {
+            "INGEST_MODE": args.mode,
+            "STATS_CACHE": args.stats_cache,
+        }
+        with LocalServer(env=env, db_path=db_path) as server:
+            _, status = server.get("/status")
+            events_before = sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+            generators = [EventGenerator(seed=args.seed * 1000 + i) for i in range(args.clients)]
+            streams = [g.events(10**12) for g in generators]
+
+            def track(i):
+                return "POST", "/track", json.dumps(next(streams[i])[0])
+
+            def track_batch(i):
+                body = [next(streams[i])[0] for _ in range(args.batch_size)]
+                return "POST", "/track/batch", json.dumps(body)
+
+            results = {}
+            for name, make in (("/track", track), ("/track/batch", track_batch)):
+                latencies, errors, seconds = run_clients(server, args.clients, make, seconds=args.seconds)
+                results[name] = latency_summary(latencies, errors, seconds)
+            results["/track/batch"]["events_per_sec"] = round(
+                results["/track/batch"]["throughput_rps"] * args.batch_size, 1
+            )
+
+            # الكاتب يخلص الطابور قبل ما نقيس القراءة
+            while server.get("/status")[1]["ingest"]["queue_depth"]:
+                time.sleep(0.05)
+
+            _, openapi = server.get("/openapi.json")
+            stats_paths = sorted(
+                path for path, ops in openapi["paths"].items()
+                if path.startswith("/stats/") and "get" in ops and path != "/stats/stream"
+            )
+            for path in stats_paths:
+                # أول طلب لحاله (كاش SQLite بارد / كاش /stats فاضي)
+                cold, _, _ = run_clients(server, 1, lambda i: ("GET", path, None), requests=1)
+                latencies, errors, seconds = run_clients(
+                    server, args.stats_clients, lambda i: ("GET", path, None), requests=args.stats_requests
+                )
+                results[path] = latency_summary(latencies, errors, seconds)
+                results[path]["cold_ms"] = round(cold[0], 2) if cold else None
+
+    report = {
+        "meta": {
+            "version": _git_version(),
+            "timestamp": int(time.time()),
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+            "cpus": os.cpu_count(),
+            "events_in_db": events_before,
+            "config": {k: v for k, v in vars(args).items() if k != "func"},
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+def bench_compare(args):
+    """يقارن ملفين من bench.py http: نسبة التغير بـ p50 و p99 و throughput لكل endpoint."""
+    with open(args.old) as f:
+        old = json.load(f)["results"]
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+
+    def change(a, b):
+        if a in (None, 0) or b is None:
+            return None
+        return round((b - a) / a * 100, 1)
+
+    report = {}
+    for path in sorted(set(old) & set(new)):
+        report[path] = {
+            metric + "_change_pct": change(old[path].get(metric), new[path].get(metric))
+            for metric in ("p50_ms", "p99_ms", "throughput_rps")
+        }
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("ingest", help="compare /track throughput per ingest mode")
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--modes", nargs="+", default=["sync", "queue"])
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("writer", help="per-event commit vs batched writer, no HTTP")
+    p.add_argument("--events", type=int, default=5000)
+    p.add_argument("--batch-size", type=int, default=500)
+    p.set_defaults(func=bench_writer)
+
+    p = sub.add_parser("funnel", help="legacy Python funnel vs SQL funnel engine")
+    p.add_argument("--events", type=int, default=5_000_000)
+    p.set_defaults(func=bench_funnel)
+
+    p = sub.add_parser("engines", help="SQLite vs Parquet stats engine (needs pyarrow)")
+    p.add_argument("--events", type=int, default=500_000)
+    p.set_defaults(func=bench_engines)
+
+    p = sub.add_parser("json", help="meta + funnel response serialization, stdlib vs JSON_BACKEND")
+    p.add_argument("--events", type=int, default=100_000)
+    p.add_argument("--products", type=int, default=5_000)
+    p.set_defaults(func=bench_json)
+
+    p = sub.add_parser("storage", help="database size with repeated strings inline vs interned")
+    p.add_argument("--events", type=int, default=200_000)
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser("seed", help="fill a database with realistic events through the write path")
+    p.add_argument("--db", default="events.db")
+    p.add_argument("--events", type=int, default=1_000_000)
+    p.add_argument("--days", type=int, default=30)
+    p.add_argument("--devices", type=int, default=200_000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--batch-size", type=int, default=5000)
+    p.set_defaults(func=bench_seed)
+
+    p = sub.add_parser("http", help="p50/p99 + throughput for /track and every GET /stats/* (JSON)")
+    p.add_argument("--db", help="seeded database to copy (default: empty)")
+    p.add_argument("--mode", choices=["sync", "queue"], default="queue")
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--batch-size", type=int, default=50)
+    p.add_argument("--stats-requests", type=int, default=200)
+    p.add_argument("--stats-clients", type=int, default=8)
+    p.add_argument("--stats-cache", choices=["on", "off"], default="off")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="also write the JSON report to this file")
+    p.set_defaults(func=bench_http)
+
+    p = sub.add_parser("compare", help="percent change between two 'http' reports")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.set_defaults(func=bench_compare)
+
+    p = sub.add_parser("distinct", help="exact COUNT(DISTINCT) vs HyperLogLog estimates")
+    p.add_argument("--events", type=int, default=200_000)
+    p.set_defaults(func=bench_distinct)
+
+    p = sub.add_parser("contention", help="/track latency while /stats/funnel is hammered")
+    p.add_argument("--events", type=int, default=300_000)
+    p.add_argument("--seconds", type=float, default=5)
+    p.add_argument("--stats-clients", type=int, default=8)
+    p.add_argument("--mode", default="sync", choices=["sync", "queue"])
+    p.set_defaults(func=bench_contention)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,493 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+from typing import Annotated, NamedTuple, Optional, Dict, Any, List, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import asyncio
+import bisect
+import calendar
+import csv
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import logging
+import math
+import os
+import queue
+import shutil
 import sqlite3
+import threading
 import time
 import json
 import re
+import urllib.parse
+import zlib
 
-DB_PATH = "events.db"
+try:
+    # اختياري: بس للتصدير العمودي و STATS_ENGINE=parquet (pip install pyarrow)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
-app = FastAPI(title="Shopify Tracking Server (Captain Version v2 + Geo)")
+try:
+    # اختياري: JSON أسرع للـ meta وردود /stats (pip install orjson)
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_PATH = os.getenv("DB_PATH", "events.db")
+
+logger = logging.getLogger("tracker")
+
+# -------- إعدادات الاستقبال (Ingestion) --------
+# sync  : كل طلب /track يكتب ويعمل commit بنفسه (السلوك القديم)
+# queue : /track يحط الحدث في طابور محدود ويرجع فوراً، وخيط كاتب واحد يكتب دفعات
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "200"))
+# reject : يرجع 429 فوراً لو الطابور مليان
+# block  : ينتظر لحد INGEST_BLOCK_TIMEOUT_MS وبعدين 429
+INGEST_BACKPRESSURE = os.getenv("INGEST_BACKPRESSURE", "reject")
+INGEST_BLOCK_TIMEOUT_MS = int(os.getenv("INGEST_BLOCK_TIMEOUT_MS", "1000"))
+# أقصى عدد أحداث في طلب /track/batch واحد
+TRACK_BATCH_MAX_EVENTS = int(os.getenv("TRACK_BATCH_MAX_EVENTS", "500"))
+
+# -------- JSON --------
+# auto   : orjson لو منزّل، وإلا json العادي
+# orjson : لازم orjson
+# stdlib : json العادي دايماً
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+# -------- القياس (/metrics بصيغة Prometheus) --------
+# on: هستوغرامات لمراحل الكتابة، لكل استعلام /stats، ولكل طلب HTTP (تنقرأ من /metrics)
+METRICS = os.getenv("METRICS", "on")
+# استعلام /stats أبطأ من هيك (ms) ينكتب بالـ log مع الـ SQL. 0 = مطفي
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+
+# -------- إعدادات SQLite و pool الاتصالات --------
+# كل الاتصالات تفتح بوضع WAL: القرّاء (الداشبورد) ما يوقفوا الكاتب (/track) والعكس
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_READER_TIMEOUT_S = float(os.getenv("DB_READER_TIMEOUT_S", "30"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # سالب = KiB
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY").upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# checkpoint دوري للـ WAL، و TRUNCATE لو الملف كبر أكثر من الحد
+WAL_CHECKPOINT_INTERVAL_S = float(os.getenv("WAL_CHECKPOINT_INTERVAL_S", "30"))
+WAL_MAX_BYTES = int(os.getenv("WAL_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# -------- خيوط التنفيذ (writer / readers) --------
+# /track و /stats/* ما يشتركوا بنفس threadpool: الكتابة على خيط واحد مخصص،
+# والإحصائيات على pool مستقل، فاستعلام داشبورد ثقيل ما يأخر الاستقبال.
+WRITER_MAX_PENDING = int(os.getenv("WRITER_MAX_PENDING", "1000"))
+STATS_THREADS = int(os.getenv("STATS_THREADS", str(DB_READERS)))
+STATS_MAX_PENDING = int(os.getenv("STATS_MAX_PENDING", "100"))
+
+# -------- كاش نتائج /stats --------
+# النتيجة تضل صالحة لحد STATS_CACHE_TTL_<ENDPOINT> ثانية، أو لحد ما يتغير آخر events.id
+# انكتب (بحد أقصى STATS_CACHE_MAX_AGE_S)، فالداشبورد الساكت ما يعيد الحساب أبداً.
+# بعد الـ TTL بـ STATS_CACHE_STALE_S ثانية ترجع النتيجة القديمة فوراً وتنحسب من جديد بالخلفية.
+STATS_CACHE = os.getenv("STATS_CACHE", "on")
+STATS_CACHE_TTL_S = {
+    name: float(os.getenv(f"STATS_CACHE_TTL_{name.upper()}", str(default)))
+    for name, default in (
+        ("overview", 2),
+        ("funnel", 10),
+        ("geo", 10),
+        ("device_types", 30),
+        ("events_daily", 30),
+        ("whatsapp", 10),
+        ("sessions", 10),
+    )
+}
+STATS_CACHE_STALE_S = float(os.getenv("STATS_CACHE_STALE_S", "30"))
+STATS_CACHE_MAX_AGE_S = float(os.getenv("STATS_CACHE_MAX_AGE_S", "300"))
+STATS_CACHE_MAX_ENTRIES = int(os.getenv("STATS_CACHE_MAX_ENTRIES", "256"))
+
+# -------- كاش تحليل user_agent --------
+UA_CACHE_SIZE = int(os.getenv("UA_CACHE_SIZE", "4096"))
+
+# -------- كاش الأجهزة والجلسات النشطة --------
+# آخر حالة انكتبت لكل جهاز/جلسة، عشان ما نكتب إلا لما يتغير شي مهم.
+# last_seen ما ينكتب أكثر من مرة كل LAST_SEEN_RESOLUTION_S ثانية لنفس الجهاز/الجلسة (0 = كل حدث).
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "200000"))
+ENTITY_CACHE_TTL_S = float(os.getenv("ENTITY_CACHE_TTL_S", "1800"))
+LAST_SEEN_RESOLUTION_S = int(os.getenv("LAST_SEEN_RESOLUTION_S", "60"))
+
+# -------- منع تكرار الأحداث (event_id من الكلاينت) --------
+# آخر DEDUPE_WINDOW_SIZE event_id انكتبوا بالذاكرة: إعادة الإرسال ترجع ok بدون أي SQL.
+# اللي مش بالنافذة ينفحص بالفهرس الفريد على events.event_id.
+# النطاق: النافذة + events الحي بس. الأجزاء المختومة (أشهر قديمة) ما إلها فهرس فريد وما بتنفحص،
+# فحدث بينعاد إرساله بعد ما شهره انختم وطلع من النافذة بينكتب مرة ثانية. إعادة الإرسال
+# من الكلاينت بتكون خلال دقايق أو ساعات، وفحص كل الأجزاء بكل دفعة ما بيستاهل.
+DEDUPE_WINDOW_SIZE = int(os.getenv("DEDUPE_WINDOW_SIZE", "200000"))
+EVENT_ID_MAX_LENGTH = 128
+
+# -------- كاش النصوص المتكررة (user_agent / url / referrer / utm_*) --------
+STRINGS_CACHE_SIZE = int(os.getenv("STRINGS_CACHE_SIZE", "100000"))
+
+# -------- العدّ التقريبي للجلسات والأجهزة (HyperLogLog) --------
+# on  : sketches لكل يوم × (الكل / المصدر / الدولة / المدينة / نوع الحدث) تتحدث مع كل دفعة،
+#       و /stats/devices و /stats/geo يقبلوا approx=true
+# off : ما في sketches (والجدول ينفضى)
+APPROX_DISTINCT = os.getenv("APPROX_DISTINCT", "on")
+# 2^HLL_PRECISION register لكل sketch؛ الخطأ المعياري 1.04/sqrt(2^p) (12 → 1.6%)
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+# عدد الـ sketches المحفوظة بالذاكرة عشان الكاتب ما يقرأها من القاعدة كل دفعة
+HLL_CACHE_SKETCHES = int(os.getenv("HLL_CACHE_SKETCHES", "4096"))
+
+# -------- عدادات realtime بالذاكرة --------
+# /stats/realtime يجاوب من الذاكرة لأي window_minutes لحد هالحد (0 = دايماً من SQLite)
+REALTIME_MAX_WINDOW_MINUTES = int(os.getenv("REALTIME_MAX_WINDOW_MINUTES", "60"))
+
+# -------- البث المباشر للإحصائيات (SSE على /stats/stream) --------
+# كل STREAM_INTERVAL_MS تنبعث رسالة وحدة بفروقات الأعداد لكل المشتركين
+STREAM_INTERVAL_MS = int(os.getenv("STREAM_INTERVAL_MS", "1000"))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", "1000"))
+# مشترك بطيء تراكم عنده أكثر من هيك رسالة ينقطع (والمتصفح يعيد الاتصال ويستلم snapshot)
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+STREAM_HEARTBEAT_S = float(os.getenv("STREAM_HEARTBEAT_S", "15"))
+
+# -------- تقسيم الأحداث حسب الشهر (partitions) --------
+# off   : كل الأحداث بجدول events واحد (السلوك القديم)
+# month : كل شهر مكتمل ينتقل لملف partitions/events_YYYY_MM.db، و events يضل فيه الشهر الحالي بس
+EVENT_PARTITIONING = os.getenv("EVENT_PARTITIONING", "off")
+PARTITIONS_DIR = os.getenv(
+    "PARTITIONS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "partitions"),
+)
+PARTITION_CHECK_INTERVAL_S = float(os.getenv("PARTITION_CHECK_INTERVAL_S", "3600"))
+# كم صف ينمسح من events بكل مسكة للكاتب وقت تفريغ شهر انختم
+PARTITION_DELETE_CHUNK = int(os.getenv("PARTITION_DELETE_CHUNK", "5000"))
+# 0 = نحتفظ بكل الأشهر. غير هيك: الأشهر الأقدم من RETENTION_MONTHS شهر كامل
+# تنضغط (archive → ARCHIVE_DIR/*.db.gz) أو تنمسح (drop)
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "0"))
+RETENTION_ACTION = os.getenv("RETENTION_ACTION", "archive")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(PARTITIONS_DIR, "archive"))
+
+# -------- التصدير العمودي (Parquet) --------
+# off     : ما في تصدير
+# parquet : خيط خلفي يصدّر events (ملفات مقسمة باليوم حسب آخر id انصدّر) ولقطات
+#           sessions / devices لـ EXPORT_DIR، للتحليل بعيد عن القاعدة الحية
+COLUMNAR_EXPORT = os.getenv("COLUMNAR_EXPORT", "off")
+EXPORT_DIR = os.getenv(
+    "EXPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "export"),
+)
+EXPORT_INTERVAL_S = float(os.getenv("EXPORT_INTERVAL_S", "60"))
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "100000"))
+# sessions و devices تتعدل (last_seen)، فتنكتب لقطة كاملة كل EXPORT_SNAPSHOT_INTERVAL_S
+EXPORT_SNAPSHOT_INTERVAL_S = float(os.getenv("EXPORT_SNAPSHOT_INTERVAL_S", "900"))
+# -------- تصدير الأحداث الخام (GET /events/export) --------
+# صفوف كل قراءة: كل دفعة transaction قراءة قصيرة لحالها، فالذاكرة ثابتة والكاتب والـ checkpoint ما يستنوا
+EVENTS_EXPORT_CHUNK_ROWS = int(os.getenv("EVENTS_EXPORT_CHUNK_ROWS", "5000"))
+
+# -------- تجميع الجلسات بالخلفية (sessions materializer) --------
+# on  : خيط خلفي يقرأ الأحداث الجديدة حسب id ويحدّث بجدول sessions عدد الصفحات والمدة
+#       وصفحة الدخول والخروج وأبعد خطوة بالفانل والشراء، فـ /stats/sessions يقرأ sessions لحاله
+# off : ما في تجميع (الأعمدة تضل على آخر قيمة انحسبت)
+SESSION_MATERIALIZER = os.getenv("SESSION_MATERIALIZER", "on")
+SESSION_MATERIALIZE_INTERVAL_S = float(os.getenv("SESSION_MATERIALIZE_INTERVAL_S", "5"))
+# أحداث كل دفعة: قراءة وحدة + UPDATE لكل جلسة بمسكة كاتب وحدة
+SESSION_MATERIALIZE_BATCH = int(os.getenv("SESSION_MATERIALIZE_BATCH", "5000"))
+
+# sqlite  : كل /stats من SQLite (الافتراضي)
+# parquet : /stats/funnel و geo و device-types من ملفات التصدير بـ pyarrow.compute
+#           (الأرقام متأخرة لحد آخر جولة تصدير)
+STATS_ENGINE = os.getenv("STATS_ENGINE", "sqlite")
+
+if JSON_BACKEND not in ("auto", "orjson", "stdlib"):
+    raise ValueError(f"invalid JSON_BACKEND: {JSON_BACKEND}")
+if JSON_BACKEND == "orjson" and orjson is None:
+    raise RuntimeError("JSON_BACKEND=orjson needs orjson (pip install orjson)")
+if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"invalid SQLITE_SYNCHRONOUS: {SQLITE_SYNCHRONOUS}")
+if SQLITE_TEMP_STORE not in ("DEFAULT", "FILE", "MEMORY"):
+    raise ValueError(f"invalid SQLITE_TEMP_STORE: {SQLITE_TEMP_STORE}")
+if STATS_CACHE not in ("on", "off"):
+    raise ValueError(f"invalid STATS_CACHE: {STATS_CACHE}")
+if APPROX_DISTINCT not in ("on", "off"):
+    raise ValueError(f"invalid APPROX_DISTINCT: {APPROX_DISTINCT}")
+if REALTIME_MAX_WINDOW_MINUTES < 0:
+    raise ValueError(f"invalid REALTIME_MAX_WINDOW_MINUTES: {REALTIME_MAX_WINDOW_MINUTES}")
+if not 4 <= HLL_PRECISION <= 16:
+    raise ValueError(f"invalid HLL_PRECISION: {HLL_PRECISION}")
+if EVENT_PARTITIONING not in ("off", "month"):
+    raise ValueError(f"invalid EVENT_PARTITIONING: {EVENT_PARTITIONING}")
+if RETENTION_ACTION not in ("archive", "drop"):
+    raise ValueError(f"invalid RETENTION_ACTION: {RETENTION_ACTION}")
+if COLUMNAR_EXPORT not in ("off", "parquet"):
+    raise ValueError(f"invalid COLUMNAR_EXPORT: {COLUMNAR_EXPORT}")
+if STATS_ENGINE not in ("sqlite", "parquet"):
+    raise ValueError(f"invalid STATS_ENGINE: {STATS_ENGINE}")
+if SESSION_MATERIALIZER not in ("on", "off"):
+    raise ValueError(f"invalid SESSION_MATERIALIZER: {SESSION_MATERIALIZER}")
+if pa is None and "parquet" in (COLUMNAR_EXPORT, STATS_ENGINE):
+    raise RuntimeError("COLUMNAR_EXPORT / STATS_ENGINE=parquet need pyarrow (pip install pyarrow)")
+
+
+# -------- JSON (orjson أو json) --------
+# orjson يرفض أرقام أكبر من 64 بت (والمفاتيح اللي مش نص)؛ بهالحالات نرجع لـ json.
+# القراءة تضل بـ json: orjson.loads يحوّل الأرقام الكبيرة لـ float بدون ما يقول
+_USE_ORJSON = orjson is not None and JSON_BACKEND != "stdlib"
+
+
+def json_dumps(obj) -> str:
+    """للتخزين (meta) ورسائل البث."""
+    if _USE_ORJSON:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def json_dumps_bytes(obj) -> bytes:
+    """للردود: نفس مخرجات JSONResponse تبع Starlette."""
+    if _USE_ORJSON:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json_dumps_bytes(content)
+
+
+# -------- القياس: هستوغرامات وعدادات بصيغة Prometheus --------
+# بدون prometheus_client: observe = bisect + lock، و /metrics يكتب النص وقت القراءة بس.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# SQLite ينادي الـ progress handler كل هالعدد من تعليمات الـ VM (تقريب لكمية الصفوف الممسوحة)
+QUERY_PROGRESS_STEPS = 1000
+
+_metrics: List[Any] = []
+
+
+def _label_pairs(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram:
+    """توزيع بحدود ثابتة؛ لكل مجموعة labels عدادات [لكل bucket..., +Inf, sum]."""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        if METRICS != "on":
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def time(self, *labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                le = _label_pairs(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_pairs(self.labels, labels)} {values[-1]:.6f}")
+            lines.append(f"{self.name}_count{_label_pairs(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, value: float, *labels):
+        if METRICS != "on":
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_label_pairs(self.labels, labels)} {value}")
+        return lines
+
+
+http_request_seconds = Histogram(
+    "tracker_http_request_duration_seconds", "Request latency by route.", ("path",)
+)
+http_requests = Counter(
+    "tracker_http_requests_total", "Requests by route and status code.", ("path", "status")
+)
+ingest_stage_seconds = Histogram(
+    "tracker_ingest_stage_seconds",
+    "Time per write-path stage, per batch (validate is per event).",
+    ("stage",),
+)
+query_seconds = Histogram(
+    "tracker_query_duration_seconds", "Stats query time (execute + fetch).", ("query",)
+)
+query_rows = Counter(
+    "tracker_query_rows_returned_total", "Rows returned by stats queries.", ("query",)
+)
+query_vm_steps = Counter(
+    "tracker_query_vm_steps_total",
+    f"SQLite VM instructions run by stats queries (granularity {QUERY_PROGRESS_STEPS}), "
+    "a proxy for rows scanned.",
+    ("query",),
+)
+slow_queries = Counter(
+    "tracker_slow_queries_total", "Stats queries slower than SLOW_QUERY_MS.", ("query",)
+)
+db_writer_wait_seconds = Histogram(
+    "tracker_db_writer_lock_wait_seconds", "Time waiting for the single writer connection."
+)
+db_locked_errors = Counter(
+    "tracker_db_locked_errors_total", "'database is locked' / busy errors.", ("conn",)
+)
+
+
+def count_locked(exc: BaseException, conn: str):
+    if isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc)):
+        db_locked_errors.inc(1, conn)
+
+
+# عدّاد تعليمات الـ VM للاستعلام الحالي على هالخيط (كل اتصال قراءة بخيط واحد بنفس الوقت)
+_query_steps = threading.local()
+
+
+def _count_vm_steps() -> int:
+    _query_steps.n = getattr(_query_steps, "n", 0) + 1
+    return 0  # 0 = كمّل الاستعلام
+
+
+def run_query(cur, name: str, sql: str, params=()) -> List[tuple]:
+    """
+    execute + fetchall مع القياس تحت اسم name: الزمن، الصفوف الراجعة، وتعليمات الـ VM.
+    لو أبطأ من SLOW_QUERY_MS ينكتب بالـ log مع الـ SQL.
+    """
+    if METRICS != "on" and not SLOW_QUERY_MS:
+        cur.execute(sql, params)
+        return cur.fetchall()
+    _query_steps.n = 0
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    elapsed = time.perf_counter() - started
+    steps = _query_steps.n * QUERY_PROGRESS_STEPS
+    query_seconds.observe(elapsed, name)
+    query_rows.inc(len(rows), name)
+    query_vm_steps.inc(steps, name)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(1, name)
+        logger.warning(
+            "slow query %s: %.1f ms, %d rows, ~%d vm steps: %s",
+            name, elapsed * 1000, len(rows), steps, " ".join(sql.split()),
+        )
+    return rows
+
+
+class MetricsMiddleware:
+    """ASGI خام (أخف من BaseHTTPMiddleware): زمن كل طلب وعدده حسب المسار والـ status."""
+
+    def __init__(self, app):
+        self.app = app
+        self._paths: Optional[set] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or METRICS != "on":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            if self._paths is None:
+                self._paths = {route.path for route in app.routes}
+            # مسارات مش معروفة تتجمع تحت other عشان الـ labels ما تكبر بلا حد
+            path = scope["path"] if scope["path"] in self._paths else "other"
+            http_requests.inc(1, path, status[0])
+            # /stats/stream و /events/export زمنهم حسب طول الستريم، مش latency
+            if path not in ("/stats/stream", "/events/export"):
+                http_request_seconds.observe(time.perf_counter() - started, path)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_background_workers()
+    try:
+        yield
+    finally:
+        stop_background_workers()
+
+
+app = FastAPI(
+    title="Shopify Tracking Server (Captain Version v2 + Geo)",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
 
 # ------- CORS -------
 origins = [
@@ -25,15 +503,404 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 # -------- دوال مساعدة لقاعدة البيانات --------
-def get_conn():
-    return sqlite3.connect(DB_PATH)
+def open_conn(readonly: bool = False, trace=None) -> sqlite3.Connection:
+    """يفتح اتصال SQLite بإعدادات الـ pragmas. الاتصال ممكن ينتقل بين الخيوط (بس مش بنفس الوقت)."""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        # عشان ATTACH يقبل file:...?mode=ro لملفات الـ partitions
+        uri=True,
+    )
+    if not readonly:
+        # journal_mode محفوظ في ملف القاعدة، فيكفي الكاتب يثبته
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA journal_size_limit={WAL_MAX_BYTES}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    if readonly:
+        conn.execute("PRAGMA query_only=1")
+        if METRICS == "on":
+            conn.set_progress_handler(_count_vm_steps, QUERY_PROGRESS_STEPS)
+    if trace is not None:
+        conn.set_trace_callback(trace)
+    return conn
+
+
+class ConnectionPool:
+    """
+    اتصال كاتب واحد (محمي بـ lock) و DB_READERS اتصالات قراءة تنفتح عند الحاجة.
+    الـ endpoints تستخدم `with db.reader() as conn` و `with db.writer() as conn`.
+    """
+
+    def __init__(self, max_readers: int, trace=None):
+        self.max_readers = max_readers
+        self.trace = trace
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.Lock()
+        self._idle_readers: "queue.LifoQueue" = queue.LifoQueue()
+        self._readers_open = 0
+        self._readers_lock = threading.Lock()
+        self.checkpoints = {"runs": 0, "truncates": 0, "busy": 0, "last_wal_bytes": 0}
+        self._after_commit: List[Any] = []
+
+    @contextmanager
+    def writer(self):
+        started = time.perf_counter()
+        with self._writer_lock:
+            db_writer_wait_seconds.observe(time.perf_counter() - started)
+            if self._writer is None:
+                self._writer = open_conn()
+            try:
+                yield self._writer
+            except sqlite3.Error as e:
+                count_locked(e, "writer")
+                raise
+
+    # كاشات الذاكرة (مثل آخر UA لكل جهاز) ما تتحدث إلا بعد ما الكتابة تنحفظ فعلاً.
+    # الدوال هذه تنستدعى بس وإحنا ماسكين الكاتب.
+    def on_commit(self, fn):
+        self._after_commit.append(fn)
+
+    def commit(self, conn: sqlite3.Connection):
+        with ingest_stage_seconds.time("commit"):
+            conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for fn in callbacks:
+            # الـ transaction صار على القرص: خطأ بتحديث كاش بالذاكرة ما لازم يوصل للي نادى،
+            # وإلا apply_batch بيعيد كتابة الدفعة حدث حدث (تكرار للأحداث بدون event_id)
+            try:
+                fn()
+            except Exception:
+                logger.exception("on_commit callback failed")
+
+    def rollback(self, conn: sqlite3.Connection):
+        conn.rollback()
+        self._after_commit = []
+
+    @contextmanager
+    def reader(self):
+        conn = self._checkout_reader()
+        broken = False
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            broken = True
+            count_locked(e, "reader")
+            raise
+        finally:
+            if broken:
+                # اتصال ممكن يكون بحالة غريبة، نسكره وما نرجعه للـ pool
+                conn.close()
+                with self._readers_lock:
+                    self._readers_open -= 1
+            else:
+                self._idle_readers.put(conn)
+
+    def _checkout_reader(self) -> sqlite3.Connection:
+        try:
+            return self._idle_readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if self._readers_open < self.max_readers:
+                self._readers_open += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return open_conn(readonly=True, trace=self.trace)
+            except Exception:
+                with self._readers_lock:
+                    self._readers_open -= 1
+                raise
+        try:
+            return self._idle_readers.get(timeout=DB_READER_TIMEOUT_S)
+        except queue.Empty:
+            raise HTTPException(status_code=503, detail="database readers busy")
+
+    def wal_size(self) -> int:
+        try:
+            return os.path.getsize(DB_PATH + "-wal")
+        except OSError:
+            return 0
+
+    def checkpoint(self, conn: sqlite3.Connection):
+        """
+        PASSIVE ما يوقف أحد؛ لو الـ WAL تعدى WAL_MAX_BYTES نعمل TRUNCATE
+        (ينتظر القرّاء الحاليين لحد busy_timeout) عشان الملف يرجع صفر.
+        """
+        wal_bytes = self.wal_size()
+        mode = "TRUNCATE" if wal_bytes > WAL_MAX_BYTES else "PASSIVE"
+        busy, _, _ = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        self.checkpoints["runs"] += 1
+        self.checkpoints["busy"] += busy
+        if mode == "TRUNCATE" and not busy:
+            self.checkpoints["truncates"] += 1
+        self.checkpoints["last_wal_bytes"] = wal_bytes
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "readers_max": self.max_readers,
+            "readers_open": self._readers_open,
+            "readers_idle": self._idle_readers.qsize(),
+            "writer_busy": self._writer_lock.locked(),
+            "wal_bytes": self.wal_size(),
+            "checkpoints": dict(self.checkpoints),
+        }
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._idle_readers.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._readers_lock:
+                self._readers_open -= 1
+
+
+db = ConnectionPool(DB_READERS)
+
+
+class WorkerPool:
+    """
+    ThreadPoolExecutor بحد أقصى للطلبات المنتظرة وعدادات (انتظار، تنفيذ، مرفوض).
+    الـ handlers الـ async تستدعي `await pool.run(fn, ...)`.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_pending: int, reject_status: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.reject_status = reject_status
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.active = 0
+        self.counters = {
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "run_ms_total": 0.0,
+        }
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.in_flight >= self.max_workers + self.max_pending:
+                self.counters["rejected"] += 1
+                raise HTTPException(
+                    status_code=self.reject_status,
+                    detail=f"{self.name} pool busy",
+                    headers={"Retry-After": "1"},
+                )
+            self.in_flight += 1
+        submitted = time.perf_counter()
+
+        def call():
+            started = time.perf_counter()
+            wait_ms = (started - submitted) * 1000
+            with self._lock:
+                self.active += 1
+                self.counters["wait_ms_total"] += wait_ms
+                self.counters["wait_ms_max"] = max(self.counters["wait_ms_max"], wait_ms)
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.counters["completed" if ok else "failed"] += 1
+                    self.counters["run_ms_total"] += (time.perf_counter() - started) * 1000
+
+        future = self._executor.submit(call)
+
+        def done(_):
+            with self._lock:
+                self.in_flight -= 1
+
+        # لو الطلب انلغى قبل ما يبدأ، الـ callback برضه ينادى فالعداد ما يعلق
+        future.add_done_callback(done)
+        return await asyncio.wrap_future(future)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {k: round(v, 2) for k, v in self.counters.items()}
+            finished = counters["completed"] + counters["failed"]
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "active": self.active,
+                "queued": self.in_flight - self.active,
+                **counters,
+                "wait_ms_avg": round(counters["wait_ms_total"] / finished, 2) if finished else 0.0,
+                "run_ms_avg": round(counters["run_ms_total"] / finished, 2) if finished else 0.0,
+            }
+
+
+# خيط كتابة واحد (SQLite يقبل كاتب واحد أصلاً)، و pool قراءة بحجم اتصالات القراءة
+writer_pool = WorkerPool("writer", 1, WRITER_MAX_PENDING, reject_status=429)
+reader_pool = WorkerPool("reader", STATS_THREADS, STATS_MAX_PENDING, reject_status=503)
+
+
+def run_on_readers(fn):
+    """
+    يحوّل endpoint عادي (def) لـ async ينفَّذ على reader_pool بدل threadpool الافتراضي.
+    النتيجة تتحول لـ JSON على نفس خيط القراءة (مش على الـ event loop)، والرد الجاهز
+    هو اللي ينحفظ بكاش /stats، فالـ hit ما يعيد السيريالايز.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await reader_pool.run(_render_json, fn, *args, **kwargs)
+
+    return wrapper
+
+
+def _render_json(fn, *args, **kwargs) -> FastJSONResponse:
+    return FastJSONResponse(fn(*args, **kwargs))
+
+
+# -------- كاش نتائج /stats (TTL + تجميع الطلبات المتزامنة + stale-while-revalidate) --------
+class StatsCache:
+    """
+    key → (وقت بداية الحساب، الـ watermark وقتها، النتيجة)، LRU بحد STATS_CACHE_MAX_ENTRIES.
+    الـ watermark آخر events.id، أو دالة الـ endpoint من watch (زي تقدم تجميع الجلسات).
+    كل شي يصير على خيط الـ event loop، فما يحتاج lock؛ الكاتب بس يحدّث watermark.
+    الحساب نفسه task مستقل: الطلبات المتزامنة لنفس المفتاح تنتظر نفس الـ task،
+    وقطع اتصال أول طالب ما يلغي الحساب على الباقين.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # آخر events.id انحفظ (commit). القيمة الابتدائية ما بتفرق، المهم إنها تتغير مع كل كتابة
+        self.watermark = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        # endpoints بتقرأ من إشي غير الأحداث مباشرة: اسم → دالة ترجع watermark خاص فيهم
+        self._sources: Dict[str, Any] = {}
+
+    def advance(self, events_id: int):
+        self.watermark = events_id
+
+    def watch(self, name: str, source):
+        self._sources[name] = source
+
+    def _watermark(self, name: str):
+        source = self._sources.get(name)
+        return self.watermark if source is None else source()
+
+    def _bump(self, name: str, key: str):
+        counters = self.counters.setdefault(
+            name, {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0}
+        )
+        counters[key] += 1
+
+    async def get(self, name: str, key: tuple, compute):
+        entry = self._entries.get(key)
+        if entry is not None:
+            computed_at, watermark, value = entry
+            age = time.monotonic() - computed_at
+            ttl = STATS_CACHE_TTL_S[name]
+            if age < ttl or (watermark == self._watermark(name) and age < STATS_CACHE_MAX_AGE_S):
+                self._entries.move_to_end(key)
+                self._bump(name, "hits")
+                return value
+            if age < ttl + STATS_CACHE_STALE_S:
+                if key not in self._inflight:
+                    self._bump(name, "refreshes")
+                    self._start(name, key, compute)
+                self._bump(name, "stale_hits")
+                return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._bump(name, "coalesced")
+        else:
+            self._bump(name, "misses")
+            task = self._start(name, key, compute)
+        return await asyncio.shield(task)
+
+    def _start(self, name: str, key: tuple, compute) -> "asyncio.Task":
+        task = asyncio.get_running_loop().create_task(self._fill(name, key, compute))
+        # refresh بالخلفية ممكن يفشل وما حدا ينتظره
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._inflight[key] = task
+        return task
+
+    async def _fill(self, name: str, key: tuple, compute):
+        started = time.monotonic()
+        watermark = self._watermark(name)
+        try:
+            value = await compute()
+        except Exception:
+            self._bump(name, "errors")
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._entries[key] = (started, watermark, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": STATS_CACHE,
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "watermark": self.watermark,
+            "ttl_s": STATS_CACHE_TTL_S,
+            "endpoints": {name: dict(c) for name, c in self.counters.items()},
+        }
+
+
+stats_cache = StatsCache(STATS_CACHE_MAX_ENTRIES)
+
+
+def cached_stats(name: str, watermark=None):
+    """
+    فوق run_on_readers: الـ hit يرجع من الـ event loop بدون ما ياخذ مكان بـ reader_pool.
+    watermark: دالة ترجع قيمة بتتغير لما تتغير مصادر الـ endpoint (الافتراضي آخر events.id).
+    """
+    if watermark is not None:
+        stats_cache.watch(name, watermark)
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if STATS_CACHE != "on":
+                return await fn(*args, **kwargs)
+            key = (name, args, tuple(sorted(kwargs.items())))
+            return await stats_cache.get(name, key, lambda: fn(*args, **kwargs))
+
+        return wrapper
+
+    return decorate
 
 
 def init_db():
-    conn = get_conn()
+    with db.writer() as conn:
+        _init_schema(conn)
+
+
+def _init_schema(conn):
     cur = conn.cursor()
 
     # جدول الأجهزة (الهيكل الأساسي)
@@ -81,11 +948,45 @@ def init_db():
             utm_campaign TEXT,
             utm_content TEXT,
             referrer_first TEXT,
-            user_agent_first TEXT
+            user_agent_first TEXT,
+            utm_source_id INTEGER,
+            utm_medium_id INTEGER,
+            utm_campaign_id INTEGER,
+            utm_content_id INTEGER,
+            referrer_first_id INTEGER,
+            user_agent_first_id INTEGER,
+            event_count INTEGER NOT NULL DEFAULT 0,
+            pageviews INTEGER NOT NULL DEFAULT 0,
+            first_event_at INTEGER,
+            last_event_at INTEGER,
+            duration_s INTEGER,
+            landing_url_id INTEGER,
+            exit_url_id INTEGER,
+            funnel_step INTEGER NOT NULL DEFAULT 0,
+            purchased INTEGER NOT NULL DEFAULT 0
         )
         """
     )
 
+    # أعمدة يعبيها materialize_sessions من الأحداث (لو الداتابيس قديمة)
+    extra_session_columns = [
+        ("event_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("pageviews", "INTEGER NOT NULL DEFAULT 0"),
+        ("first_event_at", "INTEGER"),
+        ("last_event_at", "INTEGER"),
+        ("duration_s", "INTEGER"),
+        ("landing_url_id", "INTEGER"),
+        ("exit_url_id", "INTEGER"),
+        ("funnel_step", "INTEGER NOT NULL DEFAULT 0"),
+        ("purchased", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+    for col, col_type in extra_session_columns:
+        try:
+            cur.execute(f"ALTER TABLE sessions ADD COLUMN {col} {col_type}")
+        except sqlite3.OperationalError:
+            # العمود موجود من قبل
+            pass
+
     # جدول الأحداث (مع أعمدة geo و session stats)
     cur.execute(
         """
@@ -108,7 +1009,20 @@ def init_db():
             geo_city TEXT,
             session_pages INTEGER,
             session_duration_ms INTEGER,
-            template_name TEXT
+            template_name TEXT,
+            product_id TEXT,
+            product_title TEXT,
+            value REAL,
+            currency TEXT,
+            quantity INTEGER,
+            url_id INTEGER,
+            referrer_id INTEGER,
+            user_agent_id INTEGER,
+            utm_source_id INTEGER,
+            utm_medium_id INTEGER,
+            utm_campaign_id INTEGER,
+            utm_content_id INTEGER,
+            event_id TEXT
         )
         """
     )
@@ -120,6 +1034,14 @@ def init_db():
         ("session_pages", "INTEGER"),
         ("session_duration_ms", "INTEGER"),
         ("template_name", "TEXT"),
+        # حقول meta المعروفة (تنملى من extract_meta_fields)
+        ("product_id", "TEXT"),
+        ("product_title", "TEXT"),
+        ("value", "REAL"),
+        ("currency", "TEXT"),
+        ("quantity", "INTEGER"),
+        # id من الكلاينت لمنع التكرار عند إعادة الإرسال
+        ("event_id", "TEXT"),
     ]
     for col, col_type in extra_event_columns:
         try:
@@ -128,409 +1050,3441 @@ def init_db():
             # العمود موجود من قبل
             pass
 
+    # فريد للأحداث اللي إلها event_id بس (الاسم مش idx_ عشان ensure_indexes ما يمسحه).
+    # "" مش id (زي find_duplicates)؛ النسخة القديمة كانت بتشمله فأول حدث بـ "" يسكّر على الباقي
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE name = 'uq_events_event_id'").fetchone()
+    if row is None or "event_id <> ''" not in row[0]:
+        cur.execute("UPDATE events SET event_id = NULL WHERE event_id = ''")
+        cur.execute("DROP INDEX IF EXISTS uq_events_event_id")
+        cur.execute(
+            "CREATE UNIQUE INDEX uq_events_event_id ON events (event_id)"
+            " WHERE event_id IS NOT NULL AND event_id <> ''"
+        )
+
+    # النصوص المتكررة تنحفظ كـ id من جدول strings (العمود النصي يضل للصفوف القديمة)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS strings (
+            id INTEGER PRIMARY KEY,
+            value TEXT NOT NULL UNIQUE
+        )
+        """
+    )
+    for table, columns in (("events", EVENT_STRING_COLUMNS), ("sessions", SESSION_STRING_COLUMNS)):
+        for col in columns:
+            try:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {col}_id INTEGER")
+            except sqlite3.OperationalError:
+                pass
+    create_decoded_views(cur)
+
+    # إعدادات وحالة داخلية (نسخة الفهارس وغيرها)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """
+    )
+
+    # -------- جداول التجميع (rollups) --------
+    # عدد الأحداث لكل ساعة/يوم × المصدر × نوع الحدث، تتحدث مع كل دفعة كتابة.
+    # traffic_source = NULL ينحفظ ROLLUP_NULL_SOURCE عشان ما يختلط بالمصدر الفاضي ''.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollup_hourly (
+            bucket INTEGER NOT NULL,
+            traffic_source TEXT NOT NULL,
+            event TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, traffic_source, event)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollup_daily (
+            day TEXT NOT NULL,
+            traffic_source TEXT NOT NULL,
+            event TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, traffic_source, event)
+        ) WITHOUT ROWID
+        """
+    )
+
+    # عدد الجلسات والأجهزة: يزيد فقط لما ينضاف صف جديد (مسار DO UPDATE ما يشغل trigger الإضافة)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollup_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    for table in ("sessions", "devices"):
+        cur.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO rollup_totals (name, value) VALUES ('{table}', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END
+            """
+        )
+
+    # sketches العدّ التقريبي: day = '' يعني كل الأيام (دمج اليوميات)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS hll_sketches (
+            day TEXT NOT NULL,
+            dim TEXT NOT NULL,
+            value TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            registers BLOB NOT NULL,
+            PRIMARY KEY (day, dim, value, metric)
+        ) WITHOUT ROWID
+        """
+    )
+
+    # سجل أجزاء الأحداث: draining (انسخ وعم ينمسح من events) → sealed → archived / dropped
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS event_partitions (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            min_ts INTEGER NOT NULL,
+            max_ts INTEGER NOT NULL,
+            rows INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL,
+            sealed_at INTEGER,
+            archive_path TEXT
+        )
+        """
+    )
+
     conn.commit()
-    conn.close()
 
+    ensure_indexes(conn)
 
-# استدعاء إنشاء / تحديث الجداول عند تشغيل السيرفر
-init_db()
+    # أول تشغيل بعد إضافة الـ rollups أو تغيير مفتاحها: المسح هون والإعادة بالخلفية (build_rollups)
+    if get_meta(cur, "rollups_version") != str(ROLLUPS_VERSION):
+        _reset_rollups(cur)
+        conn.commit()
 
+    # الـ sketches تنعاد لو أول مرة، أو تغيرت الدقة، أو كانت مطفية (فاتها أحداث). المسح هون
+    # (الكتابة ما لازم تلمس sketch بحجم دقة قديمة)، والإعادة على الأحداث بالخلفية (build_sketches)
+    if APPROX_DISTINCT == "off":
+        cur.execute("DELETE FROM hll_sketches")
+        cur.execute(
+            "DELETE FROM app_meta WHERE key IN ('sketches_precision', 'sketches_building', 'sketches_target')"
+        )
+        conn.commit()
+    elif str(HLL_PRECISION) not in (get_meta(cur, "sketches_precision"), get_meta(cur, "sketches_building")):
+        _reset_sketches(cur)
+        conn.commit()
 
-# -------- نماذج البيانات (Pydantic) --------
-class EventIn(BaseModel):
-    event: str
-    session_id: str
-    device_id: str
+    # أعمدة المنتج والنصوص القديمة → ids بتتعبى بالخلفية (run_backfills). هون بس نثبّت لحد
+    # أي id: اللي بعده انكتب من مسار الكتابة بالأعمدة الجديدة
+    for key, table in (
+        ("meta_columns_target", "events"),
+        ("events_strings_target", "events"),
+        ("sessions_strings_target", "sessions"),
+    ):
+        if get_meta(cur, key) is None:
+            set_meta(cur, key, cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0])
+    conn.commit()
 
-    url: Optional[str] = None
-    referrer: Optional[str] = None
-    user_agent: Optional[str] = None
 
-    traffic_source: Optional[str] = None  # direct / referral / whatsapp / etc
-    utm_source: Optional[str] = None
-    utm_medium: Optional[str] = None
-    utm_campaign: Optional[str] = None
-    utm_content: Optional[str] = None
+# -------- الفهارس --------
+# الفهارس مصممة على استعلامات /stats بالضبط، وأغلبها covering.
+# أي تغيير في القائمة لازم يرفع INDEX_SET_VERSION عشان القديم ينمسح ويتعمل ANALYZE.
+INDEX_SET_VERSION = 5
+INDEXES = {
+    # realtime + events-daily
+    "idx_events_created_at": "events (created_at)",
+    # funnel + purchase
+    "idx_events_event_session": "events (event, session_id, traffic_source)",
+    "idx_events_event_source": "events (event, traffic_source, session_id)",
+    "idx_events_product": "events (product_id, product_title, event, session_id)",
+    "idx_events_event_device": "events (event, device_id)",
+    # COUNT(DISTINCT ...) في overview و devices
+    "idx_events_session": "events (session_id)",
+    "idx_events_device": "events (device_id)",
+    # overview.by_source + فلتر source (مع مدى زمني)
+    "idx_events_source_created": "events (traffic_source, created_at)",
+    # فلتر template_name
+    "idx_events_template_created": "events (template_name, created_at)",
+    # geo
+    "idx_events_country_session": "events (geo_country, session_id)",
+    "idx_events_city_session": "events (geo_city, session_id)",
+    # realtime + whatsapp
+    "idx_sessions_last_seen": "sessions (last_seen)",
+    "idx_devices_last_seen": "devices (last_seen)",
+    "idx_devices_whatsapp": "devices (is_whatsapp, device_id)",
+    # /stats/sessions (أعمدة materialize_sessions)
+    "idx_sessions_started": "sessions (first_event_at, traffic_source, pageviews, duration_s, funnel_step, purchased)",
+    "idx_sessions_landing": "sessions (landing_url_id, first_event_at, pageviews)",
+    "idx_sessions_exit": "sessions (exit_url_id, first_event_at)",
+}
 
-    # حقول إضافية من السكربت
-    geo_country: Optional[str] = None
-    geo_city: Optional[str] = None
-    session_pages: Optional[int] = None
-    session_duration_ms: Optional[int] = None
-    template_name: Optional[str] = None
-    timestamp: Optional[int] = None  # لو حابب تستقبله من الفرونت فقط، بدون تخزين
 
-    meta: Optional[Dict[str, Any]] = None  # أي بيانات إضافية (product_id, value...)
+def get_meta(cur, key: str, default: Optional[str] = None) -> Optional[str]:
+    row = cur.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
 
 
-# -------- تحليل user_agent لاستخراج نوع الجهاز والنظام والمتصفح --------
-def parse_user_agent(ua: Optional[str]) -> Dict[str, Optional[str]]:
-    info = {
-        "device_type": None,
-        "device_brand": None,
-        "device_model": None,
-        "os_name": None,
-        "os_version": None,
-        "browser_name": None,
-        "browser_version": None,
-    }
-    if not ua:
-        return info
+def set_meta(cur, key: str, value):
+    cur.execute(
+        """
+        INSERT INTO app_meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        (key, str(value)),
+    )
 
-    ua_l = ua.lower()
 
-    # نوع الجهاز + الماركة الأساسية
-    if "iphone" in ua_l:
-        info["device_type"] = "Phone"
-        info["device_brand"] = "Apple"
-        info["device_model"] = "iPhone"
-        info["os_name"] = "iOS"
-    elif "ipad" in ua_l:
-        info["device_type"] = "Tablet"
-        info["device_brand"] = "Apple"
-        info["device_model"] = "iPad"
-        info["os_name"] = "iPadOS"
-    elif "android" in ua_l:
-        # موبايل أو تابلت
-        if "mobile" in ua_l:
-            info["device_type"] = "Phone"
-        elif "tablet" in ua_l:
-            info["device_type"] = "Tablet"
-        else:
-            info["device_type"] = "Android Device"
-        info["os_name"] = "Android"
+def ensure_indexes(conn):
+    cur = conn.cursor()
+    for name, target in INDEXES.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
 
-        # محاولة اكتشاف الماركة
-        if "samsung" in ua_l or "sm-" in ua_l:
-            info["device_brand"] = "Samsung"
-        elif "huawei" in ua_l:
-            info["device_brand"] = "Huawei"
-        elif "xiaomi" in ua_l or "redmi" in ua_l or "mi " in ua_l:
-            info["device_brand"] = "Xiaomi"
-        elif "oppo" in ua_l:
-            info["device_brand"] = "Oppo"
-        elif "vivo" in ua_l:
-            info["device_brand"] = "Vivo"
-        elif "realme" in ua_l:
-            info["device_brand"] = "Realme"
-        elif "infinix" in ua_l:
-            info["device_brand"] = "Infinix"
-        elif "tecno" in ua_l:
-            info["device_brand"] = "Tecno"
-        elif "motorola" in ua_l or "moto g" in ua_l:
-            info["device_brand"] = "Motorola"
+    if get_meta(cur, "index_set_version") != str(INDEX_SET_VERSION):
+        # نمسح فهارسنا القديمة اللي طلعت من القائمة
+        cur.execute(
+            """
+            SELECT name FROM sqlite_master
+            WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'
+            """
+        )
+        for (name,) in cur.fetchall():
+            if name not in INDEXES:
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+        cur.execute("ANALYZE")
+        set_meta(cur, "index_set_version", INDEX_SET_VERSION)
+        logger.info("index set upgraded to version %s", INDEX_SET_VERSION)
 
-        # محاولة بسيطة لاستخراج موديل (مثلاً SM-A146P)
-        m = re.search(r"(sm-[a-z0-9]+)", ua_l)
-        if m:
-            info["device_model"] = m.group(1).upper()
-    else:
-        # Desktop / Laptop
-        if "windows" in ua_l:
-            info["device_type"] = "Desktop"
-            info["os_name"] = "Windows"
-        elif "macintosh" in ua_l or "mac os" in ua_l:
-            info["device_type"] = "Desktop"
-            info["os_name"] = "macOS"
-            info["device_brand"] = "Apple"
-        elif "linux" in ua_l:
-            info["device_type"] = "Desktop"
-            info["os_name"] = "Linux"
+    conn.commit()
 
-    # استخراج نسخة النظام (بسيطة جداً)
-    if info["os_name"] == "Android":
-        m = re.search(r"android\s+([\d\.]+)", ua_l)
-        if m:
-            info["os_version"] = m.group(1)
-    elif info["os_name"] in ("iOS", "iPadOS"):
-        m = re.search(r"os\s+([\d\_]+)", ua_l)
-        if m:
-            info["os_version"] = m.group(1).replace("_", ".")
 
-    # المتصفح
-    browser_name = None
-    if "edg" in ua_l:
-        browser_name = "Edge"
-    elif "opr" in ua_l or "opera" in ua_l:
-        browser_name = "Opera"
-    elif "chrome" in ua_l and "safari" in ua_l:
-        browser_name = "Chrome"
-    elif "safari" in ua_l and "chrome" not in ua_l:
-        browser_name = "Safari"
-    elif "firefox" in ua_l:
-        browser_name = "Firefox"
+# -------- تحديث وإعادة بناء الـ rollups --------
+ROLLUP_REBUILD_CHUNK = 200_000
+# أحداث كل دفعة بإعادة بناء الـ rollups بالخلفية (تجميع بالذاكرة و upsert، فالدفعة أكبر من الـ sketches)
+ROLLUP_BACKFILL_CHUNK = 20_000
+# traffic_source = NULL بالـ rollups (العمود بالمفتاح فـ NOT NULL). '' مصدر فاضي بيطلع بـ
+# by_source زي الاستعلام القديم، و NULL لا، فلازم يضلوا منفصلين
+ROLLUP_NULL_SOURCE = "\x00"
+# يرتفع لما يتغير شكل مفتاح الـ rollups: init_db بيمسحها وبتنعاد بالخلفية
+ROLLUPS_VERSION = 2
 
-    info["browser_name"] = browser_name
+ROLLUP_HOURLY_SQL = """
+    INSERT INTO rollup_hourly (bucket, traffic_source, event, events)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(bucket, traffic_source, event) DO UPDATE SET
+        events = events + excluded.events
+"""
 
-    if browser_name:
-        # محاولة جلب النسخة
-        pattern_map = {
-            "Chrome": r"chrome/([\d\.]+)",
-            "Safari": r"version/([\d\.]+)",
-            "Firefox": r"firefox/([\d\.]+)",
-            "Edge": r"edg/([\d\.]+)",
-            "Opera": r"(?:opr|opera)/([\d\.]+)",
-        }
-        pat = pattern_map.get(browser_name)
-        if pat:
-            m = re.search(pat, ua_l)
-            if m:
-                info["browser_version"] = m.group(1)
+ROLLUP_DAILY_SQL = """
+    INSERT INTO rollup_daily (day, traffic_source, event, events)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(day, traffic_source, event) DO UPDATE SET
+        events = events + excluded.events
+"""
 
-    return info
 
+def _utc_day(ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
 
-# -------- منطق التتبع الداخلي --------
-def upsert_device(
-    cur,
-    device_id: str,
-    now_ts: int,
-    traffic_source: Optional[str],
-    user_agent: Optional[str],
-):
-    # حاول تجيب الجهاز
-    cur.execute("SELECT id, is_whatsapp FROM devices WHERE device_id = ?", (device_id,))
-    row = cur.fetchone()
 
-    is_whatsapp = 1 if (traffic_source == "whatsapp") else 0
-    ua_info = parse_user_agent(user_agent)
+def update_rollups(cur, rows: List[Tuple[int, Optional[str], str]]):
+    """rows: (created_at, traffic_source, event). يجمعهم بالذاكرة ويكتب upsert واحد لكل bucket."""
+    hourly: Dict[tuple, int] = {}
+    for created_at, traffic_source, event in rows:
+        source = ROLLUP_NULL_SOURCE if traffic_source is None else traffic_source
+        key = (created_at - created_at % 3600, source, event)
+        hourly[key] = hourly.get(key, 0) + 1
 
-    if row is None:
-        # جهاز جديد
-        cur.execute(
-            """
-            INSERT INTO devices (
-                device_id,
-                first_seen,
-                last_seen,
-                is_whatsapp,
-                device_type,
-                device_brand,
-                device_model,
-                os_name,
-                os_version,
-                browser_name,
-                browser_version
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                device_id,
-                now_ts,
-                now_ts,
-                is_whatsapp,
-                ua_info["device_type"],
-                ua_info["device_brand"],
-                ua_info["device_model"],
-                ua_info["os_name"],
-                ua_info["os_version"],
-                ua_info["browser_name"],
-                ua_info["browser_version"],
-            ),
-        )
-    else:
-        # تحديث جهاز موجود
-        current_is_whatsapp = row[1] or 0
-        new_is_whatsapp = 1 if (current_is_whatsapp == 1 or is_whatsapp == 1) else 0
+    daily: Dict[tuple, int] = {}
+    for (bucket, source, event), count in hourly.items():
+        key = (_utc_day(bucket), source, event)
+        daily[key] = daily.get(key, 0) + count
+
+    cur.executemany(ROLLUP_HOURLY_SQL, [k + (v,) for k, v in hourly.items()])
+    cur.executemany(ROLLUP_DAILY_SQL, [k + (v,) for k, v in daily.items()])
+
+
+def _reset_rollups(cur) -> int:
+    """
+    يمسح الـ rollups ويثبّت لحد أي id لازم تنعاد (build_rollups)؛ اللي بعده بيدخل من مسار الكتابة.
+    الـ id من sqlite_sequence مش MAX(id): الأحداث اللي انتقلت لأجزاء مختومة لازم تنحسب كمان.
+    """
+    cur.execute("DELETE FROM rollup_hourly")
+    cur.execute("DELETE FROM rollup_daily")
+    cur.execute("DELETE FROM rollup_totals")
+    for table in ("sessions", "devices"):
         cur.execute(
-            """
-            UPDATE devices
-            SET last_seen = ?,
-                is_whatsapp = ?,
-                device_type = ?,
-                device_brand = ?,
-                device_model = ?,
-                os_name = ?,
-                os_version = ?,
-                browser_name = ?,
-                browser_version = ?
-            WHERE device_id = ?
-            """,
-            (
-                now_ts,
-                new_is_whatsapp,
-                ua_info["device_type"],
-                ua_info["device_brand"],
-                ua_info["device_model"],
-                ua_info["os_name"],
-                ua_info["os_version"],
-                ua_info["browser_name"],
-                ua_info["browser_version"],
-                device_id,
-            ),
+            f"INSERT INTO rollup_totals (name, value) SELECT '{table}', COUNT(*) FROM {table}"
         )
+    target = cur.execute(
+        "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'events'), 0)"
+    ).fetchone()[0]
+    cur.execute("DELETE FROM app_meta WHERE key = 'rollups_built'")
+    set_meta(cur, "rollups_version", ROLLUPS_VERSION)
+    set_meta(cur, "rollups_target", target)
+    set_meta(cur, "rollups_replayed_id", 0)
+    if not target:
+        _finish_rollups(cur)
+    return target
 
 
-def upsert_session(
-    cur,
-    session_id: str,
-    device_id: str,
-    now_ts: int,
-    traffic_source: Optional[str],
-    utm_source: Optional[str],
-    utm_medium: Optional[str],
-    utm_campaign: Optional[str],
-    utm_content: Optional[str],
-    referrer: Optional[str],
-    user_agent: Optional[str],
+def _finish_rollups(cur):
+    set_meta(cur, "rollups_built", get_meta(cur, "rollups_target", "0"))
+    cur.execute("DELETE FROM app_meta WHERE key IN ('rollups_target', 'rollups_replayed_id')")
+
+
+def rollups_ready(cur) -> bool:
+    """False لحد ما build_rollups يخلص: overview و events-daily بيقروا من events."""
+    return get_meta(cur, "rollups_built") is not None
+
+
+def build_rollups():
+    """
+    يكمل الـ rollups اللي مسحها _reset_rollups: الأحداث لحد rollups_target (events والأجزاء)
+    بترتيب الـ id على دفعات ROLLUP_BACKFILL_CHUNK. الدفعة ومؤشر rollups_replayed_id بنفس
+    الـ transaction، فبعد crash أو restart بتكمل من آخر دفعة بدون ما حدث ينعد مرتين.
+    rollups_built ما بينكتب إلا بعد آخر دفعة.
+    """
+    progress = backfill_stats["rollups"]
+    conn = open_conn(readonly=True)
+    try:
+        cur = conn.cursor()
+        if rollups_ready(cur):
+            progress["state"] = "done"
+            return
+        target = int(get_meta(cur, "rollups_target", "0"))
+        last_id = int(get_meta(cur, "rollups_replayed_id", "0"))
+        progress.update(state="running", done_id=last_id, target_id=target)
+
+        while last_id < target:
+            if _stop_event.is_set():
+                return
+            rows = conn.execute(
+                _export_events_sql(
+                    conn, last_id, ROLLUP_BACKFILL_CHUNK, target, ("id", "created_at", "traffic_source", "event")
+                )
+            ).fetchall()
+            upper = rows[-1][0] if rows else target
+            # شهر بحالة draining بيطلع من events ومن الجزء بنفس الـ id
+            batch, previous = [], None
+            for event_id, created_at, traffic_source, event in rows:
+                if event_id != previous:
+                    batch.append((created_at, traffic_source, event))
+                previous = event_id
+
+            with db.writer() as w:
+                wcur = w.cursor()
+                # rebuild-rollups من عملية ثانية بيرجّع المؤشر؛ الدفعة هاي ما لازم تنضاف فوقه
+                if get_meta(wcur, "rollups_replayed_id") != str(last_id):
+                    raise RuntimeError("rollups rebuild was reset while running")
+                update_rollups(wcur, batch)
+                set_meta(wcur, "rollups_replayed_id", upper)
+                if upper >= target:
+                    _finish_rollups(wcur)
+                db.commit(w)
+            last_id = upper
+            progress["done_id"] = upper
+    finally:
+        conn.close()
+    progress["state"] = "done"
+    logger.info("rollups rebuilt up to event id %s", target)
+
+
+def rebuild_rollups():
+    """
+    يمسح الـ rollups ويعيد حسابها من events والأجزاء المختومة (للـ CLI).
+    الأشهر اللي انأرشفت أو انمسحت تطلع من الأرقام بعد إعادة البناء (والـ sketches بـ rebuild_sketches).
+    """
+    with db.writer() as conn:
+        _reset_rollups(conn.cursor())
+        db.commit(conn)
+    build_rollups()
+
+
+def rebuild_sketches(conn):
+    """يمسح الـ sketches ويعيد بناءها كلها على conn مرة وحدة (للـ CLI وهو ماسك الكاتب)."""
+    cur = conn.cursor()
+    max_id = _reset_sketches(cur)
+    conn.commit()
+
+    def apply(rows):
+        update_sketches(cur, rows, use_cache=False)
+        conn.commit()
+
+    _replay_events(conn, max_id, apply)
+    _finish_sketches(cur)
+    conn.commit()
+    logger.info("distinct-count sketches rebuilt up to event id %s", max_id)
+
+
+def build_sketches():
+    """
+    يكمل الـ sketches اللي مسحها init_db: الأحداث لحد sketches_target تنقرأ باتصال قراءة
+    وتندمج تحت الكاتب على دفعات SKETCH_BACKFILL_CHUNK. الدمج أكبر register، فترتيبه مع
+    مسار الكتابة ما بيفرق، والدفعات اللي انعادت بعد restart ما بتضر.
+    """
+    progress = backfill_stats["sketches"]
+    conn = open_conn(readonly=True)
+    try:
+        cur = conn.cursor()
+        if get_meta(cur, "sketches_building") is None:
+            progress["state"] = "done"
+            return
+        max_id = int(get_meta(cur, "sketches_target", "0"))
+        progress.update(state="running", rows=0, target_id=max_id)
+
+        def apply(rows):
+            started = time.monotonic()
+            # الحساب برا الكاتب، وتحته بس الدمج مع المحفوظ والكتابة
+            updates = sketch_updates(rows)
+            with db.writer() as w:
+                apply_sketch_updates(w.cursor(), updates)
+                db.commit(w)
+            progress["rows"] += len(rows)
+            # الحساب بايثون خالص وبياخد الـ GIL من الطلبات؛ استراحة قد وقت الدفعة
+            # بتخلي الـ ingest شبه طبيعي والبناء أبطأ مرتين بس
+            _stop_event.wait((time.monotonic() - started) * SKETCH_BACKFILL_PAUSE)
+
+        _replay_events(conn, max_id, apply, SKETCH_BACKFILL_CHUNK, stop=_stop_event)
+    finally:
+        conn.close()
+    if _stop_event.is_set():
+        return
+    with db.writer() as w:
+        _finish_sketches(w.cursor())
+        db.commit(w)
+    progress["state"] = "done"
+    logger.info("distinct-count sketches rebuilt up to event id %s", max_id)
+
+
+def _replay_events(
+    conn, max_id: int, apply, chunk: int = ROLLUP_REBUILD_CHUNK, stop: Optional[threading.Event] = None
 ):
-    cur.execute("SELECT id FROM sessions WHERE session_id = ?", (session_id,))
-    row = cur.fetchone()
+    """
+    أحداث events لحد max_id وكل الأجزاء على دفعات بالـ id، و apply(rows) لكل دفعة.
+    stop: إعادة البناء بالخلفية توقف مع السيرفر (واللي نادى بيشوفه وما بيعلّمها خلصت).
+    """
+    cur = conn.cursor()
+    # شهر بحالة draining موجود بالجزء وببقايا events؛ نحسبه من الجزء بس
+    parts = visible_partitions(cur)
+    live_from = max((p[3] for p in parts if p[4] == "draining"), default=0)
+    _rollup_id_range(conn, "main", max_id, apply, chunk, stop, live_from)
+    for name, path, *_ in parts:
+        conn.execute(f"ATTACH DATABASE ? AS {name}", (_partition_uri(path),))
+        try:
+            part_max = cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {name}.events").fetchone()[0]
+            _rollup_id_range(conn, name, part_max, apply, chunk, stop)
+        finally:
+            conn.execute(f"DETACH DATABASE {name}")
 
-    if row is None:
-        # جلسة جديدة
+
+def _rollup_id_range(
+    conn, schema: str, max_id: int, apply, chunk: int, stop: Optional[threading.Event], live_from: int = 0
+):
+    cur = conn.cursor()
+    last_id = 0
+    while last_id < max_id and not (stop is not None and stop.is_set()):
+        upper = min(last_id + chunk, max_id)
         cur.execute(
-            """
-            INSERT INTO sessions (
-                session_id, device_id,
-                first_seen, last_seen,
-                traffic_source,
-                utm_source, utm_medium, utm_campaign, utm_content,
-                referrer_first, user_agent_first
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            f"""
+            SELECT created_at, traffic_source, event, geo_country, geo_city, session_id, device_id
+            FROM {schema}.events
+            WHERE id > ? AND id <= ? AND created_at >= ?
             """,
-            (
-                session_id,
-                device_id,
-                now_ts,
-                now_ts,
-                traffic_source,
-                utm_source,
-                utm_medium,
-                utm_campaign,
-                utm_content,
-                referrer,
-                user_agent,
-            ),
+            (last_id, upper, live_from),
         )
-    else:
-        # تحديث جلسة موجودة (فقط last_seen)
-        cur.execute(
-            """
-            UPDATE sessions
-            SET last_seen = ?
-            WHERE session_id = ?
-            """,
-            (now_ts, session_id),
+        apply(cur.fetchall())
+        last_id = upper
+
+
+# -------- العدّ التقريبي (HyperLogLog) --------
+# كل (يوم، بُعد، قيمة، نوع) له sketch: 2^HLL_PRECISION register بايت لكل واحد.
+# الـ sketches تندمج بأخذ أكبر register، فدمج أي مجموعة أيام يعطي تقدير لعدد
+# الجلسات/الأجهزة المختلفة فيها. day = '' هو دمج كل الأيام، يتحدث مع اليومي عشان
+# /stats يقرأ صف واحد لكل قيمة. زي الـ rollups: الأشهر المحذوفة تطلع بعد rebuild-rollups.
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_STD_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+_HLL_VALUE_BITS = 64 - HLL_PRECISION
+_HLL_INVERSE_POWERS = [2.0 ** -rank for rank in range(_HLL_VALUE_BITS + 2)]
+
+HLL_UPSERT_SQL = """
+    INSERT INTO hll_sketches (day, dim, value, metric, registers)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(day, dim, value, metric) DO UPDATE SET
+        registers = excluded.registers
+"""
+
+
+def hll_position(item: str) -> Tuple[int, int]:
+    """(رقم الـ register، ترتيب أول بت 1) من hash بطول 64 بت."""
+    h = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+    rest = h & ((1 << _HLL_VALUE_BITS) - 1)
+    return h >> _HLL_VALUE_BITS, _HLL_VALUE_BITS - rest.bit_length() + 1
+
+
+def hll_estimate(registers: bytes) -> int:
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / sum(map(_HLL_INVERSE_POWERS.__getitem__, registers))
+    zeros = registers.count(0)
+    if raw <= 2.5 * m and zeros:
+        # أعداد صغيرة: linear counting أدق
+        return round(m * math.log(m / zeros))
+    return round(raw)
+
+
+def _reset_sketches(cur) -> int:
+    """يمسح الـ sketches؛ الأحداث لحد الـ id الراجع لازم تنعاد، واللي بعده بيدخل من مسار الكتابة."""
+    cur.execute("DELETE FROM hll_sketches")
+    cur.execute("DELETE FROM app_meta WHERE key = 'sketches_precision'")
+    max_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+    set_meta(cur, "sketches_building", HLL_PRECISION)
+    set_meta(cur, "sketches_target", max_id)
+    return max_id
+
+
+def _finish_sketches(cur):
+    set_meta(cur, "sketches_precision", HLL_PRECISION)
+    cur.execute("DELETE FROM app_meta WHERE key IN ('sketches_building', 'sketches_target')")
+
+
+def sketches_ready(cur) -> bool:
+    """False لحد ما build_sketches يخلص: approx=true بيرجع للعدّ الدقيق."""
+    return get_meta(cur, "sketches_precision") == str(HLL_PRECISION)
+
+
+def _sketch_keys(day: str, source: Optional[str], event: str, country: Optional[str], city: Optional[str]):
+    for bucket in (day, ""):
+        yield bucket, "all", ""
+        yield bucket, "source", source or ""
+        yield bucket, "event", event
+        if country:
+            yield bucket, "country", country
+        if city:
+            yield bucket, "city", city
+
+
+def update_sketches(cur, rows: List[tuple], use_cache: bool = True):
+    """
+    rows: (created_at, traffic_source, event, geo_country, geo_city, session_id, device_id).
+    يجمع أكبر ترتيب لكل register بالذاكرة، وما يكتب إلا الـ sketches اللي تغيرت فعلاً
+    (بعد ما يمتلي الـ sketch أغلب الأحداث ما تغير ولا register).
+    """
+    if APPROX_DISTINCT != "on":
+        return
+    apply_sketch_updates(cur, sketch_updates(rows), use_cache)
+
+
+def sketch_updates(rows: List[tuple]) -> Dict[tuple, Dict[int, int]]:
+    """أكبر ترتيب لكل register لكل sketch بالدفعة (بايثون خالص، ما بيحتاج الكاتب)."""
+    positions: Dict[str, Tuple[int, int]] = {}
+    updates: Dict[tuple, Dict[int, int]] = {}
+    for created_at, source, event, country, city, session_id, device_id in rows:
+        items = [(m, v) for m, v in (("session", session_id), ("device", device_id)) if v]
+        if not items:
+            continue
+        items = [(m, positions.get(v) or positions.setdefault(v, hll_position(v))) for m, v in items]
+        for bucket, dim, value in _sketch_keys(_utc_day(created_at), source, event, country, city):
+            for metric, (index, rank) in items:
+                registers = updates.setdefault((bucket, dim, value, metric), {})
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+    return updates
+
+
+def apply_sketch_updates(cur, updates: Dict[tuple, Dict[int, int]], use_cache: bool = True):
+    loaded: Dict[tuple, tuple] = {}
+    changed = []
+    for key, registers in updates.items():
+        cached = sketch_cache.get(key) if use_cache else None
+        if cached is not None:
+            current = cached[0]
+        else:
+            row = cur.execute(
+                "SELECT registers FROM hll_sketches WHERE day = ? AND dim = ? AND value = ? AND metric = ?",
+                key,
+            ).fetchone()
+            current = row[0] if row else bytes(HLL_REGISTERS)
+        sketch = bytearray(current)
+        dirty = False
+        for index, rank in registers.items():
+            if rank > sketch[index]:
+                sketch[index] = rank
+                dirty = True
+        if dirty:
+            current = bytes(sketch)
+            changed.append(key + (current,))
+        if dirty or cached is None:
+            loaded[key] = (current,)
+
+    cur.executemany(HLL_UPSERT_SQL, changed)
+    if use_cache and loaded:
+        db.on_commit(lambda: sketch_cache.put_many(loaded))
+
+
+def approx_distinct(cur, dim: str, metric: str) -> List[Tuple[str, int]]:
+    """تقدير العدد لكل قيمة من sketches كل الأيام، بترتيب تنازلي."""
+    sketches = run_query(
+        cur,
+        f"approx.{dim}.{metric}",
+        "SELECT value, registers FROM hll_sketches WHERE day = '' AND dim = ? AND metric = ?",
+        (dim, metric),
+    )
+    rows = [(value, hll_estimate(registers)) for value, registers in sketches]
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return rows
+
+
+def sketches_building() -> bool:
+    """approx=true وقت إعادة بناء الـ sketches بالخلفية بيرجع العدّ الدقيق مع approx: {"building": true}."""
+    if APPROX_DISTINCT != "on":
+        # approx_info بيرجع 400
+        return False
+    with db.reader() as conn:
+        return not sketches_ready(conn.cursor())
+
+
+def approx_info(started: float) -> Dict[str, Any]:
+    if APPROX_DISTINCT != "on":
+        raise HTTPException(status_code=400, detail="approximate counts are off (APPROX_DISTINCT=off)")
+    return {
+        "precision": HLL_PRECISION,
+        "relative_std_error": round(HLL_STD_ERROR, 4),
+        # ~95% من التقديرات ضمن ±2 خطأ معياري
+        "error_bound_95": round(2 * HLL_STD_ERROR, 4),
+        "query_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+# -------- حقول meta المعروفة → أعمدة --------
+# المنتج والقيمة تنحفظ بأعمدة مفهرسة وقت الكتابة، فاستعلامات المنتجات ما تلمس JSON أبداً.
+META_BACKFILL_CHUNK = 10_000
+
+
+def _to_float(v) -> Optional[float]:
+    if v is None or isinstance(v, bool):
+        return None
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    # "nan" و "Infinity" و "1e400" ينقروا كـ float بس مش أرقام بتنحفظ (ولا بتتحول لـ int)
+    return f if math.isfinite(f) else None
+
+
+def _to_int(v) -> Optional[int]:
+    f = _to_float(v)
+    return int(f) if f is not None else None
+
+
+def extract_meta_fields(meta: Any) -> Tuple[Optional[str], Optional[str], Optional[float], Optional[str], Optional[int]]:
+    """يرجع (product_id, product_title, value, currency, quantity) بنفس منطق الفانل القديم."""
+    if not isinstance(meta, dict):
+        return (None, None, None, None, None)
+
+    product_id = meta.get("product_id")
+    product_title = meta.get("product_title") or meta.get("title")
+    currency = meta.get("currency")
+    return (
+        str(product_id) if product_id is not None else None,
+        str(product_title) if product_title else None,
+        _to_float(meta.get("value")),
+        str(currency) if currency else None,
+        _to_int(meta.get("quantity")),
+    )
+
+
+def backfill_meta_columns():
+    """أعمدة المنتج للأحداث لحد meta_columns_target، دفعة بكل مسكة كاتب، وتكمل من حيث وقفت."""
+    progress = backfill_stats["meta_columns"]
+    with db.writer() as conn:
+        cur = conn.cursor()
+        done = get_meta(cur, "meta_columns_backfilled")
+        target = int(get_meta(cur, "meta_columns_target", "0"))
+    if done == "complete":
+        progress["state"] = "done"
+        return
+    last_id = int(done or 0)
+    progress.update(state="running", done_id=last_id, target_id=target)
+
+    while last_id < target:
+        if _stop_event.is_set():
+            return
+        upper = min(last_id + META_BACKFILL_CHUNK, target)
+        with db.writer() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, meta FROM events WHERE id > ? AND id <= ? AND meta IS NOT NULL",
+                (last_id, upper),
+            )
+            updates = []
+            for event_id, meta_json in cur.fetchall():
+                # صف خربان واحد ما لازم يوقف الترحيل
+                try:
+                    fields = extract_meta_fields(json.loads(meta_json))
+                except ValueError:
+                    continue
+                except Exception:
+                    logger.warning("meta backfill skipped event %s", event_id, exc_info=True)
+                    continue
+                if any(f is not None for f in fields):
+                    updates.append(fields + (event_id,))
+            cur.executemany(
+                """
+                UPDATE events
+                SET product_id = ?, product_title = ?, value = ?, currency = ?, quantity = ?
+                WHERE id = ?
+                """,
+                updates,
+            )
+            set_meta(cur, "meta_columns_backfilled", upper)
+            db.commit(conn)
+        last_id = upper
+        progress["done_id"] = upper
+
+    with db.writer() as conn:
+        set_meta(conn.cursor(), "meta_columns_backfilled", "complete")
+        db.commit(conn)
+    progress["state"] = "done"
+    if target:
+        logger.info("meta columns backfilled up to event id %s", target)
+
+
+def meta_backfill_pending() -> bool:
+    """
+    True لحد ما backfill_meta_columns يوصل meta_columns_target: الأحداث القديمة لسا product_id
+    فيها NULL وما بتطلع بـ by_product، فـ /stats/funnel بيرجع backfill_pending: true.
+    """
+    with db.reader() as conn:
+        cur = conn.cursor()
+        done = get_meta(cur, "meta_columns_backfilled")
+        target = int(get_meta(cur, "meta_columns_target", "0"))
+    return done != "complete" and int(done or 0) < target
+
+
+# -------- النصوص المتكررة → ids (جدول strings) --------
+# user_agent و url و referrer و utm_* تتكرر بكل حدث وعدد قيمها المختلفة قليل، فكل صف
+# يخزن id صغير بدل النص. url و referrer بنفس الجدول لأن الـ referrer غالباً صفحة من المتجر.
+# traffic_source و geo_* يضلوا نصوص: قصار، والفانل و geo يجمعوا عليهم من فهارس covering.
+EVENT_STRING_COLUMNS = (
+    "url",
+    "referrer",
+    "user_agent",
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_content",
+)
+SESSION_STRING_COLUMNS = (
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_content",
+    "referrer_first",
+    "user_agent_first",
+)
+STRING_BACKFILL_CHUNK = 10_000
+# عدد القيم في جملة IN وحدة
+STRING_LOOKUP_CHUNK = 500
+
+
+class StringTable:
+    """
+    كاش LRU للـ value → id فوق جدول strings. ما يتعدل إلا تحت lock الكاتب، والقيم
+    الجديدة ما تدخل الكاش إلا بعد الـ commit (id من transaction انلغت ما يضل فيه).
+    """
+
+    # تقدير تقريبي لحجم العنصر (النص نفسه + int + OrderedDict) لعرضه في /status
+    APPROX_ENTRY_BYTES = 200
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "inserted": 0, "evicted": 0}
+
+    def intern_many(self, cur, values) -> Dict[str, int]:
+        """يرجع value → id لكل القيم (None يتجاهل)، ويضيف الناقص لجدول strings."""
+        ids: Dict[str, int] = {}
+        missing = []
+        for value in set(values):
+            if value is None:
+                continue
+            string_id = self._ids.get(value)
+            if string_id is None:
+                missing.append(value)
+            else:
+                ids[value] = string_id
+                self._ids.move_to_end(value)
+        self.counters["hits"] += len(ids)
+        self.counters["misses"] += len(missing)
+        if not missing:
+            return ids
+
+        cur.executemany(
+            "INSERT INTO strings (value) VALUES (?) ON CONFLICT(value) DO NOTHING",
+            [(value,) for value in missing],
         )
+        self.counters["inserted"] += max(cur.rowcount, 0)
+        found: Dict[str, int] = {}
+        for i in range(0, len(missing), STRING_LOOKUP_CHUNK):
+            chunk = missing[i:i + STRING_LOOKUP_CHUNK]
+            placeholders = ",".join(["?"] * len(chunk))
+            cur.execute(f"SELECT value, id FROM strings WHERE value IN ({placeholders})", chunk)
+            found.update(cur.fetchall())
+        ids.update(found)
+        db.on_commit(lambda: self.put_many(found))
+        return ids
 
+    def put_many(self, items: Dict[str, int]):
+        self._ids.update(items)
+        for value in items:
+            self._ids.move_to_end(value)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+            self.counters["evicted"] += 1
 
-# -------- Endpoint: استقبال الأحداث من شوبفاي --------
-@app.post("/track")
-def track_event(payload: EventIn):
-    now_ts = int(time.time())
-    conn = get_conn()
-    cur = conn.cursor()
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "size": len(self._ids),
+            "max_entries": self.max_entries,
+            "approx_bytes": len(self._ids) * self.APPROX_ENTRY_BYTES,
+        }
+
+
+string_table = StringTable(STRINGS_CACHE_SIZE)
+
+
+def decoded_column(col: str) -> str:
+    """تعبير SQL يرجع النص الأصلي: العمود القديم لو موجود، وإلا القيمة من strings حسب الـ id."""
+    return f"COALESCE({col}, (SELECT value FROM strings WHERE id = {col}_id))"
+
+
+def create_decoded_views(cur):
+    """events_decoded / sessions_decoded: نفس أعمدة الجداول بالنصوص بدل الـ ids، للاستعلامات اليدوية."""
+    for table, columns in (("events", EVENT_STRING_COLUMNS), ("sessions", SESSION_STRING_COLUMNS)):
+        id_columns = {f"{col}_id" for col in columns}
+        select = []
+        for (col,) in cur.execute(f"SELECT name FROM pragma_table_info('{table}')").fetchall():
+            if col in id_columns:
+                continue
+            select.append(f"{decoded_column(col)} AS {col}" if col in columns else col)
+        # بينبني من جديد كل تشغيل عشان يلحق أي عمود انضاف للجدول
+        cur.execute(f"DROP VIEW IF EXISTS {table}_decoded")
+        cur.execute(f"CREATE VIEW {table}_decoded AS SELECT {', '.join(select)} FROM {table}")
+
+
+def backfill_string_ids():
+    """
+    ينقل النصوص القديمة بـ events و sessions لأعمدة الـ id ويفضي النص، على دفعات وتكمل
+    من حيث وقفت. لحد ما يخلص decoded_column بيقرأ الاثنين. الصفحات الفاضية ترجع للملف
+    بعد `python main.py vacuum`.
+    """
+    for table, columns in (("events", EVENT_STRING_COLUMNS), ("sessions", SESSION_STRING_COLUMNS)):
+        _backfill_table_strings(table, columns)
+
+
+def _backfill_table_strings(table: str, columns: Tuple[str, ...]):
+    progress = backfill_stats[f"{table}_strings"]
+    with db.writer() as conn:
+        cur = conn.cursor()
+        done = get_meta(cur, f"{table}_strings_backfilled")
+        target = int(get_meta(cur, f"{table}_strings_target", "0"))
+    if done == "complete":
+        progress["state"] = "done"
+        return
+    last_id = int(done or 0)
+    progress.update(state="running", done_id=last_id, target_id=target)
+
+    has_text = " OR ".join(f"{col} IS NOT NULL" for col in columns)
+    assignments = ", ".join(f"{col} = NULL, {col}_id = ?" for col in columns)
+    while last_id < target:
+        if _stop_event.is_set():
+            return
+        upper = min(last_id + STRING_BACKFILL_CHUNK, target)
+        with db.writer() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? AND id <= ? AND ({has_text})",
+                (last_id, upper),
+            )
+            rows = cur.fetchall()
+            ids = string_table.intern_many(cur, (value for row in rows for value in row[1:]))
+            cur.executemany(
+                f"UPDATE {table} SET {assignments} WHERE id = ?",
+                [tuple(ids.get(value) for value in row[1:]) + (row[0],) for row in rows],
+            )
+            set_meta(cur, f"{table}_strings_backfilled", upper)
+            db.commit(conn)
+        last_id = upper
+        progress["done_id"] = upper
+
+    with db.writer() as conn:
+        set_meta(conn.cursor(), f"{table}_strings_backfilled", "complete")
+        db.commit(conn)
+    progress["state"] = "done"
+    if target:
+        logger.info("%s strings moved to ids up to id %s; run `vacuum` to shrink the file", table, target)
+
+
+# -------- أجزاء الأحداث الشهرية (partitions) --------
+# الشهر المكتمل ينتسخ لملف events_YYYY_MM.db خاص فيه (بنفس الفهارس)، وبعدين ينمسح
+# من events على دفعات صغيرة. الملف بعد الختم ما يتغير أبداً: القرّاء يفتحوه read-only
+# و immutable، والأرشفة / النسخ الاحتياطي شغل ملفات عادي ما يلمس القاعدة الحية.
+# الاستعلامات على الأحداث تمر من events_relation اللي تضم الأجزاء المطلوبة بـ UNION ALL.
+# الأحداث تنكتب بوقت السيرفر، فما نختم شهر إلا بعد ما يخلص بـ PARTITION_SEAL_GRACE_S
+# (أحداث الطابور اللي انستلمت قبل نص الليل وانكتبت بعده).
+PARTITION_SEAL_GRACE_S = 3600
+
+partition_stats = {
+    "runs": 0,
+    "sealed": 0,
+    "rows_moved": 0,
+    "archived": 0,
+    "dropped": 0,
+    "last_run_ms": 0.0,
+    "last_error": None,
+}
+
+
+def _add_months(month_start: int, months: int) -> int:
+    t = time.gmtime(month_start)
+    index = t.tm_year * 12 + t.tm_mon - 1 + months
+    return calendar.timegm((index // 12, index % 12 + 1, 1, 0, 0, 0))
+
+
+def _month_start(ts: int) -> int:
+    t = time.gmtime(ts)
+    return calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+
+
+def _partition_uri(path: str) -> str:
+    return "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro&immutable=1"
+
+
+def visible_partitions(cur, since: Optional[int] = None, until: Optional[int] = None) -> List[tuple]:
+    """الأجزاء اللي لازم تنقرأ مع events بالمدى [since, until): (name, path, min_ts, max_ts, state)."""
+    sql = "SELECT name, path, min_ts, max_ts, state FROM main.event_partitions WHERE state IN ('draining', 'sealed')"
+    params: List[Any] = []
+    if since is not None:
+        sql += " AND max_ts > ?"
+        params.append(since)
+    if until is not None:
+        sql += " AND min_ts < ?"
+        params.append(until)
+    return cur.execute(sql + " ORDER BY min_ts", params).fetchall()
+
+
+def attach_partitions(conn, parts: List[tuple]):
+    """
+    يضمن إن الأجزاء المطلوبة مربوطة (ATTACH) على الاتصال. الاتصال يحتفظ بالمربوط
+    بين الطلبات، ويفك أول شي الأجزاء اللي انأرشفت (عشان ملفها ينحذف فعلاً من الديسك).
+    """
+    wanted = {name: path for name, path, *_ in parts}
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(wanted) > limit:
+        raise HTTPException(
+            status_code=503,
+            detail=f"query spans {len(wanted)} partitions but only {limit} can be attached; "
+            "lower RETENTION_MONTHS or narrow the time range",
+        )
+    attached = [row[1] for row in conn.execute("PRAGMA database_list") if row[1] not in ("main", "temp")]
+    missing = [name for name in wanted if name not in attached]
+    visible = {row[0] for row in visible_partitions(conn.cursor())}
+
+    room = limit - len(attached)
+    for name in sorted(attached, key=lambda n: n in visible):
+        if name in wanted or (name in visible and room >= len(missing)):
+            continue
+        conn.execute(f"DETACH DATABASE {name}")
+        room += 1
+    for name in missing:
+        conn.execute(f"ATTACH DATABASE ? AS {name}", (_partition_uri(wanted[name]),))
+
+
+def events_relation(cur, columns: str, since: Optional[int] = None, until: Optional[int] = None) -> str:
+    """
+    بديل "events" بعد FROM. لو ما في أجزاء بالمدى يرجع events نفسه (نفس الخطة والفهارس)،
+    وإلا (SELECT columns FROM main.events UNION ALL SELECT columns FROM p_YYYY_MM.events ...) AS events.
+    since/until بس يستبعدوا الأجزاء اللي برا المدى؛ فلترة الصفوف نفسها على الاستعلام.
+    """
+    parts = visible_partitions(cur, since, until)
+    if not parts:
+        return "events"
+    attach_partitions(cur.connection, parts)
+
+    arms = []
+    include_live = True
+    if until is not None:
+        oldest_live = cur.execute("SELECT MIN(created_at) FROM main.events").fetchone()[0]
+        include_live = oldest_live is not None and oldest_live < until
+    if include_live:
+        # شهر بحالة draining لسا له صفوف بـ events؛ نقرأه من الجزء بس
+        live_from = max((p[3] for p in parts if p[4] == "draining"), default=None)
+        where = f" WHERE created_at >= {int(live_from)}" if live_from is not None else ""
+        arms.append(f"SELECT {columns} FROM main.events{where}")
+    for name, path, *_ in parts:
+        # جزء انختم قبل ما ينضاف عمود: العمود يطلع NULL (نفس ALTER TABLE ADD COLUMN)
+        have = _partition_columns(cur, name, path)
+        select = ", ".join(
+            col if col in have else f"NULL AS {col}"
+            for col in (c.strip() for c in columns.split(","))
+        )
+        arms.append(f"SELECT {select} FROM {name}.events")
+    return "(" + " UNION ALL ".join(arms) + ") AS events"
+
+
+# ملفات الأجزاء ما تتغير، فأعمدتها تنقرأ مرة وحدة لكل ملف
+_partition_columns_cache: Dict[str, set] = {}
+
+
+def _partition_columns(cur, name: str, path: str) -> set:
+    columns = _partition_columns_cache.get(path)
+    if columns is None:
+        columns = {row[1] for row in cur.execute(f"PRAGMA {name}.table_info(events)")}
+        _partition_columns_cache[path] = columns
+    return columns
+
+
+def _partition_path(month_start: int) -> str:
+    return os.path.join(PARTITIONS_DIR, time.strftime("events_%Y_%m.db", time.gmtime(month_start)))
+
+
+def seal_month(conn, month_start: int) -> bool:
+    """
+    ينسخ شهر من events لملف جزء (يوم يوم، بدون ما يمسك الكاتب)، يبني الفهارس، يسجله
+    draining، وبعدين يفرّغه من events. يرجع False لو السيرفر عم يطفي (يكمل بالجولة الجاية).
+    """
+    month_end = _add_months(month_start, 1)
+    name = time.strftime("p_%Y_%m", time.gmtime(month_start))
+    cur = conn.cursor()
+    if cur.execute("SELECT 1 FROM event_partitions WHERE name = ?", (name,)).fetchone():
+        # ما المفروض يصير (الأحداث بوقت السيرفر)؛ ما نكتب فوق جزء مختوم
+        raise RuntimeError(f"events for {name} found after it was sealed")
+
+    path = _partition_path(month_start)
+    tmp_path = path + ".tmp"
+    os.makedirs(PARTITIONS_DIR, exist_ok=True)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    # نفس تعريف events الحالي (مع الأعمدة اللي انضافت بـ ALTER)
+    schema = cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'events'").fetchone()[0]
+    build = sqlite3.connect(tmp_path)
+    try:
+        build.execute(schema)
+        build.commit()
+    finally:
+        build.close()
+
+    rows = 0
+    conn.execute("ATTACH DATABASE ? AS build", (tmp_path,))
+    try:
+        # الملف المؤقت ينمسح لو صار أي شي، فما في داعي لـ journal
+        conn.execute("PRAGMA build.journal_mode=OFF")
+        conn.execute("PRAGMA build.synchronous=OFF")
+        day = month_start
+        while day < month_end:
+            if _stop_event.is_set():
+                break
+            cur.execute(
+                """
+                INSERT INTO build.events
+                SELECT * FROM main.events WHERE created_at >= ? AND created_at < ?
+                """,
+                (day, day + 86400),
+            )
+            rows += cur.rowcount
+            conn.commit()
+            day += 86400
+        else:
+            for idx_name, target in INDEXES.items():
+                if target.startswith("events "):
+                    cur.execute(f"CREATE INDEX build.{idx_name} ON {target}")
+            cur.execute("ANALYZE build")
+            conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE build")
+
+    if day < month_end:
+        os.remove(tmp_path)
+        return False
+    live_rows = cur.execute(
+        "SELECT COUNT(*) FROM events WHERE created_at >= ? AND created_at < ?",
+        (month_start, month_end),
+    ).fetchone()[0]
+    if live_rows != rows:
+        os.remove(tmp_path)
+        raise RuntimeError(f"{name}: copied {rows} events but events has {live_rows}")
+
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    with db.writer() as w:
+        w.execute(
+            """
+            INSERT INTO event_partitions (name, path, min_ts, max_ts, rows, state, sealed_at)
+            VALUES (?, ?, ?, ?, ?, 'draining', ?)
+            """,
+            (name, path, month_start, month_end, rows, int(time.time())),
+        )
+        db.commit(w)
+    partition_stats["sealed"] += 1
+    logger.info("sealed %s (%s events) into %s", name, rows, path)
+    return drain_partition(name, month_start, month_end)
+
+
+def drain_partition(name: str, min_ts: int, max_ts: int) -> bool:
+    """يمسح شهر مختوم من events على دفعات صغيرة عشان /track ما يستنى الكاتب طويل."""
+    while not _stop_event.is_set():
+        with db.writer() as w:
+            deleted = w.execute(
+                """
+                DELETE FROM events WHERE id IN (
+                    SELECT id FROM events WHERE created_at >= ? AND created_at < ? LIMIT ?
+                )
+                """,
+                (min_ts, max_ts, PARTITION_DELETE_CHUNK),
+            ).rowcount
+            if not deleted:
+                w.execute("UPDATE event_partitions SET state = 'sealed' WHERE name = ?", (name,))
+            db.commit(w)
+        if not deleted:
+            return True
+        partition_stats["rows_moved"] += deleted
+    return False
+
+
+def apply_retention(conn):
+    """يأرشف (gzip) أو يمسح الأجزاء الأقدم من RETENTION_MONTHS. ما يلمس events ولا الكاتب إلا لتحديث السجل."""
+    cur = conn.cursor()
+    # بقايا ملفات لأجزاء انأرشفت قبل ما السيرفر يطفي
+    for (path,) in cur.execute(
+        "SELECT path FROM event_partitions WHERE state IN ('archived', 'dropped')"
+    ).fetchall():
+        if os.path.exists(path):
+            os.remove(path)
+
+    if RETENTION_MONTHS <= 0:
+        return
+    cutoff = _add_months(_month_start(int(time.time())), -RETENTION_MONTHS)
+    expired = cur.execute(
+        "SELECT name, path FROM event_partitions WHERE state = 'sealed' AND max_ts <= ? ORDER BY min_ts",
+        (cutoff,),
+    ).fetchall()
+    for name, path in expired:
+        if _stop_event.is_set():
+            return
+        archive_path = None
+        if RETENTION_ACTION == "archive":
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            archive_path = os.path.join(ARCHIVE_DIR, os.path.basename(path) + ".gz")
+            with open(path, "rb") as src, gzip.open(archive_path + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(archive_path + ".tmp", archive_path)
+        state = "archived" if archive_path else "dropped"
+        with db.writer() as w:
+            w.execute(
+                "UPDATE event_partitions SET state = ?, archive_path = ? WHERE name = ?",
+                (state, archive_path, name),
+            )
+            db.commit(w)
+        # القرّاء اللي لسا رابطينه يكملوا عادي؛ المساحة ترجع لما يفكوه
+        os.remove(path)
+        partition_stats[state] += 1
+        logger.info("partition %s %s", name, state)
+
+
+def maintain_partitions(conn):
+    """جولة وحدة: يكمل تفريغ أي جزء علق، يختم الأشهر المكتملة من الأقدم، ويطبق الـ retention."""
+    started = time.perf_counter()
+    cur = conn.cursor()
+    try:
+        for name, min_ts, max_ts in cur.execute(
+            "SELECT name, min_ts, max_ts FROM event_partitions WHERE state = 'draining'"
+        ).fetchall():
+            drain_partition(name, min_ts, max_ts)
+
+        cutoff = _month_start(int(time.time()) - PARTITION_SEAL_GRACE_S)
+        while not _stop_event.is_set():
+            oldest = cur.execute("SELECT MIN(created_at) FROM events").fetchone()[0]
+            if oldest is None or oldest >= cutoff:
+                break
+            if not seal_month(conn, _month_start(oldest)):
+                break
+
+        apply_retention(conn)
+        partition_stats["last_error"] = None
+    except Exception as e:
+        partition_stats["last_error"] = str(e)
+        raise
+    finally:
+        partition_stats["runs"] += 1
+        partition_stats["last_run_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+
+# استدعاء إنشاء / تحديث الجداول عند تشغيل السيرفر
+init_db()
+
+
+# -------- نماذج البيانات (Pydantic) --------
+class EventIn(BaseModel):
+    event: str
+    session_id: str
+    device_id: str
+
+    # id يولده السكربت لكل حدث؛ إعادة إرسال نفس الحدث ما تنكتب مرتين
+    event_id: Optional[str] = Field(None, max_length=EVENT_ID_MAX_LENGTH)
+
+    url: Optional[str] = None
+    referrer: Optional[str] = None
+    user_agent: Optional[str] = None
+
+    traffic_source: Optional[str] = None  # direct / referral / whatsapp / etc
+    utm_source: Optional[str] = None
+    utm_medium: Optional[str] = None
+    utm_campaign: Optional[str] = None
+    utm_content: Optional[str] = None
+
+    # حقول إضافية من السكربت
+    geo_country: Optional[str] = None
+    geo_city: Optional[str] = None
+    session_pages: Optional[int] = None
+    session_duration_ms: Optional[int] = None
+    template_name: Optional[str] = None
+    timestamp: Optional[int] = None  # لو حابب تستقبله من الفرونت فقط، بدون تخزين
+
+    meta: Optional[Dict[str, Any]] = None  # أي بيانات إضافية (product_id, value...)
+
+    @field_validator("event_id")
+    @classmethod
+    def _blank_event_id(cls, v):
+        # "" أو مسافات = ما في id (بيتخزن NULL وما بيدخل بمنع التكرار)
+        return v if v and v.strip() else None
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def _timed(cls, data, handler):
+        # مرحلة validate بـ /metrics (لـ /track و /track/batch)
+        with ingest_stage_seconds.time("validate"):
+            return handler(data)
+
+
+# -------- تحليل user_agent لاستخراج نوع الجهاز والنظام والمتصفح --------
+UA_FIELDS = (
+    "device_type",
+    "device_brand",
+    "device_model",
+    "os_name",
+    "os_version",
+    "browser_name",
+    "browser_version",
+)
+
+_UA_SAMSUNG_MODEL_RE = re.compile(r"(sm-[a-z0-9]+)")
+_UA_ANDROID_VERSION_RE = re.compile(r"android\s+([\d\.]+)")
+_UA_IOS_VERSION_RE = re.compile(r"os\s+([\d\_]+)")
+_UA_BROWSER_VERSION_RES = {
+    "Chrome": re.compile(r"chrome/([\d\.]+)"),
+    "Safari": re.compile(r"version/([\d\.]+)"),
+    "Firefox": re.compile(r"firefox/([\d\.]+)"),
+    "Edge": re.compile(r"edg/([\d\.]+)"),
+    "Opera": re.compile(r"(?:opr|opera)/([\d\.]+)"),
+}
+
+
+def _parse_user_agent(ua: Optional[str]) -> Dict[str, Optional[str]]:
+    info = {
+        "device_type": None,
+        "device_brand": None,
+        "device_model": None,
+        "os_name": None,
+        "os_version": None,
+        "browser_name": None,
+        "browser_version": None,
+    }
+    if not ua:
+        return info
+
+    ua_l = ua.lower()
+
+    # نوع الجهاز + الماركة الأساسية
+    if "iphone" in ua_l:
+        info["device_type"] = "Phone"
+        info["device_brand"] = "Apple"
+        info["device_model"] = "iPhone"
+        info["os_name"] = "iOS"
+    elif "ipad" in ua_l:
+        info["device_type"] = "Tablet"
+        info["device_brand"] = "Apple"
+        info["device_model"] = "iPad"
+        info["os_name"] = "iPadOS"
+    elif "android" in ua_l:
+        # موبايل أو تابلت
+        if "mobile" in ua_l:
+            info["device_type"] = "Phone"
+        elif "tablet" in ua_l:
+            info["device_type"] = "Tablet"
+        else:
+            info["device_type"] = "Android Device"
+        info["os_name"] = "Android"
+
+        # محاولة اكتشاف الماركة
+        if "samsung" in ua_l or "sm-" in ua_l:
+            info["device_brand"] = "Samsung"
+        elif "huawei" in ua_l:
+            info["device_brand"] = "Huawei"
+        elif "xiaomi" in ua_l or "redmi" in ua_l or "mi " in ua_l:
+            info["device_brand"] = "Xiaomi"
+        elif "oppo" in ua_l:
+            info["device_brand"] = "Oppo"
+        elif "vivo" in ua_l:
+            info["device_brand"] = "Vivo"
+        elif "realme" in ua_l:
+            info["device_brand"] = "Realme"
+        elif "infinix" in ua_l:
+            info["device_brand"] = "Infinix"
+        elif "tecno" in ua_l:
+            info["device_brand"] = "Tecno"
+        elif "motorola" in ua_l or "moto g" in ua_l:
+            info["device_brand"] = "Motorola"
+
+        # محاولة بسيطة لاستخراج موديل (مثلاً SM-A146P)
+        m = _UA_SAMSUNG_MODEL_RE.search(ua_l)
+        if m:
+            info["device_model"] = m.group(1).upper()
+    else:
+        # Desktop / Laptop
+        if "windows" in ua_l:
+            info["device_type"] = "Desktop"
+            info["os_name"] = "Windows"
+        elif "macintosh" in ua_l or "mac os" in ua_l:
+            info["device_type"] = "Desktop"
+            info["os_name"] = "macOS"
+            info["device_brand"] = "Apple"
+        elif "linux" in ua_l:
+            info["device_type"] = "Desktop"
+            info["os_name"] = "Linux"
+
+    # استخراج نسخة النظام (بسيطة جداً)
+    if info["os_name"] == "Android":
+        m = _UA_ANDROID_VERSION_RE.search(ua_l)
+        if m:
+            info["os_version"] = m.group(1)
+    elif info["os_name"] in ("iOS", "iPadOS"):
+        m = _UA_IOS_VERSION_RE.search(ua_l)
+        if m:
+            info["os_version"] = m.group(1).replace("_", ".")
+
+    # المتصفح
+    browser_name = None
+    if "edg" in ua_l:
+        browser_name = "Edge"
+    elif "opr" in ua_l or "opera" in ua_l:
+        browser_name = "Opera"
+    elif "chrome" in ua_l and "safari" in ua_l:
+        browser_name = "Chrome"
+    elif "safari" in ua_l and "chrome" not in ua_l:
+        browser_name = "Safari"
+    elif "firefox" in ua_l:
+        browser_name = "Firefox"
+
+    info["browser_name"] = browser_name
+
+    if browser_name:
+        # محاولة جلب النسخة
+        pat = _UA_BROWSER_VERSION_RES.get(browser_name)
+        if pat:
+            m = pat.search(ua_l)
+            if m:
+                info["browser_version"] = m.group(1)
+
+    return info
+
+
+# كل جهاز يرسل نفس الـ UA مع كل حدث، وعدد الـ UAs المختلفة قليل، فنحفظ النتيجة.
+# lru_cache آمن مع الخيوط؛ القيمة tuple عشان ما حد يعدلها بالغلط.
+@functools.lru_cache(maxsize=UA_CACHE_SIZE)
+def ua_fingerprint(ua: Optional[str]) -> Tuple[Optional[str], ...]:
+    info = _parse_user_agent(ua)
+    return tuple(info[f] for f in UA_FIELDS)
+
+
+def parse_user_agent(ua: Optional[str]) -> Dict[str, Optional[str]]:
+    return dict(zip(UA_FIELDS, ua_fingerprint(ua)))
+
+
+def ua_cache_stats() -> Dict[str, int]:
+    info = ua_fingerprint.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        # كل miss يضيف عنصر، فاللي مش موجود حالياً انطرد
+        "evictions": max(info.misses - info.currsize, 0),
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
+
+
+# -------- منطق التتبع الداخلي --------
+# كل upsert عبارة عن جملة INSERT ... ON CONFLICT DO UPDATE وحدة بدل SELECT ثم INSERT/UPDATE،
+# فما في سباق بين طلبين لنفس الجهاز الجديد. النسخ المتعددة (upsert_devices / upsert_sessions)
+# تكتب صفوف كثيرة في جملة وحدة للدفعات.
+
+# عدد الصفوف في جملة VALUES وحدة (حد SQLite لعدد المتغيرات 32766)
+UPSERT_CHUNK_ROWS = 500
+
+DEVICE_UPSERT_SQL = """
+    INSERT INTO devices (
+        device_id,
+        first_seen,
+        last_seen,
+        is_whatsapp,
+        device_type,
+        device_brand,
+        device_model,
+        os_name,
+        os_version,
+        browser_name,
+        browser_version
+    )
+    VALUES {values}
+    ON CONFLICT(device_id) DO UPDATE SET
+        last_seen = excluded.last_seen,
+        is_whatsapp = CASE
+            WHEN devices.is_whatsapp = 1 OR excluded.is_whatsapp = 1 THEN 1
+            ELSE 0
+        END,
+        device_type = excluded.device_type,
+        device_brand = excluded.device_brand,
+        device_model = excluded.device_model,
+        os_name = excluded.os_name,
+        os_version = excluded.os_version,
+        browser_name = excluded.browser_name,
+        browser_version = excluded.browser_version
+"""
+
+# نفس الـ upsert بس بدون أعمدة الـ UA، للأجهزة اللي تحليل الـ UA تبعها ما تغير
+DEVICE_TOUCH_SQL = """
+    INSERT INTO devices (
+        device_id,
+        first_seen,
+        last_seen,
+        is_whatsapp,
+        device_type,
+        device_brand,
+        device_model,
+        os_name,
+        os_version,
+        browser_name,
+        browser_version
+    )
+    VALUES {values}
+    ON CONFLICT(device_id) DO UPDATE SET
+        last_seen = excluded.last_seen,
+        is_whatsapp = CASE
+            WHEN devices.is_whatsapp = 1 OR excluded.is_whatsapp = 1 THEN 1
+            ELSE 0
+        END
+"""
+
+# الجلسة الموجودة يتحدث لها last_seen فقط، والباقي (first_seen والمصدر) يبقى من أول حدث
+SESSION_UPSERT_SQL = """
+    INSERT INTO sessions (
+        session_id, device_id,
+        first_seen, last_seen,
+        traffic_source,
+        utm_source_id, utm_medium_id, utm_campaign_id, utm_content_id,
+        referrer_first_id, user_agent_first_id
+    )
+    VALUES {values}
+    ON CONFLICT(session_id) DO UPDATE SET
+        last_seen = excluded.last_seen
+"""
+
+
+def _values_clause(n_rows: int, n_cols: int) -> str:
+    row = "(" + ", ".join(["?"] * n_cols) + ")"
+    return ", ".join([row] * n_rows)
+
+
+def _execute_upsert(cur, sql_template: str, rows: List[tuple]):
+    if not rows:
+        return
+    n_cols = len(rows[0])
+    for i in range(0, len(rows), UPSERT_CHUNK_ROWS):
+        chunk = rows[i:i + UPSERT_CHUNK_ROWS]
+        params = [v for row in chunk for v in row]
+        cur.execute(sql_template.format(values=_values_clause(len(chunk), n_cols)), params)
+
+
+class EntityCache:
+    """
+    key → آخر حالة مكتوبة، بترتيب آخر كتابة (LRU) مع TTL وحد أقصى للعناصر.
+    ما يتعدل إلا تحت lock الكاتب (من on_commit)، فما يحتاج lock خاص.
+    """
+
+    # تقدير تقريبي لحجم العنصر (المفتاح + tuple الحالة + OrderedDict) لعرضه في /status
+    APPROX_ENTRY_BYTES = 320
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[str, Tuple[float, tuple]]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def get(self, key: str) -> Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        stored_at, state = entry
+        if time.monotonic() - stored_at > self.ttl_s:
+            del self._data[key]
+            self.counters["expired"] += 1
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return state
+
+    def put_many(self, items: Dict[str, tuple]):
+        now = time.monotonic()
+        for key, state in items.items():
+            self._data[key] = (now, state)
+            self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.counters["evicted"] += 1
+        # الأقدم بالأول، فنوقف عند أول عنصر لسه صالح
+        while self._data:
+            stored_at, _ = next(iter(self._data.values()))
+            if now - stored_at <= self.ttl_s:
+                break
+            self._data.popitem(last=False)
+            self.counters["expired"] += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "approx_bytes": len(self._data) * self.APPROX_ENTRY_BYTES,
+        }
+
+
+# device_id → (last_seen, is_whatsapp, ua_fingerprint)
+device_cache = EntityCache(ENTITY_CACHE_MAX_ENTRIES, ENTITY_CACHE_TTL_S)
+# session_id → (last_seen,)
+session_cache = EntityCache(ENTITY_CACHE_MAX_ENTRIES, ENTITY_CACHE_TTL_S)
+# آخر نسخة مكتوبة من sketches العدّ التقريبي: key → (registers,)
+sketch_cache = EntityCache(HLL_CACHE_SKETCHES, float("inf"))
+
+
+def upsert_devices(cur, rows: List[tuple]):
+    """
+    rows: قائمة (device_id, now_ts, traffic_source, user_agent).
+    الجهاز المتكرر في الدفعة ينكتب صف واحد: first_seen من أول صف، والـ UA من آخر صف.
+    بعدها حسب device_cache: UA تغير → upsert كامل، واتساب جديد أو last_seen قديم
+    → DEVICE_TOUCH_SQL، غير هيك ما نكتب شي.
+    """
+    merged: Dict[str, list] = {}
+    for device_id, now_ts, traffic_source, user_agent in rows:
+        is_whatsapp = 1 if (traffic_source == "whatsapp") else 0
+        item = merged.get(device_id)
+        if item is None:
+            merged[device_id] = [now_ts, now_ts, is_whatsapp, user_agent]
+        else:
+            item[1] = max(item[1], now_ts)
+            item[2] = item[2] or is_whatsapp
+            item[3] = user_agent
+
+    with ingest_stage_seconds.time("user_agent"):
+        fingerprints = {device_id: ua_fingerprint(item[3]) for device_id, item in merged.items()}
+
+    devices_started = time.perf_counter()
+    full, touch = [], []
+    written: Dict[str, tuple] = {}
+    for device_id, (first_ts, last_ts, is_whatsapp, user_agent) in merged.items():
+        fp = fingerprints[device_id]
+        cached = device_cache.get(device_id)
+        if cached is None or cached[2] != fp:
+            target = full
+        elif is_whatsapp and not cached[1]:
+            target = touch
+        elif last_ts - cached[0] >= LAST_SEEN_RESOLUTION_S:
+            target = touch
+        else:
+            continue
+        target.append((device_id, first_ts, last_ts, is_whatsapp) + fp)
+        written[device_id] = (last_ts, is_whatsapp or (cached[1] if cached else 0), fp)
+
+    _execute_upsert(cur, DEVICE_UPSERT_SQL, full)
+    _execute_upsert(cur, DEVICE_TOUCH_SQL, touch)
+    ingest_stage_seconds.observe(time.perf_counter() - devices_started, "devices")
+
+    # بعد الـ commit بس: دفعة فشلت وانعادت حدث حدث ما بتنعد مرتين
+    def count():
+        with _ingest_stats_lock:
+            ingest_stats["device_rows"] += len(rows)
+            ingest_stats["device_writes"] += len(full) + len(touch)
+            ingest_stats["ua_columns_skipped"] += len(touch)
+
+    db.on_commit(count)
+    db.on_commit(lambda: device_cache.put_many(written))
+
+
+def upsert_sessions(cur, rows: List[tuple]):
+    """
+    rows: قائمة (session_id, device_id, now_ts, traffic_source,
+                 utm_source_id, utm_medium_id, utm_campaign_id, utm_content_id,
+                 referrer_id, user_agent_id) — الـ ids من string_table.
+    الجلسة المتكررة في الدفعة تاخذ بياناتها من أول صف و last_seen من آخر صف،
+    وما تنكتب لو last_seen المكتوب أحدث من LAST_SEEN_RESOLUTION_S.
+    """
+    merged: Dict[str, list] = {}
+    for row in rows:
+        session_id, now_ts = row[0], row[2]
+        item = merged.get(session_id)
+        if item is None:
+            merged[session_id] = [row, now_ts]
+        else:
+            item[1] = max(item[1], now_ts)
+
+    params = []
+    written: Dict[str, tuple] = {}
+    for session_id, (row, last_ts) in merged.items():
+        cached = session_cache.get(session_id)
+        if cached is not None and last_ts - cached[0] < LAST_SEEN_RESOLUTION_S:
+            continue
+        (
+            _,
+            device_id,
+            first_ts,
+            traffic_source,
+            utm_source_id,
+            utm_medium_id,
+            utm_campaign_id,
+            utm_content_id,
+            referrer_id,
+            user_agent_id,
+        ) = row
+        params.append(
+            (
+                session_id,
+                device_id,
+                first_ts,
+                last_ts,
+                traffic_source,
+                utm_source_id,
+                utm_medium_id,
+                utm_campaign_id,
+                utm_content_id,
+                referrer_id,
+                user_agent_id,
+            )
+        )
+        written[session_id] = (last_ts,)
+
+    _execute_upsert(cur, SESSION_UPSERT_SQL, params)
+
+    def count():
+        with _ingest_stats_lock:
+            ingest_stats["session_rows"] += len(rows)
+            ingest_stats["session_writes"] += len(params)
+
+    db.on_commit(count)
+    db.on_commit(lambda: session_cache.put_many(written))
+
+
+EVENT_INSERT_SQL = """
+    INSERT INTO events (
+        event, session_id, device_id,
+        url_id, referrer_id, user_agent_id,
+        traffic_source,
+        utm_source_id, utm_medium_id, utm_campaign_id, utm_content_id,
+        created_at, meta,
+        geo_country, geo_city,
+        session_pages, session_duration_ms,
+        template_name,
+        product_id, product_title, value, currency, quantity,
+        event_id
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# -------- عدادات realtime بالذاكرة --------
+class RealtimeCounters:
+    """
+    آخر max_window_s ثانية بالذاكرة، تتغذى بعد كل commit من مسار الكتابة:
+    - ring بعدد الأحداث لكل ثانية
+    - لكل جلسة/جهاز آخر ثانية ظهر فيها (OrderedDict بترتيب آخر ظهور)، و ring بعدد
+      الـ ids اللي آخر ظهور إلهم بهاي الثانية
+    فعدد النشطين بأي نافذة = مجموع الـ ring على ثوانيها، O(window) بدون SQLite.
+    بيشوف بس الكتابات اللي صارت بهاي العملية ومن وقت ما اشتغلت (since)؛
+    أي نافذة أقدم من since ترجع لـ SQL.
+    """
+
+    KINDS = ("session", "device")
+
+    def __init__(self, max_window_s: int):
+        self.size = max_window_s
+        self.since = int(time.time()) + 1
+        self._lock = threading.Lock()
+        self._stamps = [-1] * max_window_s
+        self._events = [0] * max_window_s
+        self._active = {kind: [0] * max_window_s for kind in self.KINDS}
+        self._last_seen: Dict[str, "OrderedDict[str, int]"] = {kind: OrderedDict() for kind in self.KINDS}
+        self.counters = {"memory": 0, "sqlite": 0}
+
+    def _slot(self, second: int) -> int:
+        slot = second % self.size
+        if self._stamps[slot] != second:
+            self._stamps[slot] = second
+            self._events[slot] = 0
+            for ring in self._active.values():
+                ring[slot] = 0
+        return slot
+
+    def record(self, rows: List[Tuple[int, str, str]]):
+        """rows: (created_at, session_id, device_id)."""
+        with self._lock:
+            for created_at, session_id, device_id in rows:
+                self._events[self._slot(created_at)] += 1
+                for kind, key in (("session", session_id), ("device", device_id)):
+                    if key:
+                        self._touch(kind, key, created_at)
+            horizon = int(time.time()) - self.size
+            for seen in self._last_seen.values():
+                while seen and next(iter(seen.values())) < horizon:
+                    seen.popitem(last=False)
+
+    def _touch(self, kind: str, key: str, second: int):
+        seen = self._last_seen[kind]
+        ring = self._active[kind]
+        previous = seen.get(key)
+        if previous is not None:
+            if previous >= second:
+                return
+            slot = previous % self.size
+            if self._stamps[slot] == previous:
+                ring[slot] -= 1
+        seen[key] = second
+        seen.move_to_end(key)
+        ring[self._slot(second)] += 1
+
+    def window(self, now_ts: int, threshold: int) -> Optional[Dict[str, int]]:
+        """(أحداث، جلسات، أجهزة) من threshold لـ now_ts، أو None لو لازم SQL."""
+        if threshold < self.since or now_ts - threshold >= self.size:
+            self.counters["sqlite"] += 1
+            return None
+        totals = {"events": 0, "session": 0, "device": 0}
+        with self._lock:
+            for second in range(threshold, now_ts + 1):
+                slot = second % self.size
+                if self._stamps[slot] != second:
+                    continue
+                totals["events"] += self._events[slot]
+                for kind in self.KINDS:
+                    totals[kind] += self._active[kind][slot]
+        self.counters["memory"] += 1
+        return totals
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "ring_seconds": self.size,
+            "since": self.since,
+            "sessions_tracked": len(self._last_seen["session"]),
+            "devices_tracked": len(self._last_seen["device"]),
+        }
+
+
+realtime_counters = (
+    # +1 لأن النافذة تشمل الثانية الحالية
+    RealtimeCounters(REALTIME_MAX_WINDOW_MINUTES * 60 + 1) if REALTIME_MAX_WINDOW_MINUTES else None
+)
+
+
+# -------- منع التكرار (event_id) --------
+class DedupeWindow:
+    """
+    آخر event_id انكتبوا (LRU). الكاتب يضيف بعد الـ commit، والـ endpoints تفحص قبل
+    ما يوصل الحدث للكاتب، فالـ lock لأنه ينقرأ من أكثر من خيط.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, event_id: Optional[str]) -> bool:
+        if not event_id:
+            return False
+        with self._lock:
+            return event_id in self._ids
+
+    def add_many(self, event_ids: List[str]):
+        with self._lock:
+            for event_id in event_ids:
+                self._ids[event_id] = None
+                self._ids.move_to_end(event_id)
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._ids), "max_entries": self.max_entries}
+
+
+dedupe_window = DedupeWindow(DEDUPE_WINDOW_SIZE)
+
+
+def find_duplicates(cur, batch: List[Tuple[EventIn, int]]) -> List[bool]:
+    """
+    لكل حدث: هل انكتب قبل هيك؟ (نفس event_id بالنافذة، أو مكرر جوا الدفعة، أو موجود
+    بـ events الحي؛ الأجزاء المختومة لا). الجديدة تنضاف للنافذة بعد الـ commit.
+    """
+    flags = [False] * len(batch)
+    pending: Dict[str, int] = {}
+    for i, (payload, _) in enumerate(batch):
+        event_id = payload.event_id
+        if not event_id:
+            continue
+        if event_id in pending or event_id in dedupe_window:
+            flags[i] = True
+        else:
+            pending[event_id] = i
+    if not pending:
+        return flags
+
+    # النافذة ما فيها إلا اللي انكتب من هالعملية؛ بعد restart أو لما تمتلي نسأل الفهرس
+    ids = list(pending)
+    for start in range(0, len(ids), UPSERT_CHUNK_ROWS):
+        chunk = ids[start:start + UPSERT_CHUNK_ROWS]
+        cur.execute(
+            # نفس شرط الفهرس الجزئي uq_events_event_id، وإلا SQLite ما بيستعمله
+            f"SELECT event_id FROM events WHERE event_id IN ({','.join('?' * len(chunk))}) AND event_id <> ''",
+            chunk,
+        )
+        for (event_id,) in cur.fetchall():
+            flags[pending.pop(event_id)] = True
+    if pending:
+        new_ids = list(pending)
+        db.on_commit(lambda: dedupe_window.add_many(new_ids))
+    return flags
+
+
+def write_events(cur, batch: List[Tuple[EventIn, int]]) -> List[bool]:
+    """
+    يكتب دفعة (payload, now_ts): upsert واحد للأجهزة، واحد للجلسات، و executemany للأحداث.
+    يرجع لكل حدث True لو كان مكرر (event_id انكتب قبل) وما انكتب.
+    """
+    # المكرر يطلع قبل أي كتابة، فما يدخل بالـ rollups ولا الجلسات
+    with ingest_stage_seconds.time("dedupe"):
+        duplicates = find_duplicates(cur, batch)
+    if any(duplicates):
+        batch = [item for item, duplicate in zip(batch, duplicates) if not duplicate]
+        if not batch:
+            return duplicates
+
+    # 0) النصوص المتكررة → ids
+    with ingest_stage_seconds.time("strings"):
+        ids = string_table.intern_many(
+            cur,
+            (getattr(payload, col) for payload, _ in batch for col in EVENT_STRING_COLUMNS),
+        )
+
+    # 1) تحديث / إضافة الأجهزة (مع user_agent؛ المرحلتين user_agent و devices جوا)
+    upsert_devices(
+        cur,
+        [
+            (payload.device_id, now_ts, payload.traffic_source, payload.user_agent)
+            for payload, now_ts in batch
+        ],
+    )
+
+    # 2) تحديث / إضافة الجلسات
+    with ingest_stage_seconds.time("sessions"):
+        upsert_sessions(
+            cur,
+            [
+                (
+                    payload.session_id,
+                    payload.device_id,
+                    now_ts,
+                    payload.traffic_source,
+                    ids.get(payload.utm_source),
+                    ids.get(payload.utm_medium),
+                    ids.get(payload.utm_campaign),
+                    ids.get(payload.utm_content),
+                    ids.get(payload.referrer),
+                    ids.get(payload.user_agent),
+                )
+                for payload, now_ts in batch
+            ],
+        )
+
+    # 3) تحديث الـ rollups بنفس الـ transaction
+    with ingest_stage_seconds.time("rollups"):
+        update_rollups(
+            cur,
+            [(now_ts, payload.traffic_source, payload.event) for payload, now_ts in batch],
+        )
+
+    # 4) sketches العدّ التقريبي
+    with ingest_stage_seconds.time("sketches"):
+        update_sketches(
+            cur,
+            [
+                (
+                    now_ts,
+                    payload.traffic_source,
+                    payload.event,
+                    payload.geo_country,
+                    payload.geo_city,
+                    payload.session_id,
+                    payload.device_id,
+                )
+                for payload, now_ts in batch
+            ],
+        )
+
+    # 5) عدادات realtime (بعد الـ commit بس)
+    if realtime_counters is not None:
+        rows = [(now_ts, payload.session_id, payload.device_id) for payload, now_ts in batch]
+        db.on_commit(lambda: realtime_counters.record(rows))
+
+    # 6) البث المباشر (بس لو في مشتركين)
+    if live_stream.active:
+        deltas = [
+            (payload.event, payload.traffic_source, payload.geo_country) for payload, _ in batch
+        ]
+        db.on_commit(lambda: live_stream.record(deltas))
+
+    # 7) تخزين الأحداث نفسها
+    with ingest_stage_seconds.time("insert"):
+        cur.executemany(
+            EVENT_INSERT_SQL,
+            [
+                (
+                    payload.event,
+                    payload.session_id,
+                    payload.device_id,
+                    ids.get(payload.url),
+                    ids.get(payload.referrer),
+                    ids.get(payload.user_agent),
+                    payload.traffic_source,
+                    ids.get(payload.utm_source),
+                    ids.get(payload.utm_medium),
+                    ids.get(payload.utm_campaign),
+                    ids.get(payload.utm_content),
+                    now_ts,
+                    json_dumps(payload.meta or {}),
+                    payload.geo_country,
+                    payload.geo_city,
+                    payload.session_pages,
+                    payload.session_duration_ms,
+                    payload.template_name,
+                )
+                + extract_meta_fields(payload.meta)
+                + (payload.event_id,)
+                for payload, now_ts in batch
+            ],
+        )
+
+    # 8) watermark كاش /stats: آخر id انكتب (الأحداث آخر insert بالدفعة)
+    last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+    db.on_commit(lambda: stats_cache.advance(last_id))
+    return duplicates
+
+
+def write_event(cur, payload: EventIn, now_ts: int) -> bool:
+    return write_events(cur, [(payload, now_ts)])[0]
+
+
+# -------- الكاتب الخلفي (write-behind) --------
+_ingest_queue: "queue.Queue" = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+_ingest_thread: Optional[threading.Thread] = None
+_INGEST_STOP = object()
+
+_ingest_stats_lock = threading.Lock()
+ingest_stats = {
+    "accepted": 0,
+    "rejected": 0,
+    "written": 0,
+    "failed": 0,
+    "batches": 0,
+    "last_batch_size": 0,
+    "last_batch_ms": 0.0,
+    "ua_columns_skipped": 0,
+    "device_rows": 0,
+    "device_writes": 0,
+    "session_rows": 0,
+    "session_writes": 0,
+    # أحداث بـ event_id انكتب قبل (كلها)، ومنها اللي انرفضت من النافذة قبل ما توصل للكاتب
+    "duplicates": 0,
+    "duplicates_window": 0,
+}
+
+
+def _bump(key: str, value=1):
+    with _ingest_stats_lock:
+        ingest_stats[key] += value
+
+
+# بمكان الخطأ بنتيجة apply_batch: الحدث انكتب قبل هيك (نفس event_id)، وهذا مش فشل
+DUPLICATE_EVENT = "duplicate"
+
+
+def apply_batch(conn, batch: List[Tuple[EventIn, int]]) -> List[Optional[str]]:
+    """
+    يكتب دفعة أحداث (الأجهزة + الجلسات + الأحداث) في transaction واحدة.
+    لو فشلت الدفعة كاملة نرجع نكتب كل حدث لوحده عشان حدث واحد خربان
+    ما يضيّع باقي الدفعة. يرجع لكل حدث None لو انكتب، DUPLICATE_EVENT لو كان
+    مكرر، أو نص الخطأ.
+    """
+    started = time.perf_counter()
+    cur = conn.cursor()
+    errors: List[Optional[str]] = [None] * len(batch)
+    try:
+        duplicates = write_events(cur, batch)
+        db.commit(conn)
+        for i, duplicate in enumerate(duplicates):
+            if duplicate:
+                errors[i] = DUPLICATE_EVENT
+    except Exception as e:
+        db.rollback(conn)
+        count_locked(e, "writer")
+        logger.exception("ingest batch failed, retrying events one by one")
+        for i, (payload, now_ts) in enumerate(batch):
+            try:
+                duplicate = write_event(cur, payload, now_ts)
+                db.commit(conn)
+                if duplicate:
+                    errors[i] = DUPLICATE_EVENT
+            except Exception as e:
+                db.rollback(conn)
+                count_locked(e, "writer")
+                errors[i] = str(e)
+                logger.exception("dropping event %s", payload.event)
+
+    duplicates_count = errors.count(DUPLICATE_EVENT)
+    failed = sum(1 for e in errors if e is not None) - duplicates_count
+    with _ingest_stats_lock:
+        ingest_stats["written"] += len(batch) - failed - duplicates_count
+        ingest_stats["duplicates"] += duplicates_count
+        ingest_stats["failed"] += failed
+        ingest_stats["batches"] += 1
+        ingest_stats["last_batch_size"] = len(batch)
+        ingest_stats["last_batch_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return errors
+
+
+def _ingest_worker():
+    flush_s = INGEST_FLUSH_MS / 1000
+    stopping = False
+    while not stopping:
+        item = _ingest_queue.get()
+        if item is _INGEST_STOP:
+            break
+        batch = [item]
+
+        # نجمع لحد ما توصل الدفعة للحجم أو يخلص الوقت
+        deadline = time.monotonic() + flush_s
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _ingest_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _INGEST_STOP:
+                stopping = True
+                break
+            batch.append(item)
+
+        with db.writer() as conn:
+            apply_batch(conn, batch)
+
+
+# -------- مصدّر Parquet (events / sessions / devices) --------
+# events ينصدّر بالترتيب حسب id من آخر id انصدّر (app_meta: export_events_id)، مقسم باليوم:
+#   EXPORT_DIR/events/day=YYYY-MM-DD/part-<أول id>.parquet
+# لو السيرفر طفى بعد كتابة الملف وقبل حفظ الـ id، الجولة الجاية تبدأ من نفس الـ id وتكتب
+# نفس اسم الملف فوقه، فما في تكرار. ملفات الأيام اللي خلصت تندمج بملف واحد.
+# sessions و devices تتعدل، فتنكتب لقطة كاملة (sessions.parquet / devices.parquet).
+EXPORT_EVENT_COLUMNS = (
+    "id", "event", "session_id", "device_id",
+    "url", "referrer", "user_agent", "traffic_source",
+    "utm_source", "utm_medium", "utm_campaign", "utm_content",
+    "created_at", "meta", "geo_country", "geo_city",
+    "session_pages", "session_duration_ms", "template_name",
+    "product_id", "product_title", "value", "currency", "quantity",
+)
+EXPORT_SESSION_COLUMNS = (
+    "id", "session_id", "device_id", "first_seen", "last_seen", "traffic_source",
+    "utm_source", "utm_medium", "utm_campaign", "utm_content",
+    "referrer_first", "user_agent_first",
+)
+EXPORT_DEVICE_COLUMNS = ("id", "device_id", "first_seen", "last_seen", "is_whatsapp") + UA_FIELDS
+# أي عمود مش هون نصي
+EXPORT_INT_COLUMNS = {
+    "id", "created_at", "session_pages", "session_duration_ms", "quantity",
+    "first_seen", "last_seen", "is_whatsapp",
+}
+
+export_stats = {
+    "runs": 0,
+    "events_exported": 0,
+    "last_event_id": None,
+    "files_written": 0,
+    "days_compacted": 0,
+    "snapshots": 0,
+    "last_run_ms": 0.0,
+    "last_error": None,
+    # GET /events/export
+    "http_exports": 0,
+    "http_rows": 0,
+}
+
+
+def _export_schema(columns: Tuple[str, ...]):
+    # نوع ثابت لكل عمود، عشان ملف كل أعمدته NULL ما يطلع بنوع null ويخرب قراءة الـ dataset
+    def arrow_type(col):
+        if col in EXPORT_INT_COLUMNS:
+            return pa.int64()
+        if col == "value":
+            return pa.float64()
+        return pa.string()
+
+    return pa.schema([(col, arrow_type(col)) for col in columns])
+
+
+def _write_parquet(path: str, rows: List[tuple], columns: Tuple[str, ...]):
+    schema = _export_schema(columns)
+    table = pa.Table.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+        schema=schema,
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+    export_stats["files_written"] += 1
+
+
+def _export_events_sql(
+    conn,
+    after_id: int,
+    limit: int,
+    until_id: Optional[int] = None,
+    columns: Tuple[str, ...] = EXPORT_EVENT_COLUMNS,
+) -> str:
+    """
+    الأحداث بعد after_id (ولحد until_id) من events وكل الأجزاء، بالنصوص الأصلية. ORDER BY
+    على مستوى UNION ALL يخلي SQLite يدمج الـ arms حسب المفتاح الأساسي بدون فرز.
+    """
+    cur = conn.cursor()
+    parts = visible_partitions(cur)
+    attach_partitions(conn, parts)
+    where = f"id > {int(after_id)}"
+    if until_id is not None:
+        where += f" AND id <= {int(until_id)}"
+    arms = []
+    for schema, path in [("main", None)] + [(name, path) for name, path, *_ in parts]:
+        have = None if path is None else _partition_columns(cur, schema, path)
+        select = []
+        for col in columns:
+            if col in EVENT_STRING_COLUMNS and (have is None or f"{col}_id" in have):
+                select.append(decoded_column(col))
+            elif have is None or col in have:
+                select.append(col)
+            else:
+                # جزء انختم قبل ما ينضاف العمود
+                select.append(f"NULL AS {col}")
+        arms.append(f"SELECT {', '.join(select)} FROM {schema}.events WHERE {where}")
+    return " UNION ALL ".join(arms) + f" ORDER BY id LIMIT {int(limit)}"
+
+
+def export_events(conn) -> int:
+    """يصدّر الأحداث الجديدة على دفعات EXPORT_BATCH_ROWS؛ يرجع عدد الصفوف."""
+    after_id = int(get_meta(conn.cursor(), "export_events_id", "0"))
+    created_at = EXPORT_EVENT_COLUMNS.index("created_at")
+    exported = 0
+    while not _stop_event.is_set():
+        rows = conn.execute(_export_events_sql(conn, after_id, EXPORT_BATCH_ROWS)).fetchall()
+        if not rows:
+            break
+
+        by_day: Dict[str, List[tuple]] = {}
+        last_id = None
+        for row in rows:
+            # شهر بحالة draining موجود بالجزء وبـ events بنفس الـ ids
+            if row[0] == last_id:
+                continue
+            last_id = row[0]
+            by_day.setdefault(_utc_day(row[created_at] or 0), []).append(row)
+        for day, day_rows in by_day.items():
+            name = f"part-{day_rows[0][0]:012d}.parquet"
+            _write_parquet(os.path.join(EXPORT_DIR, "events", f"day={day}", name), day_rows, EXPORT_EVENT_COLUMNS)
+            exported += len(day_rows)
+
+        after_id = last_id
+        with db.writer() as w:
+            set_meta(w.cursor(), "export_events_id", after_id)
+            db.commit(w)
+        export_stats["last_event_id"] = after_id
+        if len(rows) < EXPORT_BATCH_ROWS:
+            break
+    export_stats["events_exported"] += exported
+    return exported
+
+
+def compact_export_days(before_day: str):
+    """يدمج ملفات كل يوم قبل before_day بملف واحد (الاسم يضل أول ملف، فالـ dataset ما يتغير)."""
+    root = os.path.join(EXPORT_DIR, "events")
+    if not os.path.isdir(root):
+        return
+    for entry in sorted(os.listdir(root)):
+        if not entry.startswith("day=") or entry[4:] >= before_day:
+            continue
+        day_dir = os.path.join(root, entry)
+        files = sorted(f for f in os.listdir(day_dir) if f.endswith(".parquet"))
+        if len(files) < 2:
+            continue
+        table = pa.concat_tables([pq.read_table(os.path.join(day_dir, f)) for f in files])
+        target = os.path.join(day_dir, files[0])
+        pq.write_table(table, target + ".tmp", compression="zstd")
+        # نبدل أول ملف وبعدين نمسح الباقي: لو انقطع بالنص يصير تكرار مش ضياع
+        os.replace(target + ".tmp", target)
+        for f in files[1:]:
+            os.remove(os.path.join(day_dir, f))
+        export_stats["days_compacted"] += 1
+
+
+def export_snapshot(conn, table: str, columns: Tuple[str, ...], string_columns: Tuple[str, ...] = ()):
+    """لقطة كاملة للجدول بملف واحد، تنكتب على دفعات (الذاكرة ثابتة) وتتبدل مرة وحدة."""
+    select = ", ".join(decoded_column(col) if col in string_columns else col for col in columns)
+    path = os.path.join(EXPORT_DIR, f"{table}.parquet")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    schema = _export_schema(columns)
+    cur = conn.execute(f"SELECT {select} FROM {table} ORDER BY id")
+    with pq.ParquetWriter(path + ".tmp", schema, compression="zstd") as writer:
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+            if not rows:
+                break
+            writer.write_table(
+                pa.Table.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                    schema=schema,
+                )
+            )
+    os.replace(path + ".tmp", path)
+    export_stats["files_written"] += 1
+
+
+def run_export(conn, snapshots: bool = True):
+    started = time.perf_counter()
+    try:
+        export_events(conn)
+        # الأحداث بوقت السيرفر: يوم خلص من أكثر من ساعة ما عاد يجيه شي
+        compact_export_days(_utc_day(int(time.time()) - PARTITION_SEAL_GRACE_S))
+        if snapshots:
+            export_snapshot(conn, "sessions", EXPORT_SESSION_COLUMNS, SESSION_STRING_COLUMNS)
+            export_snapshot(conn, "devices", EXPORT_DEVICE_COLUMNS)
+            export_stats["snapshots"] += 1
+        export_stats["last_error"] = None
+    except Exception as e:
+        export_stats["last_error"] = str(e)
+        raise
+    finally:
+        export_stats["runs"] += 1
+        export_stats["last_run_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+
+# -------- محرك الإحصائيات العمودي (STATS_ENGINE=parquet) --------
+# نفس صفوف استعلامات SQLite بالضبط، فالـ endpoints تبني نفس الـ JSON من المحركين.
+def _read_export(name: str, columns: List[str], filter=None):
+    path = os.path.join(EXPORT_DIR, name if name == "events" else f"{name}.parquet")
+    if not os.path.exists(path):
+        schema = _export_schema(EXPORT_EVENT_COLUMNS if name == "events" else EXPORT_DEVICE_COLUMNS)
+        return schema.empty_table().select(columns)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive" if name == "events" else None)
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def _grouped(table, keys: List[str], distinct: str) -> List[tuple]:
+    result = table.group_by(keys).aggregate([(distinct, "count_distinct")])
+    columns = [result.column(k).to_pylist() for k in keys]
+    columns.append(result.column(f"{distinct}_count_distinct").to_pylist())
+    return list(zip(*columns))
+
+
+def _non_empty(column: str):
+    return ds.field(column).is_valid() & (ds.field(column) != "")
+
+
+def parquet_funnel_rows() -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    table = _read_export(
+        "events",
+        ["event", "session_id", "traffic_source", "product_id", "product_title"],
+        ds.field("event").isin(FUNNEL_STEPS) & _non_empty("session_id"),
+    )
+    overall = _grouped(table, ["event"], "session_id")
+
+    # NULL و '' الاثنين unknown، ومع مصدر "unknown" فعلاً بنفس المجموعة (نفس funnel_by_source)
+    source = table.column("traffic_source")
+    source = pc.if_else(pc.fill_null(pc.equal(source, ""), True), "unknown", source)
+    by_source = _grouped(
+        table.select(["event", "session_id"]).append_column("source", source),
+        ["source", "event"],
+        "session_id",
+    )
+
+    with_product = table.filter(pc.is_valid(table.column("product_id")))
+    by_product = _grouped(with_product, ["product_id", "product_title", "event"], "session_id")
+    return overall, by_source, by_product
+
+
+def parquet_geo_rows(column: str) -> List[tuple]:
+    table = _read_export("events", [column, "session_id"], _non_empty(column))
+    return sorted(_grouped(table, [column], "session_id"), key=lambda r: -r[1])
+
+
+def parquet_device_rows(column: str) -> List[tuple]:
+    table = _read_export("devices", [column, "device_id"])
+    # نفس ترتيب GROUP BY في SQLite: NULL أول شي وبعدين حسب القيمة
+    return sorted(_grouped(table, [column], "device_id"), key=lambda r: (r[0] is not None, r[0] or ""))
+
+
+# -------- تجميع الجلسات (sessions materializer) --------
+# الأحداث بعد آخر id انحسب (app_meta: sessions_materialized_id) تنقرأ على دفعات باتصال قراءة
+# (events وكل الأجزاء)، تتجمع لكل جلسة بالذاكرة، وتندمج بصف الجلسة بـ UPDATE واحد. الـ id
+# يتقدم بنفس الـ transaction، فلو السيرفر طفى بالنص ما في حدث ينحسب مرتين ولا يفوت.
+# صفحة الدخول والخروج = url أول وآخر حدث بالجلسة (حسب created_at ثم id)،
+# و funnel_step = أبعد خطوة من FUNNEL_STEPS وصلتها (1..5، و 0 = ولا خطوة).
+SESSION_EVENT_COLUMNS = ("id", "session_id", "event", "created_at", "url_id")
+# الأحداث اللي بتعني فتح صفحة (الباقي أفعال على نفس الصفحة)
+SESSION_PAGEVIEW_EVENTS = frozenset(("page_view", "product_view", "cart_view"))
+
+SESSION_MERGE_SQL = """
+    UPDATE sessions SET
+        event_count = event_count + :events,
+        pageviews = pageviews + :pageviews,
+        landing_url_id = CASE
+            WHEN first_event_at IS NULL OR :first_at < first_event_at THEN :landing
+            ELSE landing_url_id END,
+        exit_url_id = CASE
+            WHEN last_event_at IS NULL OR :last_at >= last_event_at THEN :exit
+            ELSE exit_url_id END,
+        first_event_at = MIN(COALESCE(first_event_at, :first_at), :first_at),
+        last_event_at = MAX(COALESCE(last_event_at, :last_at), :last_at),
+        duration_s = MAX(COALESCE(last_event_at, :last_at), :last_at)
+                   - MIN(COALESCE(first_event_at, :first_at), :first_at),
+        funnel_step = MAX(funnel_step, :step),
+        purchased = MAX(purchased, :purchased)
+    WHERE session_id = :session_id
+"""
+
+session_materializer_stats = {
+    "runs": 0,
+    "batches": 0,
+    "events": 0,
+    "sessions_updated": 0,
+    "last_event_id": None,
+    "last_run_ms": 0.0,
+    "last_error": None,
+}
+
+
+def _merge_session_events(rows: List[tuple]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """يجمع دفعة أحداث مرتبة حسب id لكل جلسة؛ يرجع (باراميترز SESSION_MERGE_SQL، آخر id)."""
+    ranks = {step: i for i, step in enumerate(FUNNEL_STEPS, 1)}
+    merged: Dict[str, Dict[str, Any]] = {}
+    last_id = None
+    for event_id, session_id, event, created_at, url_id in rows:
+        # شهر بحالة draining موجود بالجزء وبـ events بنفس الـ ids
+        if event_id == last_id:
+            continue
+        last_id = event_id
+        if not session_id:
+            continue
+        ts = created_at or 0
+        item = merged.get(session_id)
+        if item is None:
+            merged[session_id] = {
+                "session_id": session_id,
+                "events": 1,
+                "pageviews": int(event in SESSION_PAGEVIEW_EVENTS),
+                "first_at": ts,
+                "landing": url_id,
+                "last_at": ts,
+                "exit": url_id,
+                "step": ranks.get(event, 0),
+                "purchased": int(event == "purchase"),
+            }
+            continue
+        item["events"] += 1
+        item["pageviews"] += event in SESSION_PAGEVIEW_EVENTS
+        if ts < item["first_at"]:
+            item["first_at"], item["landing"] = ts, url_id
+        if ts >= item["last_at"]:
+            item["last_at"], item["exit"] = ts, url_id
+        item["step"] = max(item["step"], ranks.get(event, 0))
+        if event == "purchase":
+            item["purchased"] = 1
+    return list(merged.values()), last_id
+
+
+def materialize_sessions(conn) -> int:
+    """يدمج الأحداث الجديدة بأعمدة sessions على دفعات SESSION_MATERIALIZE_BATCH؛ يرجع عدد الأحداث."""
+    started = time.perf_counter()
+    after_id = int(get_meta(conn.cursor(), "sessions_materialized_id", "0"))
+    done = 0
+    try:
+        while not _stop_event.is_set():
+            rows = conn.execute(
+                _export_events_sql(conn, after_id, SESSION_MATERIALIZE_BATCH, columns=SESSION_EVENT_COLUMNS)
+            ).fetchall()
+            if not rows:
+                break
+            params, after_id = _merge_session_events(rows)
+            with db.writer() as w:
+                cur = w.cursor()
+                cur.executemany(SESSION_MERGE_SQL, params)
+                set_meta(cur, "sessions_materialized_id", after_id)
+                db.commit(w)
+            done += len(rows)
+            session_materializer_stats["batches"] += 1
+            session_materializer_stats["sessions_updated"] += len(params)
+            session_materializer_stats["last_event_id"] = after_id
+            if len(rows) < SESSION_MATERIALIZE_BATCH:
+                break
+        session_materializer_stats["last_error"] = None
+    except Exception as exc:
+        session_materializer_stats["last_error"] = repr(exc)
+        raise
+    finally:
+        session_materializer_stats["runs"] += 1
+        session_materializer_stats["events"] += done
+        session_materializer_stats["last_run_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return done
+
+
+def reset_session_materialization(conn):
+    """يصفّر أعمدة التجميع والـ watermark، فالجولة الجاية تعيد الحساب من أول حدث."""
+    conn.execute(
+        """
+        UPDATE sessions SET
+            event_count = 0, pageviews = 0, first_event_at = NULL, last_event_at = NULL,
+            duration_s = NULL, landing_url_id = NULL, exit_url_id = NULL,
+            funnel_step = 0, purchased = 0
+        """
+    )
+    set_meta(conn.cursor(), "sessions_materialized_id", 0)
+    db.commit(conn)
+
+
+# -------- الترحيلات بالخلفية (backfills) --------
+# الشغل اللي بيمر على كل الصفوف القديمة ما بيوقف تشغيل السيرفر: init_db بيثبّت لحد أي id،
+# وخيط backfill بيكمل على دفعات (كل دفعة بمسكة كاتب قصيرة) والتقدم بـ /status.
+# بعد restart بيكمل من آخر دفعة انحفظت. `python main.py backfill` بيشغلهم بدون سيرفر.
+BACKFILL_RETRY_S = 60
+# أحداث كل دفعة بإعادة بناء الـ sketches بالخلفية (بايثون خالص، فالدفعة صغيرة عشان الكاتب)
+SKETCH_BACKFILL_CHUNK = 1_000
+SKETCH_BACKFILL_PAUSE = 1.0  # نسبة الاستراحة لوقت الدفعة
+
+backfill_stats: Dict[str, Dict[str, Any]] = {
+    name: {"state": "pending"}
+    for name in ("rollups", "meta_columns", "events_strings", "sessions_strings", "sketches")
+}
+
+
+def run_backfills():
+    build_rollups()
+    backfill_meta_columns()
+    backfill_string_ids()
+    build_sketches()
+
+
+# -------- الخيوط الخلفية --------
+_stop_event = threading.Event()
+_background_threads: List[threading.Thread] = []
+
+
+def _checkpoint_worker():
+    # اتصال خاص بالـ checkpoint عشان PASSIVE ما يمسك lock الكاتب
+    conn = open_conn()
+    try:
+        while not _stop_event.wait(WAL_CHECKPOINT_INTERVAL_S):
+            try:
+                db.checkpoint(conn)
+            except sqlite3.Error:
+                logger.exception("wal checkpoint failed")
+        db.checkpoint(conn)
+    finally:
+        conn.close()
+
+
+def _partition_worker():
+    # اتصال خاص: نسخ الشهر يقرأ من events ويكتب بملف الجزء بس، فما يمسك الكاتب
+    conn = open_conn()
+    try:
+        while not _stop_event.is_set():
+            try:
+                maintain_partitions(conn)
+            except Exception:
+                logger.exception("partition maintenance failed")
+            _stop_event.wait(PARTITION_CHECK_INTERVAL_S)
+    finally:
+        conn.close()
+
+
+def _export_worker():
+    conn = open_conn(readonly=True)
+    last_snapshot = None
+    try:
+        while not _stop_event.is_set():
+            snapshots = last_snapshot is None or time.monotonic() - last_snapshot >= EXPORT_SNAPSHOT_INTERVAL_S
+            try:
+                run_export(conn, snapshots=snapshots)
+                if snapshots:
+                    last_snapshot = time.monotonic()
+            except Exception:
+                logger.exception("columnar export failed")
+            _stop_event.wait(EXPORT_INTERVAL_S)
+    finally:
+        conn.close()
+
+
+def _backfill_worker():
+    while not _stop_event.is_set():
+        try:
+            run_backfills()
+            return
+        except Exception:
+            logger.exception("backfill failed, retrying in %ss", BACKFILL_RETRY_S)
+        _stop_event.wait(BACKFILL_RETRY_S)
+
+
+def _session_worker():
+    # اتصال قراءة خاص: قراءة الدفعة ما تمسك الكاتب، والكتابة بمسكة قصيرة من db.writer()
+    conn = open_conn(readonly=True)
+    try:
+        while not _stop_event.is_set():
+            try:
+                materialize_sessions(conn)
+            except Exception:
+                logger.exception("session materialization failed")
+            _stop_event.wait(SESSION_MATERIALIZE_INTERVAL_S)
+    finally:
+        conn.close()
+
+
+def _start_thread(target, name: str) -> threading.Thread:
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    _background_threads.append(thread)
+    return thread
+
+
+def start_background_workers():
+    global _ingest_thread
+    _stop_event.clear()
+    if INGEST_MODE == "queue" and _ingest_thread is None:
+        _ingest_thread = _start_thread(_ingest_worker, "ingest-writer")
+    _start_thread(_checkpoint_worker, "wal-checkpoint")
+    _start_thread(_backfill_worker, "backfills")
+    if EVENT_PARTITIONING == "month":
+        _start_thread(_partition_worker, "partitions")
+    if COLUMNAR_EXPORT == "parquet":
+        _start_thread(_export_worker, "columnar-export")
+    if SESSION_MATERIALIZER == "on":
+        _start_thread(_session_worker, "sessions-materializer")
+
+
+def stop_background_workers():
+    global _ingest_thread
+    live_stream.stop()
+    if _ingest_thread is not None:
+        # الطابور FIFO فالكاتب يخلص كل اللي قبل علامة الإيقاف
+        _ingest_queue.put(_INGEST_STOP)
+        _ingest_thread.join()
+        _ingest_thread = None
+    _stop_event.set()
+    while _background_threads:
+        _background_threads.pop().join()
+    db.close()
+
+
+async def enqueue_event(payload: EventIn, now_ts: int):
+    # ما نستخدم put(timeout) عشان ما نوقف الـ event loop؛ بوضع block ننتظر بـ sleep
+    deadline = time.monotonic() + INGEST_BLOCK_TIMEOUT_MS / 1000
+    while True:
+        try:
+            _ingest_queue.put_nowait((payload, now_ts))
+            break
+        except queue.Full:
+            if INGEST_BACKPRESSURE != "block" or time.monotonic() >= deadline:
+                _bump("rejected")
+                raise HTTPException(
+                    status_code=429,
+                    detail="ingest queue full",
+                    headers={"Retry-After": "1"},
+                )
+            await asyncio.sleep(0.005)
+    _bump("accepted")
+
+
+def _bump_duplicate_window():
+    with _ingest_stats_lock:
+        ingest_stats["duplicates"] += 1
+        ingest_stats["duplicates_window"] += 1
+
+
+def _write_one(payload: EventIn, now_ts: int) -> Dict[str, Any]:
+    with db.writer() as conn:
+        cur = conn.cursor()
+
+        try:
+            duplicate = write_event(cur, payload, now_ts)
+            db.commit(conn)
+            if duplicate:
+                _bump("duplicates")
+                return {"status": "ok", "duplicate": True}
+            _bump("written")
+            return {"status": "ok"}
+
+        except Exception as e:
+            db.rollback(conn)
+            count_locked(e, "writer")
+            return {"status": "error", "detail": str(e)}
+
+
+# -------- Endpoint: استقبال الأحداث من شوبفاي --------
+@app.post("/track")
+async def track_event(payload: EventIn):
+    now_ts = int(time.time())
+
+    # إعادة إرسال لحدث انكتب: نرجع ok فوراً بدون طابور ولا SQL
+    if payload.event_id in dedupe_window:
+        _bump_duplicate_window()
+        return {"status": "ok", "duplicate": True}
+
+    if INGEST_MODE == "queue":
+        await enqueue_event(payload, now_ts)
+        return {"status": "ok"}
+
+    return await writer_pool.run(_write_one, payload, now_ts)
+
+
+# -------- Endpoint: استقبال دفعة أحداث بطلب واحد --------
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl", "application/ndjson")
+
+
+def _parse_batch_body(body: bytes, content_type: str) -> List[Any]:
+    """يرجع قائمة عناصر خام؛ السطر اللي مش JSON صالح يرجع كـ ValueError بمكانه."""
+    if content_type.split(";")[0].strip() in NDJSON_CONTENT_TYPES:
+        items: List[Any] = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(e)
+        return items
+
+    try:
+        items = json.loads(body or b"null")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="body is not valid JSON")
+    if isinstance(items, dict) and isinstance(items.get("events"), list):
+        items = items["events"]
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="expected a JSON array of events")
+    return items
+
+
+@app.post(
+    "/track/batch",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": EventIn.model_json_schema()}
+                },
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def track_batch(request: Request):
+    """
+    يستقبل مصفوفة أحداث (أو NDJSON: حدث بكل سطر) ويكتبهم كلهم بـ transaction وحدة.
+    الرد فيه حالة لكل حدث بنفس الترتيب، فالحدث الغلط ما يفشّل الباقي.
+    """
+    now_ts = int(time.time())
+    items = _parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    if len(items) > TRACK_BATCH_MAX_EVENTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"batch has {len(items)} events, max is {TRACK_BATCH_MAX_EVENTS}",
+        )
+
+    results: List[Dict[str, Any]] = []
+    valid: List[Tuple[int, EventIn]] = []
+    for i, item in enumerate(items):
+        if isinstance(item, ValueError):
+            results.append({"index": i, "status": "error", "detail": f"invalid JSON: {item}"})
+            continue
+        try:
+            payload = EventIn.model_validate(item)
+        except ValidationError as e:
+            results.append({
+                "index": i,
+                "status": "error",
+                "detail": e.errors(include_url=False, include_context=False),
+            })
+            continue
+        if payload.event_id in dedupe_window:
+            _bump_duplicate_window()
+            results.append({"index": i, "status": "ok", "duplicate": True})
+            continue
+        valid.append((i, payload))
+        results.append({"index": i, "status": "ok"})
+
+    if INGEST_MODE == "queue":
+        for i, payload in valid:
+            try:
+                _ingest_queue.put_nowait((payload, now_ts))
+                _bump("accepted")
+            except queue.Full:
+                _bump("rejected")
+                results[i] = {"index": i, "status": "rejected", "detail": "ingest queue full"}
+    elif valid:
+        def write():
+            with db.writer() as conn:
+                return apply_batch(conn, [(payload, now_ts) for _, payload in valid])
+
+        for (i, _), error in zip(valid, await writer_pool.run(write)):
+            if error == DUPLICATE_EVENT:
+                results[i] = {"index": i, "status": "ok", "duplicate": True}
+            elif error is not None:
+                results[i] = {"index": i, "status": "error", "detail": error}
+
+    ok = sum(1 for r in results if r["status"] == "ok")
+    return {
+        "status": "ok" if ok == len(results) else "partial",
+        "accepted": ok,
+        "failed": len(results) - ok,
+        "results": results,
+    }
+
+
+# -------- Endpoint: تصدير الأحداث الخام (NDJSON / CSV) --------
+EVENTS_EXPORT_COLUMNS = EXPORT_EVENT_COLUMNS + ("event_id",)
+EVENTS_EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _export_end_id(after_id: int, limit: Optional[int]) -> int:
+    """
+    آخر id بيدخل بالتصدير، محسوب قبل أول بايت عشان يطلع بـ X-Next-After-Id: بدون limit
+    أكبر id هلأ (MAX على المفتاح بكل جدول)، ومع limit الـ id رقم limit بعد after_id
+    (مشي على المفاتيح بس).
+    """
+    with db.reader() as conn:
+        if limit is None:
+            parts = visible_partitions(conn.cursor())
+            attach_partitions(conn, parts)
+            ids = [
+                conn.execute(f"SELECT MAX(id) FROM {schema}.events").fetchone()[0]
+                for schema in ["main"] + [name for name, *_ in parts]
+            ]
+            end_id = max((i for i in ids if i is not None), default=None)
+        else:
+            sql = _export_events_sql(conn, after_id, limit, columns=("id",))
+            end_id = conn.execute(f"SELECT MAX(id) FROM ({sql})").fetchone()[0]
+    return end_id if end_id is not None and end_id > after_id else after_id
+
+
+class _ExportEncoder:
+    """يحوّل دفعات الصفوف لبايتات NDJSON أو CSV، ومع gzip ستريم مضغوط واحد لكل الرد."""
+
+    def __init__(self, fmt: str, compress: bool):
+        self.fmt = fmt
+        self._meta = EVENTS_EXPORT_COLUMNS.index("meta")
+        # wbits=31: هيدر gzip، عشان Content-Encoding: gzip
+        self._zip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def _compress(self, data: bytes) -> bytes:
+        return self._zip.compress(data) if self._zip is not None else data
+
+    def header(self) -> bytes:
+        if self.fmt != "csv":
+            return b""
+        return self._compress((",".join(EVENTS_EXPORT_COLUMNS) + "\r\n").encode())
+
+    def rows(self, rows: List[tuple]) -> bytes:
+        if self.fmt == "csv":
+            out = io.StringIO()
+            csv.writer(out).writerows(rows)
+            return self._compress(out.getvalue().encode())
+        lines = []
+        for row in rows:
+            item = dict(zip(EVENTS_EXPORT_COLUMNS, row))
+            # meta محفوظ نص JSON؛ بالتصدير يطلع object مش نص
+            item["meta"] = self._decode_meta(row[self._meta])
+            lines.append(json_dumps_bytes(item))
+        lines.append(b"")
+        return self._compress(b"\n".join(lines))
+
+    def finish(self) -> bytes:
+        return self._zip.flush() if self._zip is not None else b""
+
+    @staticmethod
+    def _decode_meta(meta: Optional[str]) -> Any:
+        if not meta:
+            return None
+        # صف خربان بعد هيدر 200 ما لازم يقطع الستريم: يطلع النص زي ما هو
+        try:
+            return json.loads(meta)
+        except (ValueError, RecursionError):
+            return meta
+
+
+def _export_chunk(after_id: int, end_id: int, encoder: _ExportEncoder) -> Tuple[bytes, int, int]:
+    """دفعة وحدة بقراءة قصيرة على reader: (بايتات، آخر id، عدد الصفوف)."""
+    with db.reader() as conn:
+        rows = conn.execute(
+            _export_events_sql(conn, after_id, EVENTS_EXPORT_CHUNK_ROWS, end_id, EVENTS_EXPORT_COLUMNS)
+        ).fetchall()
+    if not rows:
+        return b"", end_id, 0
+    unique = []
+    for row in rows:
+        # شهر بحالة draining موجود بالجزء وبـ events بنفس الـ ids
+        if not unique or row[0] != unique[-1][0]:
+            unique.append(row)
+    return encoder.rows(unique), rows[-1][0], len(unique)
+
+
+@app.get("/events/export")
+async def events_export(
+    after_id: int = Query(0, ge=0, description="export events with id > after_id"),
+    limit: Optional[int] = Query(None, ge=1, description="max events in this response"),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    compress: bool = Query(False, alias="gzip", description="gzip the body (Content-Encoding: gzip)"),
+):
+    """
+    يصدّر الأحداث الخام (events + الأجزاء الشهرية) بترتيب id، على دفعات
+    EVENTS_EXPORT_CHUNK_ROWS، كل دفعة قراءة قصيرة على reader_pool. X-Next-After-Id هو
+    after_id للطلب الجاي (آخر id بهالرد، محسوب قبل ما يبدأ الستريم).
+    """
+    end_id = await reader_pool.run(_export_end_id, after_id, limit)
+    encoder = _ExportEncoder(format, compress)
+    export_stats["http_exports"] += 1
+
+    async def body():
+        cursor = after_id
+        yield encoder.header()
+        while cursor < end_id:
+            data, cursor, count = await reader_pool.run(_export_chunk, cursor, end_id, encoder)
+            if not count:
+                break
+            export_stats["http_rows"] += count
+            yield data
+        yield encoder.finish()
+
+    headers = {
+        "X-Next-After-Id": str(end_id),
+        "Content-Disposition": f'attachment; filename="events-{after_id + 1}-{end_id}.{format}"',
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body(), media_type=EVENTS_EXPORT_FORMATS[format], headers=headers)
+
+
+# -------- Endpoint: حالة السيرفر (عمق الطابور وغيره) --------
+@app.get("/status")
+async def server_status():
+    with _ingest_stats_lock:
+        stats = dict(ingest_stats)
+    # لقطة وحدة: خيط الـ backfill بيغيّر الحالة وإحنا بنبني الرد
+    backfills = {name: dict(item) for name, item in backfill_stats.items()}
+    return {
+        "ingest": {
+            "mode": INGEST_MODE,
+            "queue_depth": _ingest_queue.qsize(),
+            "queue_capacity": INGEST_QUEUE_SIZE,
+            "batch_size": INGEST_BATCH_SIZE,
+            "flush_ms": INGEST_FLUSH_MS,
+            "backpressure": INGEST_BACKPRESSURE,
+            "writer_alive": _ingest_thread is not None and _ingest_thread.is_alive(),
+            **stats,
+            "duplicate_rate": (
+                round(stats["duplicates"] / (stats["duplicates"] + stats["written"]), 4)
+                if stats["duplicates"] + stats["written"] else 0.0
+            ),
+            "dedupe_window": dedupe_window.stats(),
+        },
+        "pools": {"writer": writer_pool.status(), "reader": reader_pool.status()},
+        "ua_cache": ua_cache_stats(),
+        "strings": string_table.stats(),
+        "entity_cache": {
+            "last_seen_resolution_s": LAST_SEEN_RESOLUTION_S,
+            "devices": device_cache.stats(),
+            "sessions": session_cache.stats(),
+        },
+        "realtime": realtime_counters.stats() if realtime_counters is not None else None,
+        "stream": live_stream.stats(),
+        "stats_cache": stats_cache.stats(),
+        "backfills": backfills,
+        "sketches": {
+            "mode": APPROX_DISTINCT,
+            "precision": HLL_PRECISION,
+            "building": backfills["sketches"]["state"] != "done",
+            "cache": {
+                **sketch_cache.stats(),
+                "approx_bytes": sketch_cache.stats()["size"] * HLL_REGISTERS,
+            },
+        },
+        "db": db.status(),
+        "partitions": {
+            "mode": EVENT_PARTITIONING,
+            "retention_months": RETENTION_MONTHS,
+            "retention_action": RETENTION_ACTION,
+            **partition_stats,
+        },
+        "export": {
+            "mode": COLUMNAR_EXPORT,
+            "stats_engine": STATS_ENGINE,
+            **export_stats,
+        },
+        "sessions_materializer": {
+            "mode": SESSION_MATERIALIZER,
+            "batch": SESSION_MATERIALIZE_BATCH,
+            **session_materializer_stats,
+            # آخر id انكتب من هالعملية (0 لو لسا ما انكتب إشي)
+            "lag_events": max(0, stats_cache.watermark - (session_materializer_stats["last_event_id"] or 0)),
+        },
+    }
+
+
+# -------- Endpoint: /metrics (Prometheus) --------
+def _sample_lines(name: str, kind: str, help: str, samples: List[Tuple[tuple, tuple, Any]]) -> List[str]:
+    """samples: (أسماء الـ labels، قيمها، القيمة) لمقاييس تنقرأ من العدادات الموجودة وقت الطلب."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for names, values, value in samples:
+        lines.append(f"{name}{_label_pairs(names, values)} {value}")
+    return lines
+
+
+def render_metrics() -> str:
+    with _ingest_stats_lock:
+        stats = dict(ingest_stats)
+    pools = {"writer": writer_pool.status(), "reader": reader_pool.status()}
+    db_status = db.status()
+    cache_counters = stats_cache.stats()["endpoints"]
+
+    lines: List[str] = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    lines += _sample_lines(
+        "tracker_ingest_events_total", "counter", "Events by ingest outcome.",
+        [
+            (("result",), (key,), stats[key])
+            for key in ("accepted", "rejected", "written", "failed", "duplicates")
+        ],
+    )
+    lines += _sample_lines(
+        "tracker_ingest_batches_total", "counter", "Batches written by the background writer and /track/batch.",
+        [((), (), stats["batches"])],
+    )
+    lines += _sample_lines(
+        "tracker_ingest_queue_depth", "gauge", "Events waiting for the background writer.",
+        [((), (), _ingest_queue.qsize())],
+    )
+    lines += _sample_lines(
+        "tracker_pool_active", "gauge", "Tasks running on a worker pool.",
+        [(("pool",), (name,), status["active"]) for name, status in pools.items()],
+    )
+    lines += _sample_lines(
+        "tracker_pool_queued", "gauge", "Tasks waiting for a worker pool thread.",
+        [(("pool",), (name,), status["queued"]) for name, status in pools.items()],
+    )
+    lines += _sample_lines(
+        "tracker_pool_tasks_total", "counter", "Worker pool tasks by outcome.",
+        [
+            (("pool", "result"), (name, result), status[result])
+            for name, status in pools.items()
+            for result in ("completed", "failed", "rejected")
+        ],
+    )
+    lines += _sample_lines(
+        "tracker_stats_cache_requests_total", "counter", "/stats cache lookups by outcome.",
+        [
+            (("endpoint", "result"), (name, result), count)
+            for name, counters in sorted(cache_counters.items())
+            for result, count in counters.items()
+        ],
+    )
+    lines += _sample_lines(
+        "tracker_db_wal_bytes", "gauge", "Size of the SQLite WAL file.",
+        [((), (), db_status["wal_bytes"])],
+    )
+    lines += _sample_lines(
+        "tracker_db_checkpoints_total", "counter", "WAL checkpoints run, and those blocked by readers.",
+        [
+            (("result",), ("run",), db_status["checkpoints"]["runs"]),
+            (("result",), ("busy",), db_status["checkpoints"]["busy"]),
+        ],
+    )
+    lines += _sample_lines(
+        "tracker_db_readers_open", "gauge", "Open read connections.",
+        [((), (), db_status["readers_open"])],
+    )
+    lines += _sample_lines(
+        "tracker_stream_subscribers", "gauge", "Connected /stats/stream clients.",
+        [((), (), live_stream.stats()["subscribers"])],
+    )
+    lines += _sample_lines(
+        "tracker_sessions_materialized_events_total", "counter", "Events merged into session columns.",
+        [((), (), session_materializer_stats["events"])],
+    )
+    lines += _sample_lines(
+        "tracker_sessions_materialized_id", "gauge", "Last events.id merged into session columns.",
+        [((), (), session_materializer_stats["last_event_id"] or 0)],
+    )
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    if METRICS != "on":
+        raise HTTPException(status_code=404, detail="metrics disabled (METRICS=off)")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# -------- البث المباشر: SSE لفروقات الأعداد --------
+class LiveStream:
+    """
+    الكاتب يجمع فروقات (حسب الحدث / المصدر / الدولة) بعد كل commit، وخيط الـ event loop
+    كل STREAM_INTERVAL_MS يحوّلها لرسالة SSE وحدة تنحط بطابور كل مشترك.
+    الحساب والـ JSON مرة وحدة لكل دفعة مهما كان عدد المشتركين، والقاعدة ما تنقرأ
+    إلا مرة عند أول مشترك (totals من rollup_daily، أو events لو الـ rollups لسا بتنبني).
+    by_geo_country بالـ totals من وقت ما بدأ البث بس (geo_since)، لأن ما في rollup للدول.
+    """
+
+    DIMENSIONS = ("by_event", "by_traffic_source", "by_geo_country")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, int]] = {dim: {} for dim in self.DIMENSIONS}
+        self._pending_events = 0
+        self._subscribers: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self.totals: Optional[Dict[str, Any]] = None
+        self.geo_since: Optional[int] = None
+        self.seq = 0
+        self.counters = {"messages": 0, "deliveries": 0, "dropped_subscribers": 0, "rejected": 0}
+
+    @property
+    def active(self) -> bool:
+        return self.totals is not None
+
+    def record(self, rows: List[Tuple[str, Optional[str], Optional[str]]]):
+        """rows: (event, traffic_source, geo_country). ينادى من on_commit تحت lock الكاتب."""
+        with self._lock:
+            for values in rows:
+                for dim, value in zip(self.DIMENSIONS, values):
+                    counts = self._pending[dim]
+                    key = value or "unknown"
+                    counts[key] = counts.get(key, 0) + 1
+            self._pending_events += len(rows)
+
+    def _load_totals(self):
+        # تحت lock الكاتب: ما في commit بين قراءة الـ totals وبداية تجميع الفروقات
+        with db.writer() as conn:
+            cur = conn.cursor()
+            if rollups_ready(cur):
+                sql = "SELECT event, traffic_source, SUM(events) FROM rollup_daily GROUP BY event, traffic_source"
+            else:
+                # الـ rollups لسا بتنعاد بالخلفية
+                events = events_relation(cur, "event, traffic_source")
+                sql = f"SELECT event, traffic_source, COUNT(*) FROM {events} GROUP BY event, traffic_source"
+            rows = cur.execute(sql).fetchall()
+            totals: Dict[str, Any] = {"events": 0, **{dim: {} for dim in self.DIMENSIONS}}
+            for event, source, count in rows:
+                totals["events"] += count
+                if source == ROLLUP_NULL_SOURCE:
+                    source = None
+                for dim, key in (("by_event", event), ("by_traffic_source", source or "unknown")):
+                    totals[dim][key] = totals[dim].get(key, 0) + count
+            with self._lock:
+                self._pending = {dim: {} for dim in self.DIMENSIONS}
+                self._pending_events = 0
+                self.geo_since = int(time.time())
+                self.totals = totals
+
+    @staticmethod
+    def _message(kind: str, seq: int, data: Dict[str, Any]) -> str:
+        return f"event: {kind}\nid: {seq}\ndata: {json_dumps(data)}\n\n"
+
+    def _snapshot(self) -> str:
+        return self._message(
+            "snapshot",
+            self.seq,
+            {"seq": self.seq, "geo_since": self.geo_since, "totals": self.totals},
+        )
+
+    async def subscribe(self) -> "asyncio.Queue":
+        if len(self._subscribers) >= STREAM_MAX_SUBSCRIBERS:
+            self.counters["rejected"] += 1
+            raise HTTPException(status_code=503, detail="too many stream subscribers", headers={"Retry-After": "5"})
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self.totals is None:
+                await writer_pool.run(self._load_totals)
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self._publisher())
+        q: "asyncio.Queue" = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        # الـ snapshot والفروقات كلها تنبني على خيط الـ loop، فما في رسالة تضيع بينهم
+        q.put_nowait(self._snapshot())
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: "asyncio.Queue"):
+        self._subscribers.discard(q)
+
+    def _drain(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if not self._pending_events:
+                return None
+            pending, self._pending = self._pending, {dim: {} for dim in self.DIMENSIONS}
+            events, self._pending_events = self._pending_events, 0
+        self.totals["events"] += events
+        for dim, counts in pending.items():
+            totals = self.totals[dim]
+            for key, count in counts.items():
+                totals[key] = totals.get(key, 0) + count
+        return {"events": events, **pending}
+
+    def _broadcast(self, message: str):
+        self.counters["messages"] += 1
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait(message)
+                self.counters["deliveries"] += 1
+            except asyncio.QueueFull:
+                # فاته فرق، فالأعداد عنده غلط: نقطعه وهو يعيد الاتصال ويبدأ من snapshot
+                self._subscribers.discard(q)
+                self.counters["dropped_subscribers"] += 1
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(None)
+
+    async def _publisher(self):
+        interval = STREAM_INTERVAL_MS / 1000
+        last_sent = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            delta = self._drain()
+            if delta is not None:
+                self.seq += 1
+                delta.update(seq=self.seq, ts=int(time.time()))
+                self._broadcast(self._message("delta", self.seq, delta))
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= STREAM_HEARTBEAT_S:
+                # تعليق SSE عشان البروكسيات ما تسكر الاتصال الساكت
+                self._broadcast(": ping\n\n")
+                last_sent = time.monotonic()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for q in list(self._subscribers):
+            self._subscribers.discard(q)
+            try:
+                q.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "subscribers": len(self._subscribers),
+            "active": self.active,
+            "seq": self.seq,
+        }
+
+
+live_stream = LiveStream()
+
+
+@app.get("/stats/stream")
+async def stats_stream():
+    """
+    Server-Sent Events: أول رسالة snapshot (totals)، وبعدها delta كل STREAM_INTERVAL_MS
+    فيها الأعداد الجديدة حسب الحدث والمصدر والدولة. totals + مجموع الـ deltas = الأرقام الحالية.
+    """
+    q = await live_stream.subscribe()
+
+    async def body():
+        try:
+            while True:
+                message = await q.get()
+                if message is None:
+                    break
+                yield message
+        finally:
+            live_stream.unsubscribe(q)
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -------- فلاتر /stats: مدى زمني، مصدر، دولة، قالب --------
+# أكبر صفحة لـ by_product / by_city (keyset: after = آخر مفتاح بالصفحة اللي قبل)
+STATS_PAGE_MAX = 1000
+
+
+class StatsFilter(NamedTuple):
+    """
+    فلاتر على وقت الحدث وأعمدته، كلها predicates بـ SQL على فهارس events:
+    created_at، (traffic_source, created_at)، (geo_country, ...)، (template_name, created_at).
+    tuple عشان تدخل بمفتاح كاش /stats.
+    """
+
+    since: Optional[int] = None  # created_at >= since
+    until: Optional[int] = None  # created_at < until
+    source: Optional[str] = None
+    country: Optional[str] = None
+    template_name: Optional[str] = None
+
+    @property
+    def empty(self) -> bool:
+        return all(value is None for value in self)
+
+    def _predicates(self) -> List[Tuple[str, str, Any]]:
+        predicates = []
+        if self.since is not None:
+            predicates.append(("created_at", "created_at >= ?", self.since))
+        if self.until is not None:
+            predicates.append(("created_at", "created_at < ?", self.until))
+        if self.source is not None:
+            predicates.append(("traffic_source", "traffic_source = ?", self.source))
+        if self.country is not None:
+            predicates.append(("geo_country", "geo_country = ?", self.country))
+        if self.template_name is not None:
+            predicates.append(("template_name", "template_name = ?", self.template_name))
+        return predicates
+
+    def where(self) -> Tuple[str, List[Any]]:
+        """"a = ? AND b >= ?" (أو "1" بدون فلاتر) مع الباراميترز."""
+        predicates = self._predicates()
+        if not predicates:
+            return "1", []
+        return (
+            " AND ".join(sql for _, sql, _ in predicates),
+            [value for _, _, value in predicates],
+        )
+
+    def relation(self, cur, columns: str) -> str:
+        """events_relation مع أعمدة الفلاتر، والأجزاء اللي برا المدى الزمني ما تنقرأ."""
+        names = [c.strip() for c in columns.split(",")]
+        for column, _, _ in self._predicates():
+            if column not in names:
+                names.append(column)
+        return events_relation(cur, ", ".join(names), self.since, self.until)
+
+    def rollup(self) -> Optional[Tuple[str, str, str, List[Any]]]:
+        """
+        (جدول، تعبير اليوم، where، params) لو عدد الأحداث ينخدم من الـ rollups: الفلاتر وقت
+        ومصدر بس، والحدود على يوم كامل (rollup_daily) أو ساعة (rollup_hourly). وإلا None.
+        """
+        if self.country is not None or self.template_name is not None:
+            return None
+        bounds = [ts for ts in (self.since, self.until) if ts is not None]
+        if all(ts % 86400 == 0 for ts in bounds):
+            table, day, column, convert = "rollup_daily", "day", "day", _utc_day
+        elif all(ts % 3600 == 0 for ts in bounds):
+            table, day, column, convert = (
+                "rollup_hourly", "strftime('%Y-%m-%d', bucket, 'unixepoch')", "bucket", int,
+            )
+        else:
+            return None
+        where, params = [], []
+        if self.since is not None:
+            where.append(f"{column} >= ?")
+            params.append(convert(self.since))
+        if self.until is not None:
+            where.append(f"{column} < ?")
+            params.append(convert(self.until))
+        if self.source is not None:
+            where.append("traffic_source = ?")
+            params.append(self.source)
+        return table, day, " AND ".join(where) or "1", params
+
+    def sessions_where(self) -> Tuple[str, List[Any]]:
+        """
+        نفس where على أعمدة sessions: الوقت على first_event_at (أول حدث بالجلسة) والمصدر على
+        traffic_source، وبس الجلسات اللي انجمعت. country و template_name مش أعمدة جلسة.
+        """
+        where, params = ["first_event_at IS NOT NULL"], []
+        if self.since is not None:
+            where.append("first_event_at >= ?")
+            params.append(self.since)
+        if self.until is not None:
+            where.append("first_event_at < ?")
+            params.append(self.until)
+        if self.source is not None:
+            where.append("traffic_source = ?")
+            params.append(self.source)
+        return " AND ".join(where), params
 
-    try:
-        # 1) تحديث / إضافة الجهاز (مع user_agent)
-        upsert_device(
-            cur,
-            payload.device_id,
-            now_ts,
-            payload.traffic_source,
-            payload.user_agent,
-        )
 
-        # 2) تحديث / إضافة الجلسة
-        upsert_session(
-            cur,
-            payload.session_id,
-            payload.device_id,
-            now_ts,
-            payload.traffic_source,
-            payload.utm_source,
-            payload.utm_medium,
-            payload.utm_campaign,
-            payload.utm_content,
-            payload.referrer,
-            payload.user_agent,
-        )
+NO_FILTER = StatsFilter()
 
-        # 3) تخزين الحدث نفسه
-        meta_json = json.dumps(payload.meta or {}, ensure_ascii=False)
 
-        cur.execute(
-            """
-            INSERT INTO events (
-                event, session_id, device_id,
-                url, referrer, user_agent,
-                traffic_source,
-                utm_source, utm_medium, utm_campaign, utm_content,
-                created_at, meta,
-                geo_country, geo_city,
-                session_pages, session_duration_ms,
-                template_name
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                payload.event,
-                payload.session_id,
-                payload.device_id,
-                payload.url,
-                payload.referrer,
-                payload.user_agent,
-                payload.traffic_source,
-                payload.utm_source,
-                payload.utm_medium,
-                payload.utm_campaign,
-                payload.utm_content,
-                now_ts,
-                meta_json,
-                payload.geo_country,
-                payload.geo_city,
-                payload.session_pages,
-                payload.session_duration_ms,
-                payload.template_name,
-            ),
-        )
+def _parse_time(value: Optional[str], name: str, end: bool = False) -> Optional[int]:
+    """unix ثواني أو ISO 8601 (بدون منطقة = UTC). تاريخ بس مع to يشمل اليوم كامل."""
+    if not value:
+        return None
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name}: expected unix seconds or ISO 8601")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    ts = int(parsed.timestamp())
+    if end and len(value) == 10:
+        ts += 86400
+    return ts
 
-        conn.commit()
-        return {"status": "ok"}
 
-    except Exception as e:
-        conn.rollback()
-        return {"status": "error", "detail": str(e)}
+def stats_filter(
+    from_: Optional[str] = Query(
+        None, alias="from", description="event time, unix seconds or ISO 8601 (UTC), inclusive"
+    ),
+    to: Optional[str] = Query(
+        None, description="event time, exclusive; a bare date (YYYY-MM-DD) includes that day"
+    ),
+    source: Optional[str] = Query(None, description="traffic_source"),
+    country: Optional[str] = Query(None, description="geo_country"),
+    template_name: Optional[str] = None,
+) -> StatsFilter:
+    since = _parse_time(from_, "from")
+    until = _parse_time(to, "to", end=True)
+    if since is not None and until is not None and until <= since:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    return StatsFilter(since, until, source or None, country or None, template_name or None)
 
-    finally:
-        conn.close()
+
+StatsFilterParam = Annotated[StatsFilter, Depends(stats_filter)]
+PageLimit = Annotated[Optional[int], Query(ge=1, le=STATS_PAGE_MAX)]
 
 
 # -------- Endpoint: تقرير عام --------
 @app.get("/stats/overview")
-def stats_overview():
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # total_events
-    cur.execute("SELECT COUNT(*) FROM events")
-    total_events = cur.fetchone()[0] or 0
+@cached_stats("overview")
+@run_on_readers
+def stats_overview(filters: StatsFilterParam = NO_FILTER):
+    # بدون فلاتر كل الأرقام من جداول الـ rollups: الوقت يعتمد على عدد الـ buckets مش عدد الأحداث.
+    # by_source فيه bucket "" للمصدر الفاضي، والأحداث بدون مصدر (NULL) بس بـ total_events
+    with db.reader() as conn:
+        cur = conn.cursor()
+        rollup = filters.rollup() if rollups_ready(cur) else None
+        where, params = filters.where()
 
-    # total_sessions
-    cur.execute("SELECT COUNT(DISTINCT session_id) FROM events")
-    total_sessions = cur.fetchone()[0] or 0
+        if rollup is not None:
+            table, _, rollup_where, rollup_params = rollup
+            # total_events
+            total_events = run_query(
+                cur,
+                "overview.total_events",
+                f"SELECT COALESCE(SUM(events), 0) FROM {table} WHERE {rollup_where}",
+                rollup_params,
+            )[0][0] or 0
 
-    # total_devices
-    cur.execute("SELECT COUNT(DISTINCT device_id) FROM events")
-    total_devices = cur.fetchone()[0] or 0
+            # by_source
+            rows = run_query(
+                cur,
+                "overview.by_source",
+                f"""
+                SELECT traffic_source, SUM(events)
+                FROM {table}
+                WHERE {rollup_where} AND traffic_source <> ?
+                GROUP BY traffic_source
+                """,
+                rollup_params + [ROLLUP_NULL_SOURCE],
+            )
+        else:
+            events = filters.relation(cur, "traffic_source")
+            rows = run_query(
+                cur,
+                "overview.filtered_by_source",
+                f"""
+                SELECT traffic_source, COUNT(*)
+                FROM {events}
+                WHERE {where}
+                GROUP BY traffic_source
+                """,
+                params,
+            )
+            total_events = sum(r[1] for r in rows)
+            rows = [r for r in rows if r[0] is not None]
 
-    # by_source
-    cur.execute(
-        """
-        SELECT traffic_source, COUNT(*)
-        FROM events
-        WHERE traffic_source IS NOT NULL
-        GROUP BY traffic_source
-        """
-    )
-    rows = cur.fetchall()
-    by_source = [
-        {"traffic_source": r[0], "count": r[1]} for r in rows if r[0] is not None
-    ]
+        if filters.empty:
+            # total_sessions / total_devices (كل جلسة وجهاز له صف واحد)
+            totals = dict(run_query(cur, "overview.totals", "SELECT name, value FROM rollup_totals"))
+            total_sessions = totals.get("sessions", 0)
+            total_devices = totals.get("devices", 0)
+        else:
+            # الجلسات والأجهزة اللي إلها أحداث تطابق الفلاتر
+            events = filters.relation(cur, "session_id, device_id")
+            total_sessions, total_devices = run_query(
+                cur,
+                "overview.filtered_totals",
+                f"""
+                SELECT COUNT(DISTINCT session_id), COUNT(DISTINCT device_id)
+                FROM {events}
+                WHERE {where}
+                """,
+                params,
+            )[0]
 
-    conn.close()
+        by_source = [
+            {"traffic_source": r[0], "count": r[1]} for r in rows
+        ]
 
     return {
         "total_events": total_events,
@@ -542,34 +4496,37 @@ def stats_overview():
 
 # -------- Endpoint: إحصائيات واتساب --------
 @app.get("/stats/whatsapp")
+@cached_stats("whatsapp")
+@run_on_readers
 def stats_whatsapp():
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # عدد الأجهزة القادمة من واتساب (is_whatsapp = 1)
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT device_id)
-        FROM devices
-        WHERE is_whatsapp = 1
-        """
-    )
-    total_whatsapp_devices = cur.fetchone()[0] or 0
+    with db.reader() as conn:
+        cur = conn.cursor()
 
-    # عدد الأجهزة من واتساب بدون شراء (لا يوجد لها event = 'purchase')
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT d.device_id)
-        FROM devices d
-        WHERE d.is_whatsapp = 1
-        AND d.device_id NOT IN (
-            SELECT DISTINCT device_id FROM events WHERE event = 'purchase'
-        )
-        """
-    )
-    whatsapp_no_purchase_devices = cur.fetchone()[0] or 0
+        # عدد الأجهزة القادمة من واتساب (is_whatsapp = 1)
+        total_whatsapp_devices = run_query(
+            cur,
+            "whatsapp.devices",
+            """
+            SELECT COUNT(DISTINCT device_id)
+            FROM devices
+            WHERE is_whatsapp = 1
+            """,
+        )[0][0] or 0
 
-    conn.close()
+        # عدد الأجهزة من واتساب بدون شراء (لا يوجد لها event = 'purchase')
+        events = events_relation(cur, "event, device_id")
+        whatsapp_no_purchase_devices = run_query(
+            cur,
+            "whatsapp.no_purchase_devices",
+            f"""
+            SELECT COUNT(DISTINCT d.device_id)
+            FROM devices d
+            WHERE d.is_whatsapp = 1
+            AND d.device_id NOT IN (
+                SELECT DISTINCT device_id FROM {events} WHERE event = 'purchase'
+            )
+            """,
+        )[0][0] or 0
 
     return {
         "total_whatsapp_devices": total_whatsapp_devices,
@@ -579,124 +4536,258 @@ def stats_whatsapp():
 
 # -------- Endpoint: إحصائيات الأجهزة والشراء --------
 @app.get("/stats/devices")
-def stats_devices():
-    conn = get_conn()
-    cur = conn.cursor()
+@run_on_readers
+def stats_devices(approx: bool = False):
+    building = approx and sketches_building()
+    if approx and not building:
+        started = time.perf_counter()
+        with db.reader() as conn:
+            cur = conn.cursor()
+            total_devices = dict(approx_distinct(cur, "all", "device")).get("", 0)
+            purchased_devices = dict(approx_distinct(cur, "event", "device")).get("purchase", 0)
+        return {
+            "total_devices": total_devices,
+            "purchased_devices": purchased_devices,
+            "no_purchase_devices": max(total_devices - purchased_devices, 0),
+            "approx": approx_info(started),
+        }
 
-    # إجمالي الأجهزة التي ظهر لها أي حدث
-    cur.execute("SELECT COUNT(DISTINCT device_id) FROM events")
-    total_devices = cur.fetchone()[0] or 0
+    with db.reader() as conn:
+        cur = conn.cursor()
 
-    # الأجهزة التي قامت بالشراء (event = 'purchase')
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT device_id)
-        FROM events
-        WHERE event = 'purchase'
-        """
-    )
-    purchased_devices = cur.fetchone()[0] or 0
+        events = events_relation(cur, "event, device_id")
 
-    no_purchase_devices = max(total_devices - purchased_devices, 0)
+        # إجمالي الأجهزة التي ظهر لها أي حدث
+        total_devices = run_query(
+            cur, "devices.total", f"SELECT COUNT(DISTINCT device_id) FROM {events}"
+        )[0][0] or 0
+
+        # الأجهزة التي قامت بالشراء (event = 'purchase')
+        purchased_devices = run_query(
+            cur,
+            "devices.purchased",
+            f"""
+            SELECT COUNT(DISTINCT device_id)
+            FROM {events}
+            WHERE event = 'purchase'
+            """,
+        )[0][0] or 0
 
-    conn.close()
+        no_purchase_devices = max(total_devices - purchased_devices, 0)
 
-    return {
+    result = {
         "total_devices": total_devices,
         "purchased_devices": purchased_devices,
         "no_purchase_devices": no_purchase_devices,
     }
+    if building:
+        result["approx"] = {"building": True}
+    return result
 
 
-# -------- Endpoint: Funnel (Overall + By Source + By Product) --------
-@app.get("/stats/funnel")
-def stats_funnel():
-    conn = get_conn()
-    cur = conn.cursor()
+# -------- محرك الفانل (تجميع داخل SQL) --------
+# بدل ما نسحب كل صفوف الفانل لبايثون ونبني sets، SQLite يحسب COUNT(DISTINCT session_id)
+# لكل خطوة / مصدر / منتج، وبايثون يستلم صف لكل مجموعة بس.
+FUNNEL_STEPS = [
+    "product_view",
+    "add_to_cart",
+    "cart_view",
+    "begin_checkout",
+    "purchase",
+]
 
-    FUNNEL_STEPS = [
-        "product_view",
-        "add_to_cart",
-        "cart_view",
-        "begin_checkout",
-        "purchase",
-    ]
 
-    # نجيب كل الأحداث المتعلقة بالفانل
+def _funnel_where(filters: StatsFilter = NO_FILTER) -> Tuple[str, List[Any]]:
     placeholders = ",".join(["?"] * len(FUNNEL_STEPS))
-    cur.execute(
+    where, params = filters.where()
+    return (
+        f"event IN ({placeholders}) AND session_id IS NOT NULL AND session_id <> '' AND {where}",
+        list(FUNNEL_STEPS) + params,
+    )
+
+
+def funnel_overall(cur, filters: StatsFilter = NO_FILTER) -> List[tuple]:
+    where, params = _funnel_where(filters)
+    events = filters.relation(cur, "event, session_id")
+    return run_query(
+        cur,
+        "funnel.overall",
         f"""
-        SELECT event, session_id, traffic_source, meta
-        FROM events
-        WHERE event IN ({placeholders})
+        SELECT event, COUNT(DISTINCT session_id)
+        FROM {events}
+        WHERE {where}
+        GROUP BY event
         """,
-        FUNNEL_STEPS,
+        params,
     )
-    rows = cur.fetchall()
-    conn.close()
 
-    # overall: step → set(session_id)
-    overall_sets = {step: set() for step in FUNNEL_STEPS}
 
-    # by_source: src → step → set(session_id)
-    source_sets = {}
+def funnel_by_source(cur, filters: StatsFilter = NO_FILTER) -> List[tuple]:
+    # التجميع على العمود نفسه عشان الفهرس (event, traffic_source, session_id) يغني عن الفرز
+    where, params = _funnel_where(filters)
+    events = filters.relation(cur, "event, traffic_source, session_id")
+    grouped = run_query(
+        cur,
+        "funnel.by_source",
+        f"""
+        SELECT traffic_source, event, COUNT(DISTINCT session_id)
+        FROM {events}
+        WHERE {where}
+        GROUP BY event, traffic_source
+        """,
+        params,
+    )
+    rows = []
+    unknown: Dict[str, List[int]] = {}
+    for src, event, count in grouped:
+        if src and src != "unknown":
+            rows.append((src, event, count))
+        else:
+            unknown.setdefault(event, []).append(count)
 
-    # by_product: (product_id, title) → step → set(session_id)
-    product_sets = {}
+    # NULL و '' ومصدر اسمه "unknown" فعلاً كلهم "unknown"؛ لو أكتر من واحد لنفس الخطوة نعد الجلسات مرة وحدة
+    for event, counts in unknown.items():
+        if len(counts) > 1:
+            filter_where, filter_params = filters.where()
+            counts = [run_query(
+                cur,
+                "funnel.by_source_unknown",
+                f"""
+                SELECT COUNT(DISTINCT session_id)
+                FROM {events}
+                WHERE event = ? AND session_id <> ''
+                AND (traffic_source IS NULL OR traffic_source IN ('', 'unknown'))
+                AND {filter_where}
+                """,
+                [event] + filter_params,
+            )[0][0]]
+        rows.append(("unknown", event, counts[0]))
+    return rows
 
-    for event, session_id, traffic_source, meta_json in rows:
-        if not session_id:
-            continue
 
-        # overall
-        overall_sets[event].add(session_id)
+def funnel_by_product(
+    cur,
+    filters: StatsFilter = NO_FILTER,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+) -> Tuple[List[tuple], Optional[str]]:
+    """
+    يرجع (الصفوف، after للصفحة الجاية). مع limit: أول limit منتج بعد after بترتيب
+    product_id (مشي على idx_events_product لحد ما تكمل الصفحة)، والتجميع عليهم بس.
+    """
+    where, params = _funnel_where(filters)
+    events = filters.relation(cur, "product_id, product_title, event, session_id")
+    next_after = None
+    if limit is not None:
+        if after is not None:
+            where += " AND product_id > ?"
+            params.append(after)
+        page = run_query(
+            cur,
+            "funnel.product_page",
+            f"""
+            SELECT DISTINCT product_id
+            FROM {events}
+            WHERE {where} AND product_id IS NOT NULL
+            ORDER BY product_id
+            LIMIT ?
+            """,
+            params + [limit],
+        )
+        if not page:
+            return [], None
+        if len(page) == limit:
+            next_after = page[-1][0]
+        where += " AND product_id <= ?"
+        params.append(page[-1][0])
+
+    rows = run_query(
+        cur,
+        "funnel.by_product",
+        f"""
+        SELECT product_id, product_title, event, COUNT(DISTINCT session_id)
+        FROM {events}
+        WHERE {where} AND product_id IS NOT NULL
+        GROUP BY product_id, product_title, event
+        """,
+        params,
+    )
+    return rows, next_after
+
 
-        # by_source
-        src = traffic_source or "unknown"
-        if src not in source_sets:
-            source_sets[src] = {step: set() for step in FUNNEL_STEPS}
-        source_sets[src][event].add(session_id)
+def _steps_template() -> Dict[str, int]:
+    return {step: 0 for step in FUNNEL_STEPS}
 
-        # by_product (لو في product_id داخل meta)
-        try:
-            meta = json.loads(meta_json or "{}")
-        except Exception:
-            meta = {}
-
-        product_id = meta.get("product_id")
-        product_title = meta.get("product_title") or meta.get("title")
-
-        if product_id is not None:
-            key = (str(product_id), str(product_title) if product_title else None)
-            if key not in product_sets:
-                product_sets[key] = {step: set() for step in FUNNEL_STEPS}
-            product_sets[key][event].add(session_id)
-
-    # helper لتحويل sets إلى أرقام (counts)
-    def convert_nested(obj):
-        if isinstance(obj, set):
-            return len(obj)
-        if isinstance(obj, dict):
-            return {k: convert_nested(v) for k, v in obj.items()}
-        return obj
-
-    overall = convert_nested(overall_sets)
-    by_source = {src: convert_nested(steps) for src, steps in source_sets.items()}
-    by_product = {
-        f"{pid} | {title if title else 'No Title'}": convert_nested(steps)
-        for (pid, title), steps in product_sets.items()
-    }
 
-    return {
+# -------- Endpoint: Funnel (Overall + By Source + By Product) --------
+@app.get("/stats/funnel")
+@cached_stats("funnel")
+@run_on_readers
+def stats_funnel(
+    filters: StatsFilterParam = NO_FILTER,
+    product_limit: PageLimit = None,
+    product_after: Optional[str] = None,
+):
+    """
+    فلاتر from/to/source/country/template_name على الأحداث نفسها. product_limit يقسم
+    by_product لصفحات بترتيب product_id، و next_product_after هو product_after للصفحة الجاية.
+    backfill_pending: true يعني by_product لسا ناقصه أحداث قديمة (ترحيل أعمدة meta شغال).
+    """
+    next_product_after = None
+    if STATS_ENGINE == "parquet" and filters.empty and product_limit is None:
+        overall_rows, source_rows, product_rows = parquet_funnel_rows()
+    else:
+        with db.reader() as conn:
+            cur = conn.cursor()
+            overall_rows = funnel_overall(cur, filters)
+            source_rows = funnel_by_source(cur, filters)
+            product_rows, next_product_after = funnel_by_product(
+                cur, filters, product_limit, product_after
+            )
+
+    # overall: step → عدد الجلسات
+    overall = _steps_template()
+    for event, count in overall_rows:
+        overall[event] = count
+
+    # by_source: src → step → عدد الجلسات
+    by_source: Dict[str, Dict[str, int]] = {}
+    for src, event, count in source_rows:
+        by_source.setdefault(src, _steps_template())[event] = count
+
+    # by_product: "product_id | title" → step → عدد الجلسات
+    by_product: Dict[str, Dict[str, int]] = {}
+    for pid, title, event, count in product_rows:
+        key = f"{pid} | {title if title else 'No Title'}"
+        by_product.setdefault(key, _steps_template())[event] = count
+
+    result = {
         "overall": overall,
         "by_source": by_source,
         "by_product": by_product,
     }
+    if product_limit is not None:
+        result["next_product_after"] = next_product_after
+    if meta_backfill_pending():
+        result["backfill_pending"] = True
+    return result
 
 
 # -------- Endpoint: ملخص أنواع الأجهزة وأنظمتها --------
+def _value_counts(rows: List[tuple]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "value": r[0] if r[0] not in (None, "") else "unknown",
+            "count": r[1],
+        }
+        for r in rows
+    ]
+
+
 @app.get("/stats/device-types")
-def stats_device_types():
+@cached_stats("device_types")
+@run_on_readers
+def stats_device_types(filters: StatsFilterParam = NO_FILTER):
     """
     يرجع توزيع الأجهزة حسب:
     - نوع الجهاز (device_type)
@@ -704,54 +4795,64 @@ def stats_device_types():
     - النظام (os_name)
     - المتصفح (browser_name)
     يعتمد على جدول devices حيث يتم تحديث المعلومات من user_agent.
+    مع فلاتر: بس الأجهزة اللي إلها أحداث تطابقها.
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    if not filters.empty:
+        return _device_types_filtered(filters)
 
-    def agg(query: str):
-        cur.execute(query)
-        rows = cur.fetchall()
-        return [
-            {
-                "value": r[0] if r[0] not in (None, "") else "unknown",
-                "count": r[1],
-            }
-            for r in rows
-        ]
+    if STATS_ENGINE == "parquet":
+        return {
+            key: _value_counts(parquet_device_rows(column))
+            for key, column in (
+                ("by_device_type", "device_type"),
+                ("by_brand", "device_brand"),
+                ("by_os", "os_name"),
+                ("by_browser", "browser_name"),
+            )
+        }
 
-    by_type = agg(
-        """
-        SELECT device_type, COUNT(DISTINCT device_id)
-        FROM devices
-        GROUP BY device_type
-        """
-    )
+    # device_id فريد بجدول devices، فـ COUNT(device_id) = COUNT(DISTINCT device_id) بدون فرز
+    with db.reader() as conn:
+        cur = conn.cursor()
 
-    by_brand = agg(
-        """
-        SELECT device_brand, COUNT(DISTINCT device_id)
-        FROM devices
-        GROUP BY device_brand
-        """
-    )
+        def agg(name: str, query: str):
+            return _value_counts(run_query(cur, f"device_types.{name}", query))
 
-    by_os = agg(
-        """
-        SELECT os_name, COUNT(DISTINCT device_id)
-        FROM devices
-        GROUP BY os_name
-        """
-    )
+        by_type = agg(
+            "by_device_type",
+            """
+            SELECT device_type, COUNT(device_id)
+            FROM devices
+            GROUP BY device_type
+            """
+        )
 
-    by_browser = agg(
-        """
-        SELECT browser_name, COUNT(DISTINCT device_id)
-        FROM devices
-        GROUP BY browser_name
-        """
-    )
+        by_brand = agg(
+            "by_brand",
+            """
+            SELECT device_brand, COUNT(device_id)
+            FROM devices
+            GROUP BY device_brand
+            """
+        )
+
+        by_os = agg(
+            "by_os",
+            """
+            SELECT os_name, COUNT(device_id)
+            FROM devices
+            GROUP BY os_name
+            """
+        )
 
-    conn.close()
+        by_browser = agg(
+            "by_browser",
+            """
+            SELECT browser_name, COUNT(device_id)
+            FROM devices
+            GROUP BY browser_name
+            """
+        )
 
     return {
         "by_device_type": by_type,
@@ -761,55 +4862,95 @@ def stats_device_types():
     }
 
 
+def _device_types_filtered(filters: StatsFilter) -> Dict[str, Any]:
+    # استعلام واحد بكل التركيبات (الـ subquery على events ينحسب مرة)، والتوزيعات الأربعة ببايثون
+    with db.reader() as conn:
+        cur = conn.cursor()
+        where, params = filters.where()
+        events = filters.relation(cur, "device_id")
+        rows = run_query(
+            cur,
+            "device_types.filtered",
+            f"""
+            SELECT device_type, device_brand, os_name, browser_name, COUNT(device_id)
+            FROM devices
+            WHERE device_id IN (SELECT device_id FROM {events} WHERE {where})
+            GROUP BY device_type, device_brand, os_name, browser_name
+            """,
+            params,
+        )
+
+    result = {}
+    for i, key in enumerate(("by_device_type", "by_brand", "by_os", "by_browser")):
+        counts: Dict[Any, int] = {}
+        for row in rows:
+            counts[row[i]] = counts.get(row[i], 0) + row[4]
+        result[key] = _value_counts(sorted(counts.items(), key=lambda r: (r[0] is not None, r[0] or "")))
+    return result
+
+
 # -------- Endpoint: إحصائيات Realtime (جلسات/أجهزة نشطة آخر X دقيقة) --------
 @app.get("/stats/realtime")
+@run_on_readers
 def stats_realtime(window_minutes: int = 5):
     """
     يعطي نظرة لحظية:
     - عدد الجلسات النشطة في آخر window_minutes دقيقة
     - عدد الأجهزة التي شوهدت في آخر window_minutes دقيقة
     - عدد الأحداث في آخر window_minutes دقيقة
+    من realtime_counters بالذاكرة لو النافذة مغطاة، وإلا من SQLite.
     """
     now_ts = int(time.time())
     threshold = now_ts - window_minutes * 60
 
-    conn = get_conn()
-    cur = conn.cursor()
+    totals = realtime_counters.window(now_ts, threshold) if realtime_counters is not None else None
+    if totals is not None:
+        return {
+            "window_minutes": window_minutes,
+            "active_sessions": totals["session"],
+            "active_devices": totals["device"],
+            "recent_events": totals["events"],
+        }
 
-    # جلسات نشطة
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT session_id)
-        FROM sessions
-        WHERE last_seen >= ?
-        """,
-        (threshold,),
-    )
-    active_sessions = cur.fetchone()[0] or 0
+    with db.reader() as conn:
+        cur = conn.cursor()
 
-    # أجهزة نشطة
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT device_id)
-        FROM devices
-        WHERE last_seen >= ?
-        """,
-        (threshold,),
-    )
-    active_devices = cur.fetchone()[0] or 0
+        # جلسات نشطة (session_id و device_id فريدين بجداولهم، فما نحتاج DISTINCT)
+        active_sessions = run_query(
+            cur,
+            "realtime.sessions",
+            """
+            SELECT COUNT(session_id)
+            FROM sessions
+            WHERE last_seen >= ?
+            """,
+            (threshold,),
+        )[0][0] or 0
 
-    # أحداث حديثة
-    cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM events
-        WHERE created_at >= ?
-        """,
-        (threshold,),
-    )
-    recent_events = cur.fetchone()[0] or 0
+        # أجهزة نشطة
+        active_devices = run_query(
+            cur,
+            "realtime.devices",
+            """
+            SELECT COUNT(device_id)
+            FROM devices
+            WHERE last_seen >= ?
+            """,
+            (threshold,),
+        )[0][0] or 0
 
-    conn.close()
+        # أحداث حديثة (الأجزاء الأقدم من النافذة ما تنقرأ)
+        events = events_relation(cur, "created_at", since=threshold)
+        recent_events = run_query(
+            cur,
+            "realtime.events",
+            f"""
+            SELECT COUNT(*)
+            FROM {events}
+            WHERE created_at >= ?
+            """,
+            (threshold,),
+        )[0][0] or 0
 
     return {
         "window_minutes": window_minutes,
@@ -821,26 +4962,48 @@ def stats_realtime(window_minutes: int = 5):
 
 # -------- Endpoint: عدد الأحداث لكل يوم (لآخر 30 يوم) --------
 @app.get("/stats/events-daily")
-def stats_events_daily(limit_days: int = 30):
+@cached_stats("events_daily")
+@run_on_readers
+def stats_events_daily(limit_days: int = 30, filters: StatsFilterParam = NO_FILTER):
     """
-    يرجع عدد الأحداث لكل يوم (للاستخدام في الرسوم البيانية).
+    يرجع عدد الأحداث لكل يوم (للاستخدام في الرسوم البيانية) من جدول rollup_daily
+    (أو rollup_hourly لو حدود from/to على ساعة، أو events لفلاتر الدولة والقالب).
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    with db.reader() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        """
-        SELECT strftime('%Y-%m-%d', datetime(created_at, 'unixepoch')) AS day,
-               COUNT(*) as cnt
-        FROM events
-        GROUP BY day
-        ORDER BY day DESC
-        LIMIT ?
-        """,
-        (limit_days,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+        rollup = filters.rollup() if rollups_ready(cur) else None
+        if rollup is not None:
+            table, day, where, params = rollup
+            rows = run_query(
+                cur,
+                "events_daily",
+                f"""
+                SELECT {day} AS day, SUM(events) AS cnt
+                FROM {table}
+                WHERE {where}
+                GROUP BY day
+                ORDER BY day DESC
+                LIMIT ?
+                """,
+                params + [limit_days],
+            )
+        else:
+            where, params = filters.where()
+            events = filters.relation(cur, "created_at")
+            rows = run_query(
+                cur,
+                "events_daily.filtered",
+                f"""
+                SELECT strftime('%Y-%m-%d', created_at, 'unixepoch') AS day, COUNT(*) AS cnt
+                FROM {events}
+                WHERE {where}
+                GROUP BY day
+                ORDER BY day DESC
+                LIMIT ?
+                """,
+                params + [limit_days],
+            )
 
     return [
         {"day": r[0], "count": r[1]}
@@ -851,40 +5014,443 @@ def stats_events_daily(limit_days: int = 30):
 
 # -------- Endpoint: إحصائيات جغرافية بسيطة --------
 @app.get("/stats/geo")
-def stats_geo():
+@cached_stats("geo")
+@run_on_readers
+def stats_geo(
+    approx: bool = False,
+    filters: StatsFilterParam = NO_FILTER,
+    city_limit: PageLimit = None,
+    city_after: Optional[str] = None,
+):
     """
     يرجع توزيع الجلسات حسب الدولة والمدينة (حسب ما متوفر).
+    approx=true: تقدير من الـ sketches بدل COUNT(DISTINCT) على الأحداث.
+    city_limit: by_city صفحات بترتيب اسم المدينة (keyset على idx_events_city_session)،
+    و next_city_after هو city_after للصفحة الجاية.
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    info = None
+    next_city_after = None
+    paged = city_limit is not None
+    if approx and (paged or not filters.empty):
+        raise HTTPException(status_code=400, detail="approx does not support filters or pagination")
+    if approx and sketches_building():
+        approx, info = False, {"building": True}
+    if approx:
+        started = time.perf_counter()
+        with db.reader() as conn:
+            cur = conn.cursor()
+            country_rows = approx_distinct(cur, "country", "session")
+            city_rows = approx_distinct(cur, "city", "session")
+        info = approx_info(started)
+    elif STATS_ENGINE == "parquet" and filters.empty and not paged:
+        country_rows = parquet_geo_rows("geo_country")
+        city_rows = parquet_geo_rows("geo_city")
+    else:
+        with db.reader() as conn:
+            cur = conn.cursor()
+            where, params = filters.where()
+
+            events = filters.relation(cur, "geo_country, session_id")
+            country_rows = run_query(
+                cur,
+                "geo.by_country",
+                f"""
+                SELECT geo_country, COUNT(DISTINCT session_id)
+                FROM {events}
+                WHERE geo_country IS NOT NULL AND geo_country <> '' AND {where}
+                GROUP BY geo_country
+                ORDER BY COUNT(DISTINCT session_id) DESC
+                """,
+                params,
+            )
+
+            events = filters.relation(cur, "geo_city, session_id")
+            if paged:
+                if city_after is not None:
+                    where += " AND geo_city > ?"
+                    params.append(city_after)
+                city_rows = run_query(
+                    cur,
+                    "geo.city_page",
+                    f"""
+                    SELECT geo_city, COUNT(DISTINCT session_id)
+                    FROM {events}
+                    WHERE geo_city IS NOT NULL AND geo_city <> '' AND {where}
+                    GROUP BY geo_city
+                    ORDER BY geo_city
+                    LIMIT ?
+                    """,
+                    params + [city_limit],
+                )
+                if len(city_rows) == city_limit:
+                    next_city_after = city_rows[-1][0]
+            else:
+                city_rows = run_query(
+                    cur,
+                    "geo.by_city",
+                    f"""
+                    SELECT geo_city, COUNT(DISTINCT session_id)
+                    FROM {events}
+                    WHERE geo_city IS NOT NULL AND geo_city <> '' AND {where}
+                    GROUP BY geo_city
+                    ORDER BY COUNT(DISTINCT session_id) DESC
+                    """,
+                    params,
+                )
 
-    cur.execute(
-        """
-        SELECT geo_country, COUNT(DISTINCT session_id)
-        FROM events
-        WHERE geo_country IS NOT NULL AND geo_country <> ''
-        GROUP BY geo_country
-        ORDER BY COUNT(DISTINCT session_id) DESC
-        """
-    )
     by_country = [
         {"country": row[0], "sessions": row[1]}
-        for row in cur.fetchall()
+        for row in country_rows
     ]
-
-    cur.execute(
-        """
-        SELECT geo_city, COUNT(DISTINCT session_id)
-        FROM events
-        WHERE geo_city IS NOT NULL AND geo_city <> ''
-        GROUP BY geo_city
-        ORDER BY COUNT(DISTINCT session_id) DESC
-        """
-    )
     by_city = [
         {"city": row[0], "sessions": row[1]}
-        for row in cur.fetchall()
+        for row in city_rows
     ]
-
-    conn.close()
+    if info is not None:
+        return {"by_country": by_country, "by_city": by_city, "approx": info}
+    if paged:
+        return {"by_country": by_country, "by_city": by_city, "next_city_after": next_city_after}
     return {"by_country": by_country, "by_city": by_city}
+
+
+# -------- Endpoint: تحليل الجلسات (أعمدة materialize_sessions) --------
+@app.get("/stats/sessions")
+# الأرقام بتتغير لما المجمّع يكتب، مش لما ينكتب حدث
+@cached_stats("sessions", watermark=lambda: session_materializer_stats["last_event_id"])
+@run_on_readers
+def stats_sessions(
+    filters: StatsFilterParam = NO_FILTER,
+    top: Annotated[int, Query(ge=1, le=STATS_PAGE_MAX)] = 10,
+):
+    """
+    bounce rate، صفحات ومدة الجلسة، الوصول لخطوات الفانل، وأكثر صفحات الدخول والخروج،
+    كلها من جدول sessions لحاله على فهارسه (بدون أي مرور على events).
+    from/to على وقت أول حدث بالجلسة، و source على مصدرها. الأرقام لحد materialized_through_id.
+    """
+    if filters.country is not None or filters.template_name is not None:
+        raise HTTPException(status_code=400, detail="sessions support from, to and source filters only")
+    with db.reader() as conn:
+        cur = conn.cursor()
+        where, params = filters.sessions_where()
+
+        sessions, bounces, pageviews, duration, purchases = run_query(
+            cur,
+            "sessions.summary",
+            f"""
+            SELECT COUNT(*), COALESCE(SUM(pageviews <= 1), 0), COALESCE(SUM(pageviews), 0),
+                   COALESCE(SUM(duration_s), 0), COALESCE(SUM(purchased), 0)
+            FROM sessions
+            WHERE {where}
+            """,
+            params,
+        )[0]
+        step_rows = run_query(
+            cur,
+            "sessions.funnel",
+            f"""
+            SELECT funnel_step, COUNT(*)
+            FROM sessions
+            WHERE {where}
+            GROUP BY funnel_step
+            """,
+            params,
+        )
+        landing_rows = run_query(
+            cur,
+            "sessions.landing",
+            f"""
+            SELECT s.value, t.sessions, t.bounces
+            FROM (
+                SELECT landing_url_id, COUNT(*) AS sessions, SUM(pageviews <= 1) AS bounces
+                FROM sessions
+                WHERE landing_url_id IS NOT NULL AND {where}
+                GROUP BY landing_url_id
+                ORDER BY sessions DESC, landing_url_id
+                LIMIT ?
+            ) t
+            LEFT JOIN strings s ON s.id = t.landing_url_id
+            ORDER BY t.sessions DESC, t.landing_url_id
+            """,
+            params + [top],
+        )
+        exit_rows = run_query(
+            cur,
+            "sessions.exit",
+            f"""
+            SELECT s.value, t.sessions
+            FROM (
+                SELECT exit_url_id, COUNT(*) AS sessions
+                FROM sessions
+                WHERE exit_url_id IS NOT NULL AND {where}
+                GROUP BY exit_url_id
+                ORDER BY sessions DESC, exit_url_id
+                LIMIT ?
+            ) t
+            LEFT JOIN strings s ON s.id = t.exit_url_id
+            ORDER BY t.sessions DESC, t.exit_url_id
+            """,
+            params + [top],
+        )
+        through = int(get_meta(cur, "sessions_materialized_id", "0"))
+        (last_id,) = cur.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()
+
+    # الجلسة اللي وصلت خطوة وصلت كل اللي قبلها
+    by_step = dict(step_rows)
+    funnel = _steps_template()
+    reached = 0
+    for i in range(len(FUNNEL_STEPS), 0, -1):
+        reached += by_step.get(i, 0)
+        funnel[FUNNEL_STEPS[i - 1]] = reached
+
+    def rate(n: int) -> float:
+        return round(n / sessions, 4) if sessions else 0.0
+
+    return {
+        "sessions": sessions,
+        "bounce_rate": rate(bounces),
+        "pages_per_session": round(pageviews / sessions, 2) if sessions else 0.0,
+        "avg_duration_s": round(duration / sessions, 1) if sessions else 0.0,
+        "purchase_rate": rate(purchases),
+        "funnel": funnel,
+        "landing_pages": [
+            {"url": url, "sessions": n, "bounce_rate": round(b / n, 4)}
+            for url, n, b in landing_rows
+        ],
+        "exit_pages": [
+            {"url": url, "sessions": n}
+            for url, n in exit_rows
+        ],
+        "materialized_through_id": through,
+        "lag_events": max(0, last_id - through),
+    }
+
+
+# -------- فحص خطط الاستعلامات (EXPLAIN QUERY PLAN) --------
+# يشغّل كل GET /stats/* على pool خاص يسجل الـ SQL المنفّذ، وبعدين يعمل
+# EXPLAIN QUERY PLAN لكل جملة ويفشل لو أي وحدة رجعت لـ SCAN على events، حتى
+# SCAN ... USING COVERING INDEX (بيمر على كل الصفوف برضه، بس بالفهرس) إلا لو اسمها بـ PLAN_ALLOWED_SCANS.
+_EVENTS_ALIAS_RE = re.compile(r"\bevents\s+(?:AS\s+)?([a-z_]\w*)", re.IGNORECASE)
+_SQL_KEYWORDS = {"where", "group", "order", "limit", "join", "left", "inner", "on", "union"}
+
+
+def _events_aliases(sql: str) -> set:
+    aliases = {"events"}
+    for alias in _EVENTS_ALIAS_RE.findall(sql):
+        if alias.lower() not in _SQL_KEYWORDS:
+            aliases.add(alias)
+    return aliases
+
+
+# كل فلتر لحاله (حدود مش على ساعة عشان تقرأ من events مش الـ rollups)، وصفحة لكل قائمة مقسمة
+PLAN_FILTERS = [
+    StatsFilter(since=1, until=7201),
+    StatsFilter(source="whatsapp"),
+    StatsFilter(country="JO"),
+    StatsFilter(template_name="product"),
+]
+PLAN_PAGES = [
+    {"product_limit": 10, "product_after": "0"},
+    {"city_limit": 10, "city_after": "A"},
+]
+# استعلامات (اسم run_query) مسموح لها تمشي على فهرس covering كامل، مع السبب
+PLAN_ALLOWED_SCANS = {
+    "devices.total": "distinct devices over every event has no predicate; approx=true reads the sketches",
+}
+
+
+def collect_stats_queries() -> List[Tuple[Optional[str], str]]:
+    """(اسم run_query أو None، الـ SQL) لكل جملة نفذتها الـ endpoints."""
+    global db, run_query
+    statements: List[Tuple[Optional[str], str]] = []
+    current: List[Optional[str]] = [None]
+
+    def named_query(cur, name, sql, params=()):
+        current[0] = name
+        try:
+            return saved_query(cur, name, sql, params)
+        finally:
+            current[0] = None
+
+    saved, db = db, ConnectionPool(1, trace=lambda sql: statements.append((current[0], sql)))
+    saved_query, run_query = run_query, named_query
+    try:
+        for route in app.routes:
+            if getattr(route, "path", "").startswith("/stats/") and "GET" in route.methods:
+                # الدالة الأصلية تحت cached_stats و run_on_readers: الفحص ما يمر على الكاش
+                endpoint = inspect.unwrap(route.endpoint)
+                # /stats/stream يقرأ rollup_daily مرة بس، ومش استعلام داشبورد
+                if asyncio.iscoroutinefunction(endpoint):
+                    continue
+                endpoint()
+                params = inspect.signature(endpoint).parameters
+                if "filters" in params:
+                    for filters in PLAN_FILTERS:
+                        try:
+                            endpoint(filters=filters)
+                        except HTTPException:
+                            # فلتر مش مدعوم بهالـ endpoint (400): ما في استعلام نفحصه
+                            pass
+                for page in PLAN_PAGES:
+                    if set(page) <= set(params):
+                        endpoint(**page)
+    finally:
+        db.close()
+        db = saved
+        run_query = saved_query
+
+    seen = set()
+    unique = []
+    for name, sql in statements:
+        key = " ".join(sql.split())
+        if key not in seen:
+            seen.add(key)
+            unique.append((name, sql))
+    return unique
+
+
+def check_query_plans() -> List[Dict[str, Any]]:
+    """
+    يرجع لكل استعلام: الاسم، الـ SQL، الخطة، و ok=False لو فيه SCAN على events
+    (allowed فيه السبب لو الـ SCAN بفهرس covering ومسموح بـ PLAN_ALLOWED_SCANS).
+    """
+    report = []
+    with db.reader() as conn:
+        attach_partitions(conn, visible_partitions(conn.cursor()))
+        for name, sql in collect_stats_queries():
+            # ATTACH / PRAGMA من events_relation مش استعلامات إحصائيات
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            # "SCAN events" بعد "CO-ROUTINE events" هو المرور على نتيجة UNION ALL للأجزاء مش الجدول
+            aliases = _events_aliases(sql) - {
+                step.split()[1] for step in plan if step.startswith(("CO-ROUTINE ", "MATERIALIZE "))
+            }
+            scans = [
+                step for step in plan
+                if step.startswith("SCAN ")
+                and (step.split()[1] in aliases or step.split()[1].endswith(".events"))
+            ]
+            allowed = None
+            if scans and all(" USING COVERING INDEX " in step for step in scans):
+                allowed = PLAN_ALLOWED_SCANS.get(name)
+            report.append({
+                "name": name,
+                "sql": " ".join(sql.split()),
+                "plan": plan,
+                "ok": not scans or allowed is not None,
+                "allowed": allowed,
+            })
+    return report
+
+
+def _use_scratch_db():
+    # قاعدة فاضية بنفس الهيكل: الخطة تعتمد على الفهارس بس مش على توزيع البيانات
+    import tempfile
+
+    global DB_PATH, db
+    db.close()
+    DB_PATH = os.path.join(tempfile.mkdtemp(prefix="tracker-plans-"), "events.db")
+    db = ConnectionPool(1)
+    init_db()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shopify tracker admin commands")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("check-plans", help="fail if any /stats query full-scans events")
+    p.add_argument(
+        "--live",
+        action="store_true",
+        help="plan against DB_PATH and its statistics instead of a fresh schema",
+    )
+    sub.add_parser("rebuild-rollups", help="recompute rollup tables (and sketches) from events")
+    sub.add_parser("backfill", help="finish pending backfills (meta columns, string ids, sketches)")
+    p = sub.add_parser("materialize-sessions", help="merge new events into session columns")
+    p.add_argument("--rebuild", action="store_true", help="reset session columns and recompute from the first event")
+    sub.add_parser("vacuum", help="rewrite the database file to reclaim freed pages")
+    sub.add_parser("export", help="run one columnar (Parquet) export pass into EXPORT_DIR")
+    sub.add_parser(
+        "partitions",
+        help="seal finished months, apply retention, and list event partitions",
+    )
+    args = parser.parse_args(argv)
+
+    if args.cmd == "export":
+        if pa is None:
+            print("export needs pyarrow (pip install pyarrow)")
+            return 1
+        conn = open_conn(readonly=True)
+        try:
+            run_export(conn)
+        finally:
+            conn.close()
+        print(json.dumps(export_stats))
+        return 0
+
+    if args.cmd == "vacuum":
+        before = os.path.getsize(DB_PATH)
+        with db.writer() as conn:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"{before} -> {os.path.getsize(DB_PATH)} bytes")
+        return 0
+
+    if args.cmd == "partitions":
+        conn = open_conn()
+        try:
+            maintain_partitions(conn)
+            rows = conn.execute(
+                "SELECT name, state, rows, COALESCE(archive_path, path) FROM event_partitions ORDER BY min_ts"
+            ).fetchall()
+        finally:
+            conn.close()
+        for name, state, count, path in rows:
+            print(f"{name}  {state:<8}  {count:>10}  {path}")
+        print(f"{len(rows)} partitions")
+        return 0
+
+    if args.cmd == "materialize-sessions":
+        if args.rebuild:
+            with db.writer() as conn:
+                reset_session_materialization(conn)
+        conn = open_conn(readonly=True)
+        try:
+            done = materialize_sessions(conn)
+        finally:
+            conn.close()
+        print(f"{done} events merged into sessions (through id {session_materializer_stats['last_event_id']})")
+        return 0
+
+    if args.cmd == "rebuild-rollups":
+        rebuild_rollups()
+        if APPROX_DISTINCT == "on":
+            with db.writer() as conn:
+                rebuild_sketches(conn)
+        print("rollups rebuilt")
+        return 0
+
+    if args.cmd == "backfill":
+        run_backfills()
+        print(json.dumps(backfill_stats))
+        return 0
+
+    if args.cmd == "check-plans":
+        if not args.live:
+            _use_scratch_db()
+        failed = 0
+        for item in check_query_plans():
+            print(("ok    " if item["ok"] else "SCAN  ") + item["sql"])
+            for step in item["plan"]:
+                print("        " + step)
+            if item["allowed"]:
+                print(f"        allowed ({item['name']}): {item['allowed']}")
+            failed += not item["ok"]
+        print(f"{failed} queries full-scan events" if failed else "all stats queries use indexes")
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,39 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def load_tracker(tmp_path, monkeypatch):
+    """
+    يستورد main.py من جديد على قاعدة بـ tmp_path: الإعدادات تنقرأ من env والـ schema
+    تنبني وقت الاستيراد، فكل تحميل زي تشغيل سيرفر جديد على نفس الملف.
+    """
+    loaded = []
+
+    def load(**env):
+        for module in loaded:
+            module.db.close()
+        monkeypatch.setenv("DB_PATH", str(tmp_path / "events.db"))
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        sys.modules.pop("main", None)
+        module = importlib.import_module("main")
+        loaded.append(module)
+        return module
+
+    yield load
+    for module in loaded:
+        module.db.close()
+    sys.modules.pop("main", None)
+
+
+@pytest.fixture
+def tracker(load_tracker):
+    return load_tracker()
@@ -0,0 +1,218 @@
+import inspect
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+
+def _seed(tracker, n=20):
+    with tracker.db.writer() as conn:
+        tracker.apply_batch(
+            conn,
+            [
+                (
+                    tracker.EventIn(
+                        event="purchase" if i % 4 == 0 else "page_view",
+                        session_id=f"s{i % 7}",
+                        device_id=f"d{i % 5}",
+                        geo_country="JO" if i % 2 else "SA",
+                        traffic_source=(None, "", "whatsapp")[i % 3],
+                        url=f"https://shop.example/p/{i % 3}",
+                    ),
+                    1_700_000_000 + i * 60,
+                )
+                for i in range(n)
+            ],
+        )
+
+
+def _legacy(tracker):
+    """يرجّع القاعدة لحالة ما قبل الترحيلات: نصوص بدل ids، أعمدة meta فاضية، بدون sketches."""
+    conn = sqlite3.connect(tracker.DB_PATH)
+    conn.execute("UPDATE events SET url = (SELECT value FROM strings WHERE id = url_id), url_id = NULL")
+    conn.execute("UPDATE events SET meta = '{\"product_id\": \"p1\", \"value\": \"5\"}', product_id = NULL, value = NULL")
+    conn.execute("DELETE FROM hll_sketches")
+    conn.execute(
+        """
+        DELETE FROM app_meta WHERE key IN (
+            'meta_columns_backfilled', 'meta_columns_target',
+            'events_strings_backfilled', 'events_strings_target',
+            'sketches_precision', 'sketches_building', 'sketches_target'
+        )
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_startup_leaves_backfills_to_the_worker(load_tracker):
+    tracker = load_tracker()
+    _seed(tracker)
+    _legacy(tracker)
+
+    tracker = load_tracker()
+    conn = sqlite3.connect(tracker.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE product_id IS NULL").fetchone()[0] == 20
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE url_id IS NULL").fetchone()[0] == 20
+    targets = dict(conn.execute("SELECT key, value FROM app_meta WHERE key LIKE '%target'"))
+    assert targets["meta_columns_target"] == "20"
+    assert targets["events_strings_target"] == "20"
+    assert targets["sketches_target"] == "20"
+    assert conn.execute("SELECT COUNT(*) FROM hll_sketches").fetchone()[0] == 0
+
+    # لحد ما الـ sketches تخلص approx=true بيرجع العدّ الدقيق
+    devices = inspect.unwrap(tracker.stats_devices)
+    geo = inspect.unwrap(tracker.stats_geo)
+    exact = devices()
+    assert devices(approx=True) == {**exact, "approx": {"building": True}}
+    assert geo(approx=True)["approx"] == {"building": True}
+    assert geo(approx=True)["by_country"] == geo()["by_country"]
+
+    tracker.run_backfills()
+    assert all(item["state"] == "done" for item in tracker.backfill_stats.values())
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE url_id IS NULL OR url IS NOT NULL").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE product_id = 'p1' AND value = 5").fetchone()[0] == 20
+    approx = devices(approx=True)
+    assert approx["approx"]["precision"] == tracker.HLL_PRECISION
+    # أعداد صغيرة: linear counting بيطلع الرقم بالضبط
+    assert approx["total_devices"] == exact["total_devices"] == 5
+    conn.close()
+
+
+def test_backfill_worker_runs_with_the_server(load_tracker):
+    tracker = load_tracker()
+    _seed(tracker)
+    _legacy(tracker)
+    tracker = load_tracker()
+    with TestClient(tracker.app) as client:
+        for _ in range(200):
+            status = client.get("/status").json()
+            if all(item["state"] == "done" for item in status["backfills"].values()):
+                break
+            tracker.time.sleep(0.02)
+        assert {name: item["state"] for name, item in status["backfills"].items()} == {
+            "rollups": "done",
+            "meta_columns": "done",
+            "events_strings": "done",
+            "sessions_strings": "done",
+            "sketches": "done",
+        }
+        assert not status["sketches"]["building"]
+        assert "building" not in client.get("/stats/devices?approx=true").json()["approx"]
+
+
+def test_backfill_resumes_after_stop(load_tracker, monkeypatch):
+    tracker = load_tracker()
+    _seed(tracker)
+    _legacy(tracker)
+
+    tracker = load_tracker()
+    monkeypatch.setattr(tracker, "META_BACKFILL_CHUNK", 6)
+    extract = tracker.extract_meta_fields
+    calls = []
+
+    def stop_after_first_chunk(meta):
+        calls.append(meta)
+        if len(calls) == 6:
+            tracker._stop_event.set()
+        return extract(meta)
+
+    monkeypatch.setattr(tracker, "extract_meta_fields", stop_after_first_chunk)
+    tracker.run_backfills()
+    assert tracker.backfill_stats["meta_columns"]["done_id"] == 6
+    conn = sqlite3.connect(tracker.DB_PATH)
+    assert conn.execute("SELECT value FROM app_meta WHERE key = 'meta_columns_backfilled'").fetchone() == ("6",)
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE product_id = 'p1'").fetchone()[0] == 6
+
+    # restart: بيكمل من الدفعة اللي انحفظت، مش من الأول
+    tracker = load_tracker()
+    monkeypatch.setattr(tracker, "META_BACKFILL_CHUNK", 6)
+    calls.clear()
+    monkeypatch.setattr(tracker, "extract_meta_fields", lambda meta: calls.append(meta) or extract(meta))
+    tracker.run_backfills()
+    assert len(calls) == 14
+    assert conn.execute("SELECT COUNT(*) FROM events WHERE product_id = 'p1'").fetchone()[0] == 20
+    assert conn.execute("SELECT value FROM app_meta WHERE key = 'meta_columns_backfilled'").fetchone() == ("complete",)
+    conn.close()
+
+
+def test_backfill_commits_through_the_pool(tracker, monkeypatch):
+    # db.commit بيشغّل الـ on_commit المعلّقة؛ conn.commit كان بيخليها للكتابة اللي بعدها
+    _seed(tracker)
+    _legacy(tracker)
+    with tracker.db.writer() as conn:
+        tracker.set_meta(conn.cursor(), "meta_columns_target", 20)
+        tracker.db.commit(conn)
+    commits = []
+    commit = tracker.db.commit
+    monkeypatch.setattr(tracker.db, "commit", lambda conn: commits.append(conn) or commit(conn))
+    tracker.backfill_meta_columns()
+    # دفعة وحدة + علامة complete
+    assert len(commits) == 2
+
+
+def _rollups(conn):
+    return {table: sorted(conn.execute(f"SELECT * FROM {table}")) for table in ("rollup_hourly", "rollup_daily", "rollup_totals")}
+
+
+def test_rebuild_rollups_matches_the_write_path(tracker):
+    _seed(tracker)
+    conn = sqlite3.connect(tracker.DB_PATH)
+    before = _rollups(conn)
+    # NULL و '' بمفتاحين منفصلين
+    assert {row[1] for row in before["rollup_daily"]} == {tracker.ROLLUP_NULL_SOURCE, "", "whatsapp"}
+    tracker.rebuild_rollups()
+    assert _rollups(conn) == before
+    conn.close()
+
+
+def test_rollups_rebuild_resumes_after_a_crash(load_tracker, monkeypatch):
+    tracker = load_tracker()
+    _seed(tracker)
+    conn = sqlite3.connect(tracker.DB_PATH)
+    expected = _rollups(conn)
+    overview = inspect.unwrap(tracker.stats_overview)()
+    # rollups من نسخة أقدم: init_db بيمسحها وبيثبّت لحد أي id تنعاد
+    conn.execute("DELETE FROM app_meta WHERE key = 'rollups_version'")
+    conn.commit()
+
+    tracker = load_tracker()
+    assert conn.execute("SELECT COUNT(*) FROM rollup_daily").fetchone() == (0,)
+    assert conn.execute("SELECT value FROM app_meta WHERE key = 'rollups_target'").fetchone() == ("20",)
+    # لحد ما تخلص الأرقام من events
+    assert inspect.unwrap(tracker.stats_overview)() == overview
+    monkeypatch.setattr(tracker, "ROLLUP_BACKFILL_CHUNK", 6)
+    update = tracker.update_rollups
+    calls = []
+
+    def crash_on_second_chunk(cur, rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise sqlite3.OperationalError("disk I/O error")
+        update(cur, rows)
+
+    monkeypatch.setattr(tracker, "update_rollups", crash_on_second_chunk)
+    try:
+        tracker.build_rollups()
+    except sqlite3.OperationalError:
+        pass
+    meta = dict(conn.execute("SELECT key, value FROM app_meta WHERE key LIKE 'rollups%'"))
+    assert "rollups_built" not in meta
+    assert meta["rollups_replayed_id"] == "6"
+    assert inspect.unwrap(tracker.stats_overview)() == overview
+
+    # restart: بيكمل من الدفعة اللي انحفظت بدون ما يعد الأولى مرتين
+    tracker = load_tracker()
+    monkeypatch.setattr(tracker, "ROLLUP_BACKFILL_CHUNK", 6)
+    tracker.run_backfills()
+    assert tracker.backfill_stats["rollups"]["state"] == "done"
+    assert _rollups(conn) == expected
+    assert conn.execute("SELECT value FROM app_meta WHERE key = 'rollups_built'").fetchone() == ("20",)
+    assert inspect.unwrap(tracker.stats_overview)() == overview
+    conn.close()
+
+
+def test_rebuild_sketches_cli_path(tracker):
+    _seed(tracker)
+    with tracker.db.writer() as conn:
+        tracker.rebuild_sketches(conn)
+        assert tracker.sketches_ready(conn.cursor())
@@ -0,0 +1,132 @@
+import csv
+import gzip
+import io
+import json
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+
+def _seed(tracker, n, first=0):
+    with tracker.db.writer() as conn:
+        tracker.apply_batch(
+            conn,
+            [
+                (
+                    tracker.EventIn(
+                        event="purchase" if i % 5 == 0 else "page_view",
+                        session_id=f"s{i % 11}",
+                        device_id=f"d{i % 7}",
+                        event_id=f"e{i}",
+                        url=f"https://shop.example/p/{i % 3}",
+                        meta={"product_id": i % 4, "value": 9.5} if i % 5 == 0 else None,
+                    ),
+                    1_700_000_000 + i * 60,
+                )
+                for i in range(first, first + n)
+            ],
+        )
+
+
+def _ndjson(resp):
+    return [json.loads(line) for line in resp.content.splitlines()]
+
+
+def test_export_pages_cover_every_event_once(load_tracker):
+    # دفعات داخلية أصغر من الصفحة عشان الصفحة الوحدة تمر على كذا قراءة
+    tracker = load_tracker(EVENTS_EXPORT_CHUNK_ROWS=4)
+    _seed(tracker, 25)
+    with TestClient(tracker.app) as client:
+        rows, after_id, pages = [], 0, 0
+        while True:
+            resp = client.get("/events/export", params={"after_id": after_id, "limit": 10})
+            assert resp.headers["content-type"] == "application/x-ndjson"
+            page = _ndjson(resp)
+            after_id = int(resp.headers["X-Next-After-Id"])
+            if not page:
+                break
+            pages += 1
+            assert len(page) <= 10
+            assert page[-1]["id"] == after_id
+            rows += page
+        everything = _ndjson(client.get("/events/export"))
+
+    assert pages == 3
+    assert [row["id"] for row in rows] == list(range(1, 26))
+    assert rows == everything
+    conn = sqlite3.connect(tracker.DB_PATH)
+    expected = conn.execute("SELECT event, session_id, url, event_id FROM events_decoded ORDER BY id").fetchall()
+    conn.close()
+    assert [(r["event"], r["session_id"], r["url"], r["event_id"]) for r in rows] == expected
+    # meta بيطلع object مش نص
+    assert rows[0]["meta"] == {"product_id": 0, "value": 9.5}
+    assert rows[1]["meta"] == {}
+
+
+def test_export_stops_at_the_id_in_the_header(load_tracker, monkeypatch):
+    tracker = load_tracker(EVENTS_EXPORT_CHUNK_ROWS=4)
+    _seed(tracker, 10)
+    end_id = tracker._export_end_id
+
+    def then_write(after_id, limit):
+        # حدث بينكتب بعد ما انحسب X-Next-After-Id وقبل أول دفعة
+        result = end_id(after_id, limit)
+        _seed(tracker, 1, first=10)
+        return result
+
+    monkeypatch.setattr(tracker, "_export_end_id", then_write)
+    with TestClient(tracker.app) as client:
+        resp = client.get("/events/export", params={"after_id": 3})
+        assert resp.headers["X-Next-After-Id"] == "10"
+        assert [row["id"] for row in _ndjson(resp)] == list(range(4, 11))
+        monkeypatch.setattr(tracker, "_export_end_id", end_id)
+        resp = client.get("/events/export", params={"after_id": 10})
+        assert [row["id"] for row in _ndjson(resp)] == [11]
+        assert resp.headers["X-Next-After-Id"] == "11"
+        resp = client.get("/events/export", params={"after_id": 11})
+        assert resp.content == b""
+        assert resp.headers["X-Next-After-Id"] == "11"
+
+
+def test_export_csv_and_gzip(load_tracker):
+    tracker = load_tracker()
+    _seed(tracker, 6)
+    with TestClient(tracker.app) as client:
+        ndjson = _ndjson(client.get("/events/export"))
+        params = {"format": "csv", "gzip": "true", "limit": 4}
+        resp = client.get("/events/export", params=params)
+        # httpx بيفك الضغط لحاله؛ iter_raw بيرجع البايتات زي ما انبعتت
+        with client.stream("GET", "/events/export", params=params) as stream:
+            compressed = b"".join(stream.iter_raw())
+
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.headers["content-type"] == "text/csv; charset=utf-8"
+    assert resp.headers["X-Next-After-Id"] == "4"
+    assert 'filename="events-1-4.csv"' in resp.headers["content-disposition"]
+    assert gzip.decompress(compressed) == resp.content
+    rows = list(csv.DictReader(io.StringIO(resp.text)))
+    assert list(rows[0]) == list(tracker.EVENTS_EXPORT_COLUMNS)
+    assert [int(row["id"]) for row in rows] == [1, 2, 3, 4]
+    assert [row["event_id"] for row in rows] == [row["event_id"] for row in ndjson[:4]]
+
+
+def test_export_rejects_bad_params(tracker):
+    with TestClient(tracker.app) as client:
+        assert client.get("/events/export", params={"format": "xml"}).status_code == 422
+        assert client.get("/events/export", params={"limit": 0}).status_code == 422
+        assert client.get("/events/export", params={"after_id": -1}).status_code == 422
+
+
+def test_export_keeps_streaming_past_a_corrupt_meta(tracker):
+    _seed(tracker, 3)
+    conn = sqlite3.connect(tracker.DB_PATH)
+    conn.execute("UPDATE events SET meta = '{\"product_id\": ' WHERE id = 2")
+    conn.execute("UPDATE events SET meta = ? WHERE id = 3", ("[" * 100_000 + "]" * 100_000,))
+    conn.commit()
+    conn.close()
+    with TestClient(tracker.app) as client:
+        rows = _ndjson(client.get("/events/export"))
+    assert [row["id"] for row in rows] == [1, 2, 3]
+    assert rows[0]["meta"] == {"product_id": 0, "value": 9.5}
+    assert rows[1]["meta"] == '{"product_id": '
+    assert rows[2]["meta"].startswith("[[[")
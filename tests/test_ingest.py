@@ -0,0 +1,221 @@
+import sqlite3
+
+
+def _event(tracker, n, **fields):
+    payload = {"event": "page_view", "session_id": f"s{n}", "device_id": f"d{n}", **fields}
+    return tracker.EventIn(**payload), 1_700_000_000 + n
+
+
+def _count(tracker, sql="SELECT COUNT(*) FROM events"):
+    conn = sqlite3.connect(tracker.DB_PATH)
+    try:
+        return conn.execute(sql).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_failing_commit_callback_does_not_replay_batch(tracker, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("cache blew up")
+
+    monkeypatch.setattr(tracker.session_cache, "put_many", broken)
+    with tracker.db.writer() as conn:
+        errors = tracker.apply_batch(conn, [_event(tracker, n) for n in range(3)])
+    assert errors == [None, None, None]
+    assert _count(tracker) == 3
+
+
+def test_failed_batch_retry_counts_each_event_once(tracker, monkeypatch):
+    update = tracker.update_rollups
+    calls = []
+
+    def fail_first_batch(cur, rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        update(cur, rows)
+
+    monkeypatch.setattr(tracker, "update_rollups", fail_first_batch)
+    with tracker.db.writer() as conn:
+        errors = tracker.apply_batch(conn, [_event(tracker, n) for n in range(3)])
+    assert errors == [None, None, None]
+    # الدفعة رجعت rollback بعد upsert_devices و upsert_sessions وانعادت حدث حدث
+    stats = tracker.ingest_stats
+    assert (stats["written"], stats["failed"]) == (3, 0)
+    assert (stats["device_rows"], stats["device_writes"]) == (3, 3)
+    assert (stats["session_rows"], stats["session_writes"]) == (3, 3)
+
+
+def test_blank_event_id_is_not_an_id(tracker):
+    from fastapi.testclient import TestClient
+
+    with TestClient(tracker.app) as client:
+        for n in range(2):
+            resp = client.post("/track", json={"event": "page_view", "session_id": "s", "device_id": "d", "event_id": ""})
+            assert resp.json() == {"status": "ok"}
+        resp = client.post(
+            "/track/batch",
+            json=[{"event": "page_view", "session_id": "s", "device_id": "d", "event_id": value} for value in ("", " ", "")],
+        )
+        assert resp.status_code == 200
+        assert resp.json()["accepted"] == 3
+    assert _count(tracker) == 5
+    assert _count(tracker, "SELECT COUNT(*) FROM events WHERE event_id IS NOT NULL") == 0
+
+
+def test_old_event_id_index_is_rebuilt(load_tracker):
+    tracker = load_tracker()
+    conn = sqlite3.connect(tracker.DB_PATH)
+    # الفهرس زي ما كان: "" جواه، وفي حدث قديم انكتب بـ ""
+    conn.execute("DROP INDEX uq_events_event_id")
+    conn.execute("CREATE UNIQUE INDEX uq_events_event_id ON events (event_id) WHERE event_id IS NOT NULL")
+    conn.execute("INSERT INTO events (event, session_id, device_id, created_at, event_id) VALUES ('page_view', 's', 'd', 1, '')")
+    conn.commit()
+    conn.close()
+
+    tracker = load_tracker()
+    assert _count(tracker, "SELECT COUNT(*) FROM events WHERE event_id = ''") == 0
+    with tracker.db.writer() as conn:
+        conn.execute("INSERT INTO events (event, created_at, event_id) VALUES ('page_view', 2, '')")
+        conn.execute("INSERT INTO events (event, created_at, event_id) VALUES ('page_view', 3, '')")
+        conn.rollback()
+
+
+def test_track_stores_event(tracker):
+    from fastapi.testclient import TestClient
+
+    with TestClient(tracker.app) as client:
+        resp = client.post(
+            "/track",
+            json={
+                "event": "add_to_cart",
+                "session_id": "s1",
+                "device_id": "d1",
+                "url": "https://shop.example/products/a",
+                "traffic_source": "whatsapp",
+                "meta": {"product_id": 7, "quantity": 2},
+            },
+        )
+        assert resp.json() == {"status": "ok"}
+    conn = sqlite3.connect(tracker.DB_PATH)
+    row = conn.execute(
+        "SELECT event, session_id, url, traffic_source, product_id, quantity FROM events_decoded"
+    ).fetchone()
+    assert row == ("add_to_cart", "s1", "https://shop.example/products/a", "whatsapp", "7", 2)
+    assert conn.execute("SELECT COUNT(*) FROM sessions WHERE session_id = 's1'").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM devices WHERE device_id = 'd1'").fetchone()[0] == 1
+    conn.close()
+
+
+def test_queue_mode_writes_on_the_background_writer(load_tracker):
+    from fastapi.testclient import TestClient
+
+    tracker = load_tracker(INGEST_MODE="queue", INGEST_FLUSH_MS=10)
+    with TestClient(tracker.app) as client:
+        for n in range(3):
+            resp = client.post("/track", json={"event": "page_view", "session_id": f"s{n}", "device_id": "d"})
+            assert resp.json() == {"status": "ok"}
+        resp = client.post(
+            "/track/batch",
+            json=[{"event": "page_view", "session_id": "s", "device_id": "d"}, {"event": "page_view"}],
+        )
+        assert resp.json()["accepted"] == 1
+        assert client.get("/status").json()["ingest"]["writer_alive"]
+    # الإيقاف بيفضّي الطابور قبل ما يسكّر
+    assert _count(tracker) == 4
+    assert tracker.ingest_stats["accepted"] == 4
+    assert tracker.ingest_stats["written"] == 4
+
+
+def test_queue_full_is_rejected(load_tracker):
+    from fastapi.testclient import TestClient
+
+    tracker = load_tracker(INGEST_MODE="queue", INGEST_QUEUE_SIZE=1, INGEST_BACKPRESSURE="reject")
+    tracker._ingest_queue.put_nowait((tracker.EventIn(event="page_view", session_id="s", device_id="d"), 1))
+    # بدون lifespan ما في كاتب، فالطابور بيضل مليان
+    client = TestClient(tracker.app)
+    resp = client.post("/track", json={"event": "page_view", "session_id": "s", "device_id": "d"})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "1"
+    assert tracker.ingest_stats["rejected"] == 1
+
+
+def test_track_batch_reports_each_event(tracker):
+    from fastapi.testclient import TestClient
+
+    with TestClient(tracker.app) as client:
+        resp = client.post(
+            "/track/batch",
+            json={"events": [
+                {"event": "page_view", "session_id": "s", "device_id": "d"},
+                {"event": "page_view", "session_id": "s"},
+                {"event": "purchase", "session_id": "s", "device_id": "d"},
+            ]},
+        )
+    body = resp.json()
+    assert (body["status"], body["accepted"], body["failed"]) == ("partial", 2, 1)
+    assert [r["status"] for r in body["results"]] == ["ok", "error", "ok"]
+    assert _count(tracker) == 2
+
+
+def test_track_batch_ndjson(tracker):
+    from fastapi.testclient import TestClient
+
+    lines = [
+        '{"event": "page_view", "session_id": "s", "device_id": "d"}',
+        "",
+        "{not json",
+        '{"event": "purchase", "session_id": "s", "device_id": "d"}',
+    ]
+    with TestClient(tracker.app) as client:
+        resp = client.post(
+            "/track/batch",
+            content="\n".join(lines).encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        bad = client.post("/track/batch", content=b"{not json", headers={"Content-Type": "application/json"})
+    body = resp.json()
+    # السطر الفاضي ما بينعد، والسطر الخربان بمكانه
+    assert [r["status"] for r in body["results"]] == ["ok", "error", "ok"]
+    assert body["results"][1]["detail"].startswith("invalid JSON")
+    assert bad.status_code == 400
+    assert _count(tracker) == 2
+
+
+def test_track_batch_rejects_oversized_batch(load_tracker):
+    from fastapi.testclient import TestClient
+
+    tracker = load_tracker(TRACK_BATCH_MAX_EVENTS=3)
+    with TestClient(tracker.app) as client:
+        resp = client.post(
+            "/track/batch",
+            json=[{"event": "page_view", "session_id": "s", "device_id": "d"}] * 4,
+        )
+    assert resp.status_code == 413
+    assert _count(tracker) == 0
+
+
+def test_duplicate_event_id_is_written_once(load_tracker):
+    from fastapi.testclient import TestClient
+
+    tracker = load_tracker()
+    event = {"event": "purchase", "session_id": "s", "device_id": "d", "event_id": "e1"}
+    with TestClient(tracker.app) as client:
+        assert client.post("/track", json=event).json() == {"status": "ok"}
+        # من النافذة بالذاكرة
+        assert client.post("/track", json=event).json() == {"status": "ok", "duplicate": True}
+        resp = client.post("/track/batch", json=[event, {**event, "event_id": "e2"}, {**event, "event_id": "e2"}])
+        assert [r.get("duplicate", False) for r in resp.json()["results"]] == [True, False, True]
+        assert client.get("/status").json()["ingest"]["duplicates"] == 3
+
+    # بعد restart النافذة فاضية، والفهرس هو اللي بيلقط المكرر
+    tracker = load_tracker()
+    assert "e1" not in tracker.dedupe_window
+    with tracker.db.writer() as conn:
+        errors = tracker.apply_batch(conn, [_event(tracker, 1, event_id="e1"), _event(tracker, 2, event_id="e3")])
+    assert errors == [tracker.DUPLICATE_EVENT, None]
+    assert _count(tracker) == 3
+    conn = sqlite3.connect(tracker.DB_PATH)
+    # المكرر ما بيدخل بالـ rollups
+    assert conn.execute("SELECT SUM(events) FROM rollup_daily").fetchone()[0] == 3
+    conn.close()
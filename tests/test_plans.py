@@ -0,0 +1,24 @@
+def test_stats_queries_use_indexes(tracker):
+    # نفس `python main.py check-plans`: قاعدة فاضية بنفس الهيكل
+    report = tracker.check_query_plans()
+    assert report
+    assert [item["sql"] for item in report if not item["ok"]] == []
+    # كل استثناء بالقائمة لسا مستعمل
+    assert {item["name"] for item in report if item["allowed"]} == set(tracker.PLAN_ALLOWED_SCANS)
+
+
+def test_plan_check_catches_a_full_scan(tracker, monkeypatch):
+    monkeypatch.setattr(
+        tracker, "collect_stats_queries", lambda: [(None, "SELECT COUNT(*) FROM events WHERE meta LIKE '%x%'")]
+    )
+    (item,) = tracker.check_query_plans()
+    assert not item["ok"]
+
+
+def test_plan_check_catches_a_covering_index_scan(tracker, monkeypatch):
+    sql = "SELECT COUNT(DISTINCT device_id) FROM events"
+    monkeypatch.setattr(tracker, "collect_stats_queries", lambda: [("devices.other", sql), ("devices.total", sql)])
+    other, allowed = tracker.check_query_plans()
+    assert any("USING COVERING INDEX" in step for step in other["plan"])
+    assert not other["ok"]
+    assert allowed["ok"] and allowed["allowed"] == tracker.PLAN_ALLOWED_SCANS["devices.total"]
@@ -0,0 +1,32 @@
+from fastapi.testclient import TestClient
+
+
+def test_sessions_cache_follows_materializer(load_tracker):
+    # TTL صفر: الـ entry يضل صالح بس طول ما الـ watermark ما تغير
+    tracker = load_tracker(
+        SESSION_MATERIALIZER="off",
+        STATS_CACHE="on",
+        STATS_CACHE_TTL_SESSIONS=0,
+        STATS_CACHE_STALE_S=0,
+    )
+    with TestClient(tracker.app) as client:
+        for n in range(3):
+            client.post("/track", json={"event": "page_view", "session_id": f"s{n}", "device_id": "d"})
+        assert client.get("/stats/sessions").json()["sessions"] == 0
+
+        conn = tracker.open_conn(readonly=True)
+        try:
+            assert tracker.materialize_sessions(conn) == 3
+        finally:
+            conn.close()
+        # ما انكتب ولا حدث جديد، بس المجمّع تقدم
+        assert client.get("/stats/sessions").json()["sessions"] == 3
+
+
+def test_events_watermark_still_drives_other_endpoints(load_tracker):
+    tracker = load_tracker(STATS_CACHE="on", STATS_CACHE_TTL_OVERVIEW=0, STATS_CACHE_STALE_S=0)
+    with TestClient(tracker.app) as client:
+        client.post("/track", json={"event": "page_view", "session_id": "s", "device_id": "d"})
+        assert client.get("/stats/overview").json()["total_events"] == 1
+        client.post("/track", json={"event": "page_view", "session_id": "s", "device_id": "d"})
+        assert client.get("/stats/overview").json()["total_events"] == 2
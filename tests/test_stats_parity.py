@@ -0,0 +1,284 @@
+"""كل /stats مقارن بإعادة حساب على صفوف events الخام (events_decoded)."""
+import inspect
+import sqlite3
+
+import pytest
+
+from bench import EventGenerator
+
+# ساعة كاملة ومش يوم كامل: الحدود على الساعة بتقرأ rollup_hourly، واللي مش عليها events
+START_TS = 1_699_999_200
+DAY = 86400
+
+
+@pytest.fixture
+def seeded(tracker):
+    gen = EventGenerator(seed=3, devices=120, products=15, start_ts=START_TS, days=6)
+    batch = [(tracker.EventIn(**payload), ts) for payload, ts in gen.events(1500)]
+    # بدون مصدر (NULL و '') وبدون دولة، عشان الـ buckets الفاضية، ومصدر اسمه "unknown" بنفس
+    # الجلسات (الفانل بيدمجه مع NULL و '')
+    for n in range(30):
+        payload = {"event": "product_view" if n % 2 else "page_view", "session_id": f"x{n % 9}", "device_id": f"x{n}"}
+        if n % 3:
+            payload["traffic_source"] = ("", "", "unknown")[n % 3]
+        batch.append((tracker.EventIn(**payload), START_TS + n * 3000))
+    with tracker.db.writer() as conn:
+        for start in range(0, len(batch), 200):
+            assert set(tracker.apply_batch(conn, batch[start:start + 200])) == {None}
+    conn = tracker.open_conn(readonly=True)
+    try:
+        tracker.materialize_sessions(conn)
+    finally:
+        conn.close()
+    return tracker
+
+
+@pytest.fixture
+def raw(seeded):
+    conn = sqlite3.connect(seeded.DB_PATH)
+    yield lambda sql, params=(): conn.execute(sql, params).fetchall()
+    conn.close()
+
+
+def _call(tracker, name, **kwargs):
+    # الدالة تحت cached_stats و run_on_readers، فالنتيجة محسوبة هلأ مش من الكاش
+    return inspect.unwrap(getattr(tracker, name))(**kwargs)
+
+
+FILTERS = [
+    {},
+    {"since": START_TS + DAY, "until": START_TS + 3 * DAY},
+    {"since": START_TS + DAY + 1, "until": START_TS + 3 * DAY - 7},
+    {"source": "whatsapp"},
+    {"since": START_TS + 2 * DAY, "source": "whatsapp"},
+    {"country": "JO"},
+    {"template_name": "product"},
+]
+
+
+def _where(filters):
+    sql, params = ["1"], []
+    for key, predicate in (
+        ("since", "created_at >= ?"),
+        ("until", "created_at < ?"),
+        ("source", "traffic_source = ?"),
+        ("country", "geo_country = ?"),
+        ("template_name", "template_name = ?"),
+    ):
+        if key in filters:
+            sql.append(predicate)
+            params.append(filters[key])
+    return " AND ".join(sql), params
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_events_daily(seeded, raw, filters):
+    result = _call(seeded, "stats_events_daily", limit_days=60, filters=seeded.StatsFilter(**filters))
+    where, params = _where(filters)
+    rows = raw(
+        f"""
+        SELECT strftime('%Y-%m-%d', created_at, 'unixepoch') AS day, COUNT(*) FROM events
+        WHERE {where} GROUP BY day ORDER BY day DESC
+        """,
+        params,
+    )
+    assert [(r["day"], r["count"]) for r in result] == rows
+    assert _call(seeded, "stats_events_daily", limit_days=2, filters=seeded.StatsFilter(**filters)) == result[:2]
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_overview(seeded, raw, filters):
+    result = _call(seeded, "stats_overview", filters=seeded.StatsFilter(**filters))
+    where, params = _where(filters)
+    (total, sessions, devices), = raw(
+        f"SELECT COUNT(*), COUNT(DISTINCT session_id), COUNT(DISTINCT device_id) FROM events WHERE {where}",
+        params,
+    )
+    # نفس استعلام by_source القديم: '' bucket لحاله و NULL برا
+    by_source = raw(
+        f"""
+        SELECT traffic_source, COUNT(*) FROM events
+        WHERE traffic_source IS NOT NULL AND {where} GROUP BY traffic_source
+        """,
+        params,
+    )
+    assert result["total_events"] == total
+    assert (result["total_sessions"], result["total_devices"]) == (sessions, devices)
+    assert [(r["traffic_source"], r["count"]) for r in result["by_source"]] == by_source
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_funnel(seeded, raw, filters):
+    result = _call(seeded, "stats_funnel", filters=seeded.StatsFilter(**filters))
+    where, params = _where(filters)
+    steps = ",".join("?" * len(seeded.FUNNEL_STEPS))
+    where = f"event IN ({steps}) AND session_id <> '' AND {where}"
+    params = list(seeded.FUNNEL_STEPS) + params
+
+    overall = dict(raw(f"SELECT event, COUNT(DISTINCT session_id) FROM events WHERE {where} GROUP BY event", params))
+    assert result["overall"] == {step: overall.get(step, 0) for step in seeded.FUNNEL_STEPS}
+
+    by_source = {}
+    for source, event, count in raw(
+        f"""
+        SELECT COALESCE(NULLIF(traffic_source, ''), 'unknown'), event, COUNT(DISTINCT session_id)
+        FROM events WHERE {where} GROUP BY 1, 2
+        """,
+        params,
+    ):
+        by_source.setdefault(source, dict.fromkeys(seeded.FUNNEL_STEPS, 0))[event] = count
+    assert result["by_source"] == by_source
+
+    by_product = {}
+    for key, event, count in raw(
+        f"""
+        SELECT product_id || ' | ' || COALESCE(NULLIF(product_title, ''), 'No Title'), event,
+               COUNT(DISTINCT session_id)
+        FROM events WHERE {where} AND product_id IS NOT NULL GROUP BY product_id, product_title, event
+        """,
+        params,
+    ):
+        by_product.setdefault(key, dict.fromkeys(seeded.FUNNEL_STEPS, 0))[event] = count
+    assert result["by_product"] == by_product
+
+
+def test_approx_matches_exact_within_error(seeded):
+    exact_devices = _call(seeded, "stats_devices")
+    exact_geo = _call(seeded, "stats_geo")
+    # قاعدة جديدة: الـ sketches بتنبني مع الكتابة، والـ worker بس بيعلّمها جاهزة
+    assert _call(seeded, "stats_devices", approx=True)["approx"] == {"building": True}
+    seeded.run_backfills()
+
+    approx = _call(seeded, "stats_devices", approx=True)
+    assert approx["approx"]["precision"] == seeded.HLL_PRECISION
+    assert approx["total_devices"] == pytest.approx(exact_devices["total_devices"], rel=0.05)
+    assert approx["purchased_devices"] == pytest.approx(exact_devices["purchased_devices"], rel=0.05)
+    geo = {r["country"]: r["sessions"] for r in _call(seeded, "stats_geo", approx=True)["by_country"]}
+    for row in exact_geo["by_country"]:
+        assert geo[row["country"]] == pytest.approx(row["sessions"], rel=0.05, abs=2)
+
+
+def test_funnel_product_pages(seeded):
+    full = _call(seeded, "stats_funnel")["by_product"]
+    pages, after = {}, None
+    while True:
+        page = _call(seeded, "stats_funnel", product_limit=4, product_after=after)
+        pages.update(page["by_product"])
+        after = page["next_product_after"]
+        if after is None:
+            break
+    assert pages == full
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_geo(seeded, raw, filters):
+    result = _call(seeded, "stats_geo", filters=seeded.StatsFilter(**filters))
+    where, params = _where(filters)
+    countries = raw(
+        f"""
+        SELECT geo_country, COUNT(DISTINCT session_id) FROM events
+        WHERE geo_country <> '' AND {where} GROUP BY geo_country
+        """,
+        params,
+    )
+    cities = raw(
+        f"SELECT geo_city, COUNT(DISTINCT session_id) FROM events WHERE geo_city <> '' AND {where} GROUP BY geo_city",
+        params,
+    )
+    assert {r["country"]: r["sessions"] for r in result["by_country"]} == dict(countries)
+    assert {r["city"]: r["sessions"] for r in result["by_city"]} == dict(cities)
+    counts = [r["sessions"] for r in result["by_country"]]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_geo_city_pages(seeded):
+    full = {r["city"]: r["sessions"] for r in _call(seeded, "stats_geo")["by_city"]}
+    pages, after = [], None
+    while True:
+        page = _call(seeded, "stats_geo", city_limit=3, city_after=after)
+        pages += [(r["city"], r["sessions"]) for r in page["by_city"]]
+        after = page["next_city_after"]
+        if after is None:
+            break
+    assert [city for city, _ in pages] == sorted(full)
+    assert dict(pages) == full
+
+
+def test_devices(seeded, raw):
+    result = _call(seeded, "stats_devices")
+    (total,), = raw("SELECT COUNT(DISTINCT device_id) FROM events")
+    (purchased,), = raw("SELECT COUNT(DISTINCT device_id) FROM events WHERE event = 'purchase'")
+    assert result == {
+        "total_devices": total,
+        "purchased_devices": purchased,
+        "no_purchase_devices": total - purchased,
+    }
+
+
+def test_device_types(seeded, raw):
+    result = _call(seeded, "stats_device_types")
+    (devices,), = raw("SELECT COUNT(DISTINCT device_id) FROM events")
+    for key in ("by_device_type", "by_brand", "by_os", "by_browser"):
+        assert sum(r["count"] for r in result[key]) == devices
+    # فلتر بيغطي كل الأحداث بيمر على _device_types_filtered وبيطلع نفس الأرقام
+    everything = _call(seeded, "stats_device_types", filters=seeded.StatsFilter(since=START_TS - 1))
+    for key, rows in result.items():
+        assert sorted(map(tuple, (r.values() for r in everything[key]))) == sorted(
+            map(tuple, (r.values() for r in rows))
+        )
+
+    jo = _call(seeded, "stats_device_types", filters=seeded.StatsFilter(country="JO"))
+    (jo_devices,), = raw("SELECT COUNT(DISTINCT device_id) FROM events WHERE geo_country = 'JO'")
+    assert sum(r["count"] for r in jo["by_device_type"]) == jo_devices
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [{}, {"since": START_TS + DAY, "until": START_TS + 3 * DAY}, {"source": "whatsapp"}],
+)
+def test_sessions(seeded, raw, filters):
+    result = _call(seeded, "stats_sessions", filters=seeded.StatsFilter(**filters), top=5)
+    views = ",".join(f"'{e}'" for e in seeded.SESSION_PAGEVIEW_EVENTS)
+    steps = " ".join(f"WHEN '{e}' THEN {i}" for i, e in enumerate(seeded.FUNNEL_STEPS, 1))
+    sessions = raw(
+        f"""
+        SELECT e.session_id, COUNT(*), SUM(e.event IN ({views})), MIN(e.created_at),
+               MAX(e.created_at) - MIN(e.created_at), MAX(CASE e.event {steps} ELSE 0 END),
+               MAX(e.event = 'purchase'), s.traffic_source
+        FROM events e JOIN sessions s ON s.session_id = e.session_id
+        GROUP BY e.session_id
+        """
+    )
+    sessions = [
+        row for row in sessions
+        if ("since" not in filters or row[3] >= filters["since"])
+        and ("until" not in filters or row[3] < filters["until"])
+        and ("source" not in filters or row[7] == filters["source"])
+    ]
+    n = len(sessions)
+    assert result["sessions"] == n
+    assert result["bounce_rate"] == round(sum(row[2] <= 1 for row in sessions) / n, 4)
+    assert result["pages_per_session"] == round(sum(row[2] for row in sessions) / n, 2)
+    assert result["avg_duration_s"] == round(sum(row[4] for row in sessions) / n, 1)
+    assert result["purchase_rate"] == round(sum(row[6] for row in sessions) / n, 4)
+    assert result["funnel"] == {
+        step: sum(row[5] >= i for row in sessions) for i, step in enumerate(seeded.FUNNEL_STEPS, 1)
+    }
+
+    # صفحة الدخول = url أول حدث بالجلسة
+    ids = {row[0] for row in sessions}
+    landing = {}
+    for session_id, url in raw(
+        """
+        SELECT session_id, url FROM events_decoded e
+        WHERE created_at = (SELECT MIN(created_at) FROM events WHERE session_id = e.session_id)
+        """
+    ):
+        if session_id in ids and url is not None:
+            landing[url] = landing.get(url, 0) + 1
+    top = sorted(landing.values(), reverse=True)[:5]
+    assert [page["sessions"] for page in result["landing_pages"]] == top
+    for page in result["landing_pages"]:
+        assert landing[page["url"]] == page["sessions"]
+    (last_id,), = raw("SELECT MAX(id) FROM events")
+    assert (result["materialized_through_id"], result["lag_events"]) == (last_id, 0)